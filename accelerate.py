@@ -0,0 +1,100 @@
+"""This module accelerates the constant updates with Broyden's method.
+
+The calibration workbooks move each constant by the log ratio of its target
+and modeled share, as if every constant moved only its own share and by
+exactly that much. Where segments interact, as the coordinated activity
+patterns of household members do in CDAP, that step overshoots or undershoots
+and ignores the other segments, so the constants approach their targets over
+many model runs.
+
+The workbook of every iteration records the constants the model ran with and
+the constants the workbook proposes; their difference is the residual, which
+is zero once the modeled shares hit their targets. Broyden's method estimates
+the Jacobian of the residuals with respect to the constants from the secant
+of each pair of consecutive iterations, starting from the workbook's own
+assumption (minus the identity, under which its step is exact), and solves
+for the constants whose residuals are zero. Cross-segment sensitivities
+enter through the off-diagonal terms. The step is damped towards the
+workbook's, capped relative to it, and replaced by it while there is too
+little history or the estimate is singular.
+
+"""
+
+import numpy as np
+
+
+def jacobian(constants, residuals, min_change=1e-9):
+    """Estimate the Jacobian of the residuals with Broyden updates.
+
+    Parameters
+    ----------
+    constants : numpy.ndarray
+        The constants of each iteration, one row per iteration.
+    residuals : numpy.ndarray
+        The workbook's proposed change of the constants of each iteration.
+    min_change : float, default : 1e-9
+        Pairs of iterations whose constants moved less than this are
+        skipped.
+
+    Returns
+    -------
+    jacobian : numpy.ndarray
+        The estimated change of the residuals per change of the constants.
+
+    """
+    estimate = -np.eye(constants.shape[1])
+    for step, change in zip(np.diff(constants, axis=0),
+                            np.diff(residuals, axis=0)):
+        size = step @ step
+        if size > min_change ** 2:
+            estimate += np.outer(change - estimate @ step, step) / size
+    return estimate
+
+
+def propose(before, after, damping=0.8, max_ratio=5.0, min_history=2,
+            max_condition=1e6):
+    """Propose the next constants of a step from its whole history.
+
+    Parameters
+    ----------
+    before : array-like
+        The constants each model run used, one row per iteration, oldest
+        first. The last row is the run just completed.
+    after : array-like
+        The constants the workbook proposed from each run.
+    damping : float, default : 0.8
+        The weight of the Broyden step against the workbook's step.
+    max_ratio : float, default : 5.0
+        The largest change of any constant, as a multiple of the largest
+        change the workbook proposes.
+    min_history : int, default : 2
+        The number of iterations needed before accelerating.
+    max_condition : float, default : 1e6
+        The largest condition number of the estimated Jacobian.
+
+    Returns
+    -------
+    constants : list of float
+        The next constants.
+    method : str
+        'broyden' if the step was accelerated, otherwise 'workbook'.
+
+    """
+    before = np.asarray(before, dtype=float)
+    after = np.asarray(after, dtype=float)
+    residuals = after - before
+    workbook = after[-1].tolist()
+    if len(before) < min_history or not np.isfinite(residuals).all():
+        return workbook, 'workbook'
+    estimate = jacobian(before, residuals)
+    if np.linalg.cond(estimate) > max_condition:
+        return workbook, 'workbook'
+    step = -np.linalg.solve(estimate, residuals[-1])
+    step = damping * step + (1 - damping) * residuals[-1]
+    limit = max_ratio * np.abs(residuals[-1]).max()
+    largest = np.abs(step).max()
+    if not np.isfinite(largest):
+        return workbook, 'workbook'
+    if largest > limit:
+        step *= limit / largest
+    return (before[-1] + step).tolist(), 'broyden'
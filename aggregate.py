@@ -0,0 +1,710 @@
+"""This module counts model results for the calibration targets.
+
+A target is declared by the output file it counts, the columns it groups by,
+the values of other columns it keeps and the labels its groups are renamed
+to. The targets are planned by file, and each file is read once, streaming
+only the columns any of its targets needs, while every target of that file is
+counted in the same pass. The same pass can also archive the file as
+compressed Parquet, which later analyses can load column by column through a
+memory map with read_archive. Given several workers, a file is instead split
+at line boundaries into byte ranges that are counted in a process pool, and
+their partial counts are merged. The result files of an ensemble of runs are
+counted together, each run's counts kept in its own column.
+
+Archiving to Parquet needs pyarrow, an optional dependency that is only
+imported by archive and read_archive. Without it, keep results as csv copies
+with --archive csv, which pandas alone counts.
+
+Counts can be kept in a CountCache, keyed by a hash of the file's contents and
+the target's definition, so updating an iteration again does not parse an
+unchanged file. Cached counts can be dropped with:
+
+    python aggregate.py invalidate CACHE_DIR [SOURCE ...]
+
+"""
+
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import hashlib
+import io
+import json
+import mmap
+import os
+import os.path as osp
+import tempfile
+import threading
+
+import pandas as pd
+
+
+CDAP_NAMES = {'Child too young for school': 'Pre-school',
+              'Non-worker': 'Non-working Adult',
+              'Retired': 'Non-working Senior',
+              'Student of driving age': 'Driving Age Student',
+              'Student of non-driving age': 'Non-driving Student',
+              'University Student': 'College Student'}
+
+
+class Target():
+    """A count of model results by one or more columns.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the csv file in the model's output directory, with an
+        {iteration} field if each global iteration writes its own file.
+    columns : list of str
+        The columns to count rows by.
+    filters : dict, default : None
+        For each column to filter on, the values of the rows to keep.
+    labels : dict, default : None
+        For each column to relabel, a mapping of model values to the labels
+        used by the calibration workbook.
+
+    """
+
+    def __init__(self, filename, columns, filters=None, labels=None):
+        self.filename = filename
+        self.columns = list(columns)
+        self.filters = filters or {}
+        self.labels = labels or {}
+
+    @property
+    def usecols(self):
+        """The columns that have to be read for this target."""
+        return set(self.columns) | set(self.filters)
+
+    def results(self, iteration=3):
+        """The name of the file written by a global iteration of the model."""
+        return self.filename.format(iteration=iteration)
+
+
+RANGE_BYTES = 67108864
+
+TARGETS = OrderedDict([
+    ('AO', Target('aoResults.csv', ['AO'])),
+    ('CDAP', Target('personData_{iteration}.csv',
+                    ['type', 'activity_pattern'],
+                    labels={'type': CDAP_NAMES}))])
+
+
+def plan(targets, iteration=3):
+    """Group targets by the file they count.
+
+    Parameters
+    ----------
+    targets : dict
+        Targets keyed by name.
+    iteration : int, default : 3
+        The global iteration of the model whose files are counted.
+
+    Returns
+    -------
+    files : collections.OrderedDict
+        For each file, an OrderedDict of its targets keyed by name.
+
+    """
+    files = OrderedDict()
+    for name, target in targets.items():
+        files.setdefault(target.results(iteration),
+                         OrderedDict())[name] = target
+    return files
+
+
+def _numeric(values):
+    """Convert labels read as text to numbers if they all are."""
+    try:
+        return pd.to_numeric(pd.Index(values)).tolist()
+    except (TypeError, ValueError):
+        return list(values)
+
+
+def _counts(totals, target):
+    """Build the labeled and sorted counts of a target from a dict."""
+    keys = list(totals)
+    levels = [_numeric([key[idx] for key in keys])
+              for idx in range(len(target.columns))]
+    if len(target.columns) == 1:
+        index = pd.Index(levels[0], name=target.columns[0])
+    else:
+        index = pd.MultiIndex.from_arrays(levels, names=target.columns)
+    counts = pd.Series(list(totals.values()), index=index, dtype='int64')
+    for column, mapping in target.labels.items():
+        if len(target.columns) == 1:
+            counts = counts.rename(index=mapping)
+        else:
+            counts = counts.rename(index=mapping, level=column)
+    return counts.sort_index()
+
+
+def _tally(chunk, targets, totals):
+    """Add the counts of each target in a chunk of rows to its totals."""
+    for name, target in targets.items():
+        rows = chunk
+        for column, values in target.filters.items():
+            rows = rows[rows[column].isin([str(value) for value in values])]
+        sizes = rows.groupby(target.columns, observed=True).size()
+        for key, size in sizes.items():
+            if not isinstance(key, tuple):
+                key = (key,)
+            totals[name][key] = totals[name].get(key, 0) + size
+
+
+def scan(filename, targets, chunksize=None, workers=None):
+    """Count every target of a file in a single read.
+
+    Only the columns needed by the targets are read, as categoricals, so
+    memory use depends on the number of groups rather than the number of
+    rows when reading in chunks or in parallel.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the csv file.
+    targets : dict
+        Targets of the file keyed by name.
+    chunksize : int, default : None
+        If given, the file is read this many rows at a time.
+    workers : int, default : None
+        If more than one, the file is counted in byte ranges by this many
+        processes instead, see scan_ranges, and chunksize is ignored.
+
+    Returns
+    -------
+    counts : dict
+        For each target, a pandas.Series of the number of rows indexed by
+        its columns, relabeled and sorted.
+
+    """
+    if workers and workers > 1:
+        totals = scan_ranges(filename, targets, workers)
+    else:
+        usecols = sorted(set().union(*(target.usecols
+                                       for target in targets.values())))
+        reader = pd.read_csv(filename, usecols=usecols, dtype='category',
+                             chunksize=chunksize)
+        if not chunksize:
+            reader = [reader]
+        totals = {name: {} for name in targets}
+        for chunk in reader:
+            _tally(chunk, targets, totals)
+    return {name: _counts(totals[name], target)
+            for name, target in targets.items()}
+
+
+def split_ranges(filename, parts, range_bytes=RANGE_BYTES):
+    """Split the rows of a csv file into byte ranges at line boundaries.
+
+    Fields must not contain line breaks, as in the model's outputs.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the csv file.
+    parts : int
+        The smallest number of ranges to split the rows into.
+    range_bytes : int, default : RANGE_BYTES
+        The largest size of a range before it is moved to a line boundary,
+        which bounds the memory each range takes to count.
+
+    Returns
+    -------
+    header : list of str
+        The column names.
+    ranges : list of tuple
+        The start and end offset of each range, after the header.
+
+    """
+    with open(filename, 'rb') as results:
+        if not os.fstat(results.fileno()).st_size:
+            return [], []
+        with mmap.mmap(results.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            size = len(view)
+            start = view.find(b'\n') + 1 or size
+            header = next(csv.reader(
+                [view[:start].decode().rstrip('\r\n')]))
+            parts = max(parts, -(-(size - start) // range_bytes))
+            bounds = [start]
+            for part in range(1, parts):
+                offset = max(start + (size - start) * part // parts,
+                             bounds[-1])
+                offset = view.find(b'\n', offset) + 1 or size
+                if offset < size:
+                    bounds.append(offset)
+            bounds.append(size)
+    return header, [(first, last) for first, last in zip(bounds, bounds[1:])
+                    if last > first]
+
+
+def _count_range(filename, start, end, header, targets):
+    """Count the targets in the rows between two offsets of a csv file."""
+    with open(filename, 'rb') as results:
+        with mmap.mmap(results.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            rows = view[start:end]
+    usecols = sorted(set().union(*(target.usecols
+                                   for target in targets.values())))
+    chunk = pd.read_csv(io.BytesIO(rows), header=None, names=header,
+                        usecols=usecols, dtype='category')
+    totals = {name: {} for name in targets}
+    _tally(chunk, targets, totals)
+    return totals
+
+
+def scan_ranges(filename, targets, workers=None):
+    """Count the targets of a csv file in parallel byte ranges.
+
+    The file is split at line boundaries into at least one range per worker
+    and each range is parsed and counted in a process pool.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the csv file.
+    targets : dict
+        Targets of the file keyed by name.
+    workers : int, default : None
+        The number of processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    totals : dict
+        For each target, the number of rows of each group of its columns
+        before relabeling, keyed by tuples of the values read.
+
+    """
+    workers = workers or os.cpu_count() or 1
+    header, ranges = split_ranges(filename, workers)
+    totals = {name: {} for name in targets}
+    if not ranges:
+        return totals
+    with ProcessPoolExecutor(min(workers, len(ranges))) as pool:
+        futures = [pool.submit(_count_range, filename, start, end, header,
+                               targets) for start, end in ranges]
+        for future in futures:
+            _merge(totals, future.result())
+    return totals
+
+
+def _merge(totals, partial):
+    """Add the totals of a range to the totals of its file."""
+    for name, counts in partial.items():
+        for key, size in counts.items():
+            totals[name][key] = totals[name].get(key, 0) + size
+
+
+def scan_ensemble(filenames, targets, chunksize=None, workers=None):
+    """Count every target in the result files of several runs.
+
+    Given several workers, the byte ranges of all files are counted in one
+    process pool, so the pool stays busy across files instead of draining
+    at the end of each.
+
+    Parameters
+    ----------
+    filenames : list of str
+        Paths to the csv files, one per run.
+    targets : dict
+        Targets of the files keyed by name.
+    chunksize : int, default : None
+        If given, and counting in a single process, each file is read this
+        many rows at a time.
+    workers : int, default : None
+        If more than one, the number of processes counting the byte ranges.
+
+    Returns
+    -------
+    counts : dict
+        For each target, a pandas.DataFrame of the number of rows of each
+        run, one column per file, indexed as by scan. Groups a run has no
+        rows of are counted as 0.
+
+    """
+    if workers and workers > 1:
+        totals = [{name: {} for name in targets} for _ in filenames]
+        jobs = []
+        for idx, filename in enumerate(filenames):
+            header, ranges = split_ranges(filename, workers)
+            jobs.extend((idx, filename, start, end, header)
+                        for start, end in ranges)
+        if jobs:
+            with ProcessPoolExecutor(min(workers, len(jobs))) as pool:
+                futures = [(idx, pool.submit(_count_range, filename, start,
+                                             end, header, targets))
+                           for idx, filename, start, end, header in jobs]
+                for idx, future in futures:
+                    _merge(totals[idx], future.result())
+        runs = [{name: _counts(run[name], target)
+                 for name, target in targets.items()} for run in totals]
+    else:
+        runs = [scan(filename, targets, chunksize=chunksize)
+                for filename in filenames]
+    return {name: pd.concat([run[name] for run in runs], axis=1,
+                            keys=range(len(runs))).fillna(0).astype('int64')
+            for name in targets}
+
+
+def _write_archive(filename, dest, targets, read_options, column_types,
+                   compression):
+    """Write the blocks of a csv file to Parquet and count their targets.
+
+    Raises pyarrow.ArrowInvalid if a block does not fit the column types,
+    which are inferred from the first block where column_types are None.
+
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pv
+    import pyarrow.parquet as pq
+
+    usecols = sorted(set().union(*(target.usecols
+                                   for target in targets.values())))
+    reader = pv.open_csv(filename, read_options=read_options,
+                         convert_options=pv.ConvertOptions(
+                             column_types=column_types))
+    totals = {name: {} for name in targets}
+    with pq.ParquetWriter(dest, reader.schema,
+                          compression=compression) as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+            chunk = pd.DataFrame({
+                column: batch.column(column).cast(pa.string())
+                .dictionary_encode().to_pandas() for column in usecols})
+            _tally(chunk, targets, totals)
+    return totals
+
+
+def archive(filename, dest, targets, block_size=None, compression='zstd'):
+    """Convert a csv file to Parquet and count its targets in the same pass.
+
+    The file is streamed in blocks with pyarrow, each block is written to
+    the archive and the columns the targets need are counted from it, so the
+    file is read only once. The column types are inferred from the first
+    block. If a later block does not fit them, e.g. a column that is empty
+    at first, the file is read again with every column as text. The archive
+    is written to a temporary file that replaces dest when complete.
+    Requires pyarrow.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the csv file.
+    dest : str
+        Path of the Parquet file to write.
+    targets : dict
+        Targets of the file keyed by name.
+    block_size : int, default : None
+        The number of bytes of the csv file read at a time. Defaults to
+        pyarrow's block size.
+    compression : str, default : 'zstd'
+        The compression codec of the archive.
+
+    Returns
+    -------
+    counts : dict
+        The counts of each target, as returned by scan.
+
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pv
+
+    read_options = pv.ReadOptions(block_size=block_size) if block_size \
+        else None
+    handle, temp = tempfile.mkstemp(dir=osp.dirname(osp.abspath(dest)),
+                                    suffix='.parquet')
+    os.close(handle)
+    try:
+        try:
+            totals = _write_archive(filename, temp, targets, read_options,
+                                    None, compression)
+        except pa.ArrowInvalid:
+            columns = pv.open_csv(filename,
+                                  read_options=read_options).schema.names
+            totals = _write_archive(
+                filename, temp, targets, read_options,
+                {column: pa.string() for column in columns}, compression)
+        os.replace(temp, dest)
+    except BaseException:
+        os.remove(temp)
+        raise
+    return {name: _counts(totals[name], target)
+            for name, target in targets.items()}
+
+
+def read_archive(filename, columns=None):
+    """Load columns of a Parquet archive through a memory map.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the Parquet file written by archive.
+    columns : list of str, default : None
+        The columns to load. Every column is loaded if None.
+
+    Returns
+    -------
+    results : pandas.DataFrame
+        The requested columns.
+
+    """
+    import pyarrow.parquet as pq
+
+    return pq.read_table(filename, columns=columns,
+                         memory_map=True).to_pandas()
+
+
+def aggregate(output_dir, targets=None, chunksize=None, workers=None,
+              iteration=3):
+    """Count all targets, reading each output file once.
+
+    Parameters
+    ----------
+    output_dir : str
+        Path to the model's output directory.
+    targets : dict, default : None
+        Targets keyed by name. Defaults to TARGETS.
+    chunksize : int, default : None
+        If given, the files are read this many rows at a time.
+    workers : int, default : None
+        If more than one, each file is counted by this many processes.
+    iteration : int, default : 3
+        The global iteration of the model whose files are counted.
+
+    Returns
+    -------
+    counts : dict
+        The counts of each target, as returned by scan.
+
+    """
+    counts = {}
+    for filename, file_targets in plan(targets or TARGETS,
+                                       iteration).items():
+        counts.update(scan(output_dir + '/' + filename, file_targets,
+                           chunksize=chunksize, workers=workers))
+    return counts
+
+
+class CountCache():
+    """Counts of targets stored on disk, keyed by the contents they count.
+
+    Each entry is a JSON file named after a BLAKE2 hash of the source file's
+    contents and the target's columns, filters and labels, so a changed file
+    or definition never matches an old entry. The hash of each source file is
+    remembered with its size and modification time, so an unchanged file is
+    not read again to hash it. Least recently used entries are removed once
+    the entries take more than the budget.
+
+    Parameters
+    ----------
+    directory : str
+        The directory the entries are stored in.
+    budget : int, default : 67108864
+        The largest combined size in bytes of the entries.
+
+    """
+
+    VERSION = 1
+    # Shared by every instance, as concurrent updates open their own cache
+    # on the same directory.
+    lock = threading.Lock()
+
+    def __init__(self, directory, budget=67108864):
+        self.directory = directory
+        self.budget = budget
+        os.makedirs(directory, exist_ok=True)
+
+    def _write(self, filename, data):
+        """Write a JSON file atomically."""
+        handle, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'w') as out:
+            json.dump(data, out, default=lambda value: value.item())
+        os.replace(temp, filename)
+
+    def _hashes(self):
+        try:
+            with open(osp.join(self.directory, 'hashes.json')) as hashes:
+                return json.load(hashes)
+        except (OSError, ValueError):
+            return {}
+
+    def digest(self, filename):
+        """Hash the contents of a file, reusing the hash while it's unchanged.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the file.
+
+        Returns
+        -------
+        digest : str
+            Hexadecimal BLAKE2 digest of the file's contents.
+
+        """
+        path = osp.abspath(filename)
+        status = os.stat(path)
+        stamp = [status.st_size, status.st_mtime_ns]
+        with self.lock:
+            known = self._hashes().get(path)
+        if known and known[:2] == stamp:
+            return known[2]
+        content = hashlib.blake2b(digest_size=20)
+        with open(path, 'rb') as source:
+            for block in iter(lambda: source.read(1 << 20), b''):
+                content.update(block)
+        digest = content.hexdigest()
+        with self.lock:
+            hashes = self._hashes()
+            hashes[path] = stamp + [digest]
+            self._write(osp.join(self.directory, 'hashes.json'), hashes)
+        return digest
+
+    def key(self, filename, target):
+        """Name of the entry of a target counted from a file."""
+        definition = json.dumps(
+            [self.VERSION, target.columns, target.filters, target.labels],
+            sort_keys=True, default=str)
+        return hashlib.blake2b(
+            (self.digest(filename) + definition).encode(),
+            digest_size=20).hexdigest()
+
+    def get(self, filename, target):
+        """Return the cached counts of a target, or None if not cached.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the file the target counts.
+        target : Target
+            The target.
+
+        Returns
+        -------
+        counts : pandas.Series or None
+            The counts as returned by scan.
+
+        """
+        entry = osp.join(self.directory, self.key(filename, target) + '.json')
+        try:
+            with open(entry) as cached:
+                data = json.load(cached)
+            os.utime(entry)
+        except (OSError, ValueError):
+            return None
+        if len(data['names']) == 1:
+            index = pd.Index([key[0] for key in data['index']],
+                             name=data['names'][0])
+        else:
+            index = pd.MultiIndex.from_tuples(
+                [tuple(key) for key in data['index']], names=data['names'])
+        return pd.Series(data['values'], index=index, dtype='int64')
+
+    def put(self, filename, target, counts):
+        """Store the counts of a target and evict old entries.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the file the target counts.
+        target : Target
+            The target.
+        counts : pandas.Series
+            The counts as returned by scan.
+
+        """
+        index = [list(key) if isinstance(key, tuple) else [key]
+                 for key in counts.index.tolist()]
+        data = {'source': osp.abspath(filename),
+                'names': list(counts.index.names), 'index': index,
+                'values': counts.tolist()}
+        entry = osp.join(self.directory, self.key(filename, target) + '.json')
+        with self.lock:
+            self._write(entry, data)
+            self._evict()
+
+    def entries(self):
+        """List the entries from most to least recently used.
+
+        Returns
+        -------
+        entries : list of tuple
+            The path, last use time and size of each entry.
+
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json') and name != 'hashes.json':
+                path = osp.join(self.directory, name)
+                try:
+                    status = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, status.st_mtime, status.st_size))
+        return sorted(entries, key=lambda entry: -entry[1])
+
+    def _evict(self):
+        total = 0
+        for path, _, size in self.entries():
+            total += size
+            if total > self.budget:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def invalidate(self, source=None):
+        """Remove the entries of a source file, or every entry.
+
+        Parameters
+        ----------
+        source : str, default : None
+            Path to the file whose counts are removed. If None, the cache is
+            emptied.
+
+        Returns
+        -------
+        removed : int
+            The number of entries removed.
+
+        """
+        removed = 0
+        source = source and osp.abspath(source)
+        with self.lock:
+            for path, _, _ in self.entries():
+                if source is not None:
+                    # Entries that can not be read may belong to any source.
+                    try:
+                        with open(path) as cached:
+                            if json.load(cached).get('source') != source:
+                                continue
+                    except (OSError, ValueError):
+                        continue
+                os.remove(path)
+                removed += 1
+            hashes = self._hashes()
+            for path in list(hashes):
+                if source is None or path == source:
+                    del hashes[path]
+            self._write(osp.join(self.directory, 'hashes.json'), hashes)
+        return removed
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='Manage the cache of counted model results.')
+    COMMANDS = PARSER.add_subparsers(dest='command')
+    COMMANDS.required = True
+    INVALIDATE = COMMANDS.add_parser(
+        'invalidate', help='Remove cached counts.')
+    INVALIDATE.add_argument(
+        'directory', metavar='Directory', type=str,
+        help='The cache directory.')
+    INVALIDATE.add_argument(
+        'sources', metavar='Sources', type=str, nargs='*',
+        help='The files whose counts are removed. Every entry is removed if '
+        'none are given.')
+    ARGS = PARSER.parse_args()
+    CACHE = CountCache(ARGS.directory)
+    REMOVED = sum(CACHE.invalidate(source) for source in ARGS.sources) \
+        if ARGS.sources else CACHE.invalidate()
+    print('Removed {} cached counts.'.format(REMOVED))
@@ -0,0 +1,505 @@
+"""Benchmark the calibration update.
+
+The `cdap` command compares reading a full personData file into memory against
+streaming only the columns needed by the CDAP update, and against counting
+them in parallel byte ranges. The `uec` command
+compares writing the constants into a UEC in place against rewriting it with
+xlutils, and checks that both produce the same cells. The `update` command
+generates synthetic model outputs, UECs and calibration workbooks of several
+sizes and measures each stage of the AO and CDAP updates: copying the results,
+reading and counting them, loading, recalculating and saving the calibration
+workbook, and writing the UEC. Wall-clock time and peak memory are reported
+for each, and the suite's results can be saved as JSON and compared against a
+stored baseline to flag regressions. The reference baseline in
+benchmarks/baseline.json holds the 100,000 row cases, measured with
+
+    python benchmark.py update -r 100000 -n 5 -o benchmarks/baseline.json
+
+Timings depend on the machine, so a baseline measured on the machine running
+the comparison flags regressions more reliably.
+
+"""
+
+import argparse
+import json
+import os
+import os.path as osp
+import platform
+import shutil
+import sys
+import tempfile
+from time import perf_counter
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from xlrd import open_workbook
+
+from synthetic import (write_ao_results, write_calibration_workbooks,
+                       write_person_data, write_uecs)
+from aggregate import TARGETS, scan
+from update import (STEPS, UECEditor, cdap_counts, read_cdap_counts,
+                    uec_constants, update)
+from workbooks import WorkbookManager
+
+
+BASELINE = osp.join(osp.dirname(osp.abspath(__file__)), 'benchmarks',
+                    'baseline.json')
+
+
+def measure(func, *args, **kwargs):
+    """Time a function call and track its peak memory allocation.
+
+    Parameters
+    ----------
+    func : callable
+        The function to measure.
+    *args, **kwargs
+        Arguments passed on to func.
+
+    Returns
+    -------
+    result : object
+        The value returned by func.
+    seconds : float
+        Wall-clock time of the call.
+    peak : int
+        Peak memory allocated during the call in bytes.
+
+    """
+    tracemalloc.start()
+    start = perf_counter()
+    result = func(*args, **kwargs)
+    seconds = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def full_cdap(filename):
+    """Aggregate the CDAP results by reading the whole file."""
+    return cdap_counts(pd.read_csv(filename)).values
+
+
+def chunked_cdap(filename, chunksize):
+    """Aggregate the CDAP results by streaming the needed columns."""
+    return cdap_counts(read_cdap_counts(filename, chunksize=chunksize))\
+        .values
+
+
+def parallel_cdap(filename, workers):
+    """Aggregate the CDAP results in byte ranges counted in parallel."""
+    return cdap_counts(scan(filename, {'CDAP': TARGETS['CDAP']},
+                            workers=workers)['CDAP']).values
+
+
+def benchmark_cdap(filename, chunksize=1000000, workers=None):
+    """Compare full, chunked and parallel aggregation of a personData file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to a personData csv file.
+    chunksize : int, default : 1000000
+        The number of rows to read at a time in chunked mode.
+    workers : int, default : None
+        If more than one, also count the file with this many processes. The
+        peak memory of parallel mode is that of the parent process only.
+
+    Returns
+    -------
+    results : dict
+        Time in seconds and peak memory in bytes for each mode.
+
+    """
+    full, full_time, full_peak = measure(full_cdap, filename)
+    chunked, chunked_time, chunked_peak = measure(
+        chunked_cdap, filename, chunksize)
+    if list(full) != list(chunked):
+        raise ValueError('Chunked counts do not match the full counts.')
+    results = {'full': {'seconds': full_time, 'peak': full_peak},
+               'chunked': {'seconds': chunked_time, 'peak': chunked_peak}}
+    if workers and workers > 1:
+        parallel, seconds, peak = measure(parallel_cdap, filename, workers)
+        if list(full) != list(parallel):
+            raise ValueError('Parallel counts do not match the full counts.')
+        results['parallel'] = {'seconds': seconds, 'peak': peak}
+    return results
+
+
+def build_fixture(directory, rows, seed=0):
+    """Write synthetic outputs, UECs and calibration workbooks.
+
+    Parameters
+    ----------
+    directory : str
+        Path to write the `output`, `uec` and `calibration` directories to.
+    rows : int
+        The number of rows of the aoResults and personData files.
+    seed : int, default : 0
+        Seed of the random number generator.
+
+    """
+    output = osp.join(directory, 'output')
+    os.makedirs(output, exist_ok=True)
+    write_ao_results(osp.join(output, TARGETS['AO'].results()), rows,
+                     seed=seed)
+    write_person_data(osp.join(output, TARGETS['CDAP'].results()), rows,
+                      seed=seed)
+    write_uecs(osp.join(directory, 'uec'))
+    write_calibration_workbooks(osp.join(directory, 'calibration'))
+
+
+def ao_counts(results):
+    """Count the households by auto ownership level."""
+    return results.groupby('AO').size()
+
+
+def load_template(filename):
+    """Parse a calibration workbook and calculate its formulas."""
+    with WorkbookManager().checkout(filename) as calc:
+        return calc
+
+
+def fill_template(calc, step, counts):
+    """Write counts and zero constants into a template and recalculate it."""
+    calc.set_values('_data', step.data, counts.values)
+    calc.set_values(step.sheet, step.inputs,
+                    [0] * len(calc.get_values(step.sheet, step.inputs)))
+    calc.recalculate()
+    return step.columns(calc.get_values(step.sheet, step.outputs))
+
+
+def write_uec(uec_path, step, constants):
+    """Write the new constants of a step to its UEC."""
+    with UECEditor(uec_path) as uec:
+        for (startx, starty, _, axis), values in zip(step.uec_cells,
+                                                     constants):
+            uec.write(startx, starty, values, axis=axis)
+
+
+def sheet_values(filename):
+    """Read the types and values of every cell of every sheet."""
+    book = open_workbook(filename)
+    try:
+        return [[list(sheet.row_types(row)) + sheet.row_values(row)
+                 for row in range(sheet.nrows)] for sheet in book.sheets()]
+    finally:
+        book.release_resources()
+
+
+def benchmark_uec(uec_path, method='AO', rounds=5, seed=0):
+    """Compare writing a UEC's constants in place and with xlutils.
+
+    Both ways write the same random constants into their own copy of the UEC
+    each round, and every cell of the copies has to match afterwards. The
+    first round turns the constants into number cells that can be written in
+    place, so it is not timed.
+
+    Parameters
+    ----------
+    uec_path : str
+        Path to an AutoOwnership or CoordinatedDailyActivityPattern UEC.
+    method : str, 'AO' | 'CDAP'
+        The step the UEC belongs to.
+    rounds : int, default : 5
+        The number of timed writes.
+    seed : int, default : 0
+        Seed of the random number generator.
+
+    Returns
+    -------
+    results : dict
+        The mean time in seconds of a write and the number of bytes that
+        differ from the previous file for each mode.
+
+    Raises
+    ------
+    ValueError
+        If the cells of the copies differ.
+
+    """
+    step = STEPS[method]
+    size = len(uec_constants(uec_path, method)) // len(step.uec_cells)
+    rng = np.random.RandomState(seed)
+    results = {'patch': {'seconds': 0.0, 'changed': 0},
+               'rewrite': {'seconds': 0.0, 'changed': 0}}
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {mode: osp.join(directory, '{}.xls'.format(mode))
+                 for mode in results}
+        for path in paths.values():
+            shutil.copy2(uec_path, path)
+        for round_ in range(rounds + 1):
+            constants = [list(rng.normal(0, 2, size))
+                         for _ in step.uec_cells]
+            for mode, path in paths.items():
+                with open(path, 'rb') as before:
+                    previous = before.read()
+                editor = UECEditor(path, in_place=mode == 'patch')
+                for (startx, starty, _, axis), values in zip(step.uec_cells,
+                                                          constants):
+                    editor.write(startx, starty, values, axis=axis)
+                _, seconds, _ = measure(editor.commit)
+                if round_:
+                    with open(path, 'rb') as after:
+                        current = after.read()
+                    results[mode]['seconds'] += seconds / rounds
+                    results[mode]['changed'] = max(
+                        results[mode]['changed'],
+                        abs(len(current) - len(previous)) + sum(
+                            a != b for a, b in zip(current, previous)))
+            if sheet_values(paths['patch']) != sheet_values(paths['rewrite']):
+                raise ValueError('The UEC written in place differs from the '
+                                 'one written by xlutils.')
+    return results
+
+
+def benchmark_update(directory, method='AO', chunksize=None):
+    """Measure each stage of an update on a fixture.
+
+    Parameters
+    ----------
+    directory : str
+        Path to a directory written by build_fixture.
+    method : str, 'AO' | 'CDAP'
+        The update to measure.
+    chunksize : int, default : None
+        If given, the CDAP results are counted in chunks of this many rows.
+
+    Returns
+    -------
+    stages : dict
+        Time in seconds and peak memory in bytes of each stage, and of the
+        whole update under 'update'.
+
+    """
+    step = STEPS[method]
+    cal_dir = osp.join(directory, 'calibration', step.directory)
+    source = osp.join(directory, 'output', TARGETS[method].results())
+    copy = osp.join(cal_dir, osp.basename(source)[:-len('.csv')] +
+                    '_bench.csv')
+    uec_path = osp.join(directory, 'uec', '{}.xls'.format(step.uec))
+    stages = {}
+
+    def run(stage, func, *args, **kwargs):
+        result, seconds, peak = measure(func, *args, **kwargs)
+        stages[stage] = {'seconds': seconds, 'peak': peak}
+        return result
+
+    run('copy', shutil.copy2, source, copy)
+    if chunksize and method == 'CDAP':
+        results = run('read_csv', read_cdap_counts, copy, chunksize=chunksize)
+    else:
+        results = run('read_csv', pd.read_csv, copy)
+    counts = run('groupby', cdap_counts if method == 'CDAP' else ao_counts,
+                 results)
+    del results
+    calc = run('workbook_load', load_template, osp.join(
+        cal_dir, '{}.xlsx'.format(step.workbook)))
+    constants = run('recalculate', fill_template, calc, step, counts)
+    run('workbook_save', calc.save,
+        osp.join(cal_dir, '{}_bench.xlsx'.format(step.workbook)))
+    run('uec_write', write_uec, uec_path, step, constants)
+    # Without the count cache, so repeated measurements count every time.
+    run('update', update, 0, directory, cal_dir, method=method,
+        chunksize=chunksize, cache=False)
+    return stages
+
+
+def benchmark_suite(rows=(100000,), methods=('AO', 'CDAP'), chunksize=None,
+                    directory=None, seed=0, repeat=1):
+    """Measure the update stages over several output sizes.
+
+    Parameters
+    ----------
+    rows : sequence of int, default : (100000,)
+        The number of rows of the synthetic outputs in each case.
+    methods : sequence of str, default : ('AO', 'CDAP')
+        The updates to measure.
+    chunksize : int, default : None
+        If given, the CDAP results are counted in chunks of this many rows.
+    directory : str, default : None
+        Path to write the fixtures to. A temporary directory is used and
+        removed afterwards if not given.
+    seed : int, default : 0
+        Seed of the random number generator.
+    repeat : int, default : 1
+        The number of times each case is measured. The median time and peak
+        memory of each stage are kept.
+
+    Returns
+    -------
+    results : dict
+        The environment under 'environment' and, under 'cases', the stages
+        measured by benchmark_update keyed by '<method>/<rows>'.
+
+    """
+    cleanup = directory is None
+    directory = directory or tempfile.mkdtemp(prefix='benchmark_')
+    cases = {}
+    try:
+        for count in rows:
+            fixture = osp.join(directory, str(count))
+            build_fixture(fixture, count, seed=seed)
+            for method in methods:
+                runs = [benchmark_update(fixture, method=method,
+                                         chunksize=chunksize)
+                        for _ in range(repeat)]
+                cases['{}/{}'.format(method, count)] = {
+                    stage: {metric: float(np.median([run[stage][metric]
+                                                     for run in runs]))
+                            for metric in ('seconds', 'peak')}
+                    for stage in runs[0]}
+    finally:
+        if cleanup:
+            shutil.rmtree(directory, ignore_errors=True)
+    return {'environment': {'python': sys.version.split()[0],
+                            'pandas': pd.__version__,
+                            'machine': platform.machine()},
+            'chunksize': chunksize, 'repeat': repeat, 'cases': cases}
+
+
+def compare_baseline(results, baseline, tolerance=0.5, min_seconds=0.05,
+                     min_peak=1000000):
+    """Find the stages that got slower or use more memory than a baseline.
+
+    Parameters
+    ----------
+    results : dict
+        The value returned by benchmark_suite.
+    baseline : dict
+        A previous value returned by benchmark_suite.
+    tolerance : float, default : 0.5
+        Allowed relative increase of time and peak memory. Stages of the
+        small cases take tenths of a second, whose times vary by a quarter
+        between runs.
+    min_seconds : float, default : 0.05
+        Times below this many seconds are never flagged.
+    min_peak : int, default : 1000000
+        Peak memory below this many bytes is never flagged.
+
+    Returns
+    -------
+    regressions : list of dict
+        The case, stage, metric, baseline and new value of each regression.
+        Cases and stages missing from the baseline are skipped.
+
+    """
+    floors = {'seconds': min_seconds, 'peak': min_peak}
+    regressions = []
+    for case, stages in sorted(results['cases'].items()):
+        for stage, stats in stages.items():
+            base = baseline['cases'].get(case, {}).get(stage)
+            if base is None:
+                continue
+            for metric, floor in floors.items():
+                if stats[metric] > max(base[metric] * (1 + tolerance), floor):
+                    regressions.append({
+                        'case': case, 'stage': stage, 'metric': metric,
+                        'baseline': base[metric], 'value': stats[metric]})
+    return regressions
+
+
+def print_update_results(results):
+    """Print the time and peak memory of every stage of every case."""
+    for case, stages in sorted(results['cases'].items()):
+        print(case)
+        for stage, stats in stages.items():
+            print('  {:14} {:10.3f} s {:10.1f} MB'.format(
+                stage, stats['seconds'], stats['peak'] / 1e6))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='Benchmark the calibration update.')
+    COMMANDS = PARSER.add_subparsers(dest='command')
+    COMMANDS.required = True
+    CDAP = COMMANDS.add_parser(
+        'cdap', help='Compare full and chunked aggregation of a personData '
+        'file.')
+    CDAP.add_argument(
+        'filename', metavar='Filename', type=str,
+        help='The path to a personData csv file.')
+    CDAP.add_argument(
+        '-c', '--chunksize', metavar='Chunksize', type=int, default=1000000,
+        help='The number of rows to read at a time in chunked mode.')
+    CDAP.add_argument(
+        '-w', '--workers', metavar='Workers', type=int,
+        help='Also count the file in byte ranges with this many processes.')
+    UEC = COMMANDS.add_parser(
+        'uec', help='Compare writing UEC constants in place and with '
+        'xlutils.')
+    UEC.add_argument(
+        'filename', metavar='Filename', type=str, nargs='?',
+        help='The path to a UEC. Defaults to a synthetic one.')
+    UEC.add_argument(
+        '-m', '--method', metavar='Method', type=str, default='AO',
+        choices=['AO', 'CDAP'], help='The step the UEC belongs to.')
+    UEC.add_argument(
+        '-n', '--rounds', metavar='Rounds', type=int, default=5,
+        help='The number of timed writes.')
+    UPDATE = COMMANDS.add_parser(
+        'update', help='Measure the stages of the update on synthetic data.')
+    UPDATE.add_argument(
+        '-r', '--rows', metavar='Rows', type=int, nargs='+',
+        default=[100000, 1000000, 10000000],
+        help='The number of rows of the synthetic outputs in each case.')
+    UPDATE.add_argument(
+        '-m', '--methods', metavar='Methods', nargs='+',
+        choices=['AO', 'CDAP'], default=['AO', 'CDAP'],
+        help='The updates to measure.')
+    UPDATE.add_argument(
+        '-c', '--chunksize', metavar='Chunksize', type=int,
+        help='Count the CDAP results in chunks of this many rows.')
+    UPDATE.add_argument(
+        '-d', '--directory', metavar='Directory', type=str,
+        help='Write the fixtures to this directory and keep them.')
+    UPDATE.add_argument(
+        '-o', '--output', metavar='Output', type=str,
+        help='Write the results to this JSON file.')
+    UPDATE.add_argument(
+        '-n', '--repeat', metavar='Repeat', type=int, default=3,
+        help='Measure each case this many times and keep the medians.')
+    UPDATE.add_argument(
+        '-b', '--baseline', metavar='Baseline', type=str, default=BASELINE,
+        help='Compare the results against this JSON file and exit with an '
+        'error if any stage regressed. Defaults to the reference baseline '
+        'in benchmarks/baseline.json; pass an empty string to skip the '
+        'comparison.')
+    UPDATE.add_argument(
+        '-t', '--tolerance', metavar='Tolerance', type=float, default=0.5,
+        help='Allowed relative increase over the baseline.')
+    ARGS = PARSER.parse_args()
+    if ARGS.command == 'cdap':
+        for mode, stats in benchmark_cdap(ARGS.filename, ARGS.chunksize,
+                                          ARGS.workers).items():
+            print('{:8} {:10.2f} s {:10.1f} MB'.format(
+                mode, stats['seconds'], stats['peak'] / 1e6))
+    elif ARGS.command == 'uec':
+        with tempfile.TemporaryDirectory() as DIRECTORY:
+            FILENAME = ARGS.filename
+            if FILENAME is None:
+                write_uecs(DIRECTORY)
+                FILENAME = osp.join(DIRECTORY, '{}.xls'.format(
+                    STEPS[ARGS.method].uec))
+            for mode, stats in benchmark_uec(FILENAME, ARGS.method,
+                                             ARGS.rounds).items():
+                print('{:8} {:10.4f} s {:10} bytes changed'.format(
+                    mode, stats['seconds'], stats['changed']))
+    else:
+        RESULTS = benchmark_suite(ARGS.rows, ARGS.methods, ARGS.chunksize,
+                                  directory=ARGS.directory,
+                                  repeat=ARGS.repeat)
+        print_update_results(RESULTS)
+        if ARGS.output:
+            with open(ARGS.output, 'w') as output:
+                json.dump(RESULTS, output, indent=2)
+        if ARGS.baseline:
+            with open(ARGS.baseline) as baseline:
+                REGRESSIONS = compare_baseline(
+                    RESULTS, json.load(baseline), tolerance=ARGS.tolerance)
+            for regression in REGRESSIONS:
+                print('Regression in {case} {stage}: {metric} {baseline:.4g} '
+                      '-> {value:.4g}'.format(**regression))
+            if REGRESSIONS:
+                sys.exit(1)
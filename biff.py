@@ -0,0 +1,338 @@
+"""This module writes numbers into existing cells of .xls workbooks in place.
+
+An .xls file is a compound document whose `Workbook` stream holds the BIFF8
+records of the workbook. A number cell is a NUMBER record holding an IEEE
+double, or an RK or MULRK record holding a compressed one, so overwriting the
+value of an existing number cell changes only those bytes of the stream. The
+patcher locates the records of the target cells, copies the file
+byte-for-byte and overwrites the value bytes in the sectors of the copy, so
+the cost of a write does not depend on the size of the workbook.
+
+Anything that can not be written in place (a target cell that is empty,
+holds text or a formula, or an RK value that can not hold the new number, an
+encrypted workbook, or one that is not BIFF8) raises PatchError, and the
+caller falls back to rewriting the whole workbook.
+
+"""
+
+import os
+import shutil
+from struct import pack, unpack, unpack_from
+import tempfile
+
+
+SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+ENDOFCHAIN = 0xFFFFFFFE
+MAXREGSECT = 0xFFFFFFFA
+
+BOF = 0x0809
+EOF = 0x000A
+BOUNDSHEET = 0x0085
+FILEPASS = 0x002F
+NUMBER = 0x0203
+RK = 0x027E
+MULRK = 0x00BD
+CELLS = {0x0006: 'formula', 0x00FD: 'text', 0x0204: 'text', 0x00D6: 'text',
+         0x0201: 'blank', 0x00BE: 'blank', 0x0205: 'boolean or error'}
+
+
+class PatchError(Exception):
+    """The cells can not be written in place."""
+
+
+def encode_rk(value):
+    """Encode a number as an RK value if it can be stored exactly.
+
+    Parameters
+    ----------
+    value : float
+        The number.
+
+    Returns
+    -------
+    rk : int or None
+        The unsigned 32-bit RK value, or None if the number does not survive
+        the round trip.
+
+    """
+    for scale, flag in ((1, 0), (100, 1)):
+        scaled = value * scale
+        if -0x20000000 <= scaled < 0x20000000 and scaled == int(scaled):
+            rk = (int(scaled) << 2 | 2 | flag) & 0xFFFFFFFF
+            if decode_rk(rk) == value:
+                return rk
+        high = unpack('<Q', pack('<d', scaled))[0]
+        if not high & 0x3FFFFFFFF:
+            rk = high >> 32 | flag
+            if decode_rk(rk) == value:
+                return rk
+    return None
+
+
+def decode_rk(rk):
+    """Decode an unsigned 32-bit RK value, as xlrd does."""
+    if rk & 2:
+        value = float(unpack('<i', pack('<I', rk))[0] >> 2)
+    else:
+        value = unpack('<d', pack('<Q', (rk & 0xFFFFFFFC) << 32))[0]
+    return value / 100.0 if rk & 1 else value
+
+
+class CompoundFile():
+    """The sectors of the streams of a compound document.
+
+    Parameters
+    ----------
+    data : bytes
+        The contents of the file.
+
+    """
+
+    def __init__(self, data):
+        if data[:8] != SIGNATURE:
+            raise PatchError('Not a compound document.')
+        self.data = data
+        self.sector_size = 1 << unpack_from('<H', data, 0x1E)[0]
+        self.cutoff = unpack_from('<I', data, 0x38)[0]
+        fat_sectors = self._difat()
+        self.fat = []
+        for sector in fat_sectors:
+            self.fat.extend(unpack_from(
+                '<{}I'.format(self.sector_size // 4), data,
+                self._offset(sector)))
+
+    def _offset(self, sector):
+        offset = (sector + 1) * self.sector_size
+        if sector > MAXREGSECT or offset + self.sector_size > len(self.data):
+            raise PatchError('Sector {} is outside the file.'.format(sector))
+        return offset
+
+    def _difat(self):
+        count, = unpack_from('<I', self.data, 0x2C)
+        sectors = list(unpack_from('<109I', self.data, 0x4C))
+        sector, = unpack_from('<I', self.data, 0x44)
+        per_sector = self.sector_size // 4 - 1
+        while sector <= MAXREGSECT and len(sectors) < count:
+            entries = unpack_from('<{}I'.format(per_sector + 1), self.data,
+                                  self._offset(sector))
+            sectors.extend(entries[:-1])
+            sector = entries[-1]
+        return sectors[:count]
+
+    def chain(self, sector):
+        """The sectors of a stream, from its first sector."""
+        sectors = []
+        while sector != ENDOFCHAIN:
+            if sector >= len(self.fat) or len(sectors) > len(self.fat):
+                raise PatchError('Broken sector chain.')
+            sectors.append(sector)
+            sector = self.fat[sector]
+        return sectors
+
+    def stream(self, name):
+        """Find a stream in the root storage.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stream.
+
+        Returns
+        -------
+        offsets : list of int
+            The file offsets of the sectors of the stream.
+        data : bytes
+            The contents of the stream.
+
+        """
+        directory = b''.join(
+            self.data[offset:offset + self.sector_size]
+            for offset in map(self._offset,
+                              self.chain(unpack_from('<I', self.data,
+                                                     0x30)[0])))
+        for entry in range(0, len(directory), 128):
+            length, kind = unpack_from('<HB', directory, entry + 64)
+            if kind != 2 or length < 2:
+                continue
+            if directory[entry:entry + length - 2].decode('utf-16-le') != \
+                    name:
+                continue
+            start, size = unpack_from('<II', directory, entry + 116)
+            if size < self.cutoff:
+                raise PatchError('The {} stream is in the mini stream.'
+                                 .format(name))
+            offsets = [self._offset(sector) for sector in self.chain(start)]
+            if len(offsets) * self.sector_size < size:
+                raise PatchError('The {} stream is truncated.'.format(name))
+            data = b''.join(self.data[offset:offset + self.sector_size]
+                            for offset in offsets)[:size]
+            return offsets, data
+        raise PatchError('No {} stream.'.format(name))
+
+
+def records(stream, position):
+    """Iterate over the BIFF records of a substream.
+
+    Parameters
+    ----------
+    stream : bytes
+        The workbook stream.
+    position : int
+        Offset of the BOF record of the substream.
+
+    Yields
+    ------
+    record : tuple
+        The type, offset of the data and length of the data of each record,
+        up to and including the EOF record that ends the substream.
+
+    """
+    depth = 0
+    while position + 4 <= len(stream):
+        kind, length = unpack_from('<HH', stream, position)
+        yield kind, position + 4, length
+        # Charts embedded in a worksheet are nested substreams.
+        if kind == BOF:
+            depth += 1
+        elif kind == EOF:
+            depth -= 1
+            if not depth:
+                return
+        position += 4 + length
+    raise PatchError('The substream has no EOF record.')
+
+
+def sheet_positions(stream):
+    """Offsets of the BOF records of the worksheets, in xlrd's sheet order."""
+    kind, version = unpack_from('<HxxH', stream, 0)
+    if kind != BOF or version != 0x0600:
+        raise PatchError('Not a BIFF8 workbook.')
+    positions = []
+    for kind, start, _ in records(stream, 0):
+        if kind == FILEPASS:
+            raise PatchError('The workbook is encrypted.')
+        if kind == BOUNDSHEET:
+            position, sheet_type = unpack_from('<IxB', stream, start)
+            # xlrd only numbers worksheets.
+            if sheet_type == 0:
+                positions.append(position)
+    return positions
+
+
+def locate(stream, position, cells):
+    """Find the value bytes of number cells in a worksheet.
+
+    Parameters
+    ----------
+    stream : bytes
+        The workbook stream.
+    position : int
+        Offset of the BOF record of the worksheet.
+    cells : set of tuple
+        The (row, column) of each cell.
+
+    Returns
+    -------
+    found : dict
+        For each cell, the offset of its value in the stream and whether it
+        is an RK value rather than a double.
+
+    Raises
+    ------
+    PatchError
+        If a cell is not a number cell.
+
+    """
+    found = {}
+    for kind, start, length in records(stream, position):
+        if kind == NUMBER or kind == RK:
+            cell = unpack_from('<HH', stream, start)
+            if cell in cells:
+                found[cell] = (start + 6, kind == RK)
+        elif kind == MULRK:
+            row, first = unpack_from('<HH', stream, start)
+            for idx in range((length - 6) // 6):
+                if (row, first + idx) in cells:
+                    found[row, first + idx] = (start + 6 + 6 * idx, True)
+        elif kind in CELLS and length >= 4:
+            cell = unpack_from('<HH', stream, start)
+            if cell in cells:
+                raise PatchError('Cell {} is a {} cell.'.format(
+                    cell, CELLS[kind]))
+        if len(found) == len(cells):
+            # Every cell is stored once, so the rest need not be scanned.
+            break
+    missing = sorted(set(cells) - set(found))
+    if missing:
+        raise PatchError('Cell {} is empty.'.format(missing[0]))
+    return found
+
+
+def patch_cells(filename, cells, dest=None):
+    """Write numbers into existing number cells of an .xls workbook.
+
+    The workbook is copied byte-for-byte and the values of the cells are
+    overwritten in the copy, which then replaces dest atomically.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the workbook.
+    cells : list of tuple
+        The sheet index, row, column and new value of each cell.
+    dest : str, default : None
+        Path of the patched workbook. Defaults to filename.
+
+    Raises
+    ------
+    PatchError
+        If any cell can not be written in place. Nothing is written then.
+
+    """
+    with open(filename, 'rb') as workbook:
+        document = CompoundFile(workbook.read())
+    offsets, stream = document.stream('Workbook')
+    positions = sheet_positions(stream)
+    wanted = {}
+    for sheet, row, col, value in cells:
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                raise PatchError('{!r} is not a number.'.format(value))
+        wanted.setdefault(sheet, {})[row, col] = float(value)
+    patches = []
+    for sheet, values in sorted(wanted.items()):
+        if sheet >= len(positions):
+            raise PatchError('There is no sheet {}.'.format(sheet))
+        found = locate(stream, positions[sheet], set(values))
+        for cell, value in values.items():
+            start, is_rk = found[cell]
+            if is_rk:
+                rk = encode_rk(value)
+                if rk is None:
+                    raise PatchError('{!r} does not fit the RK cell {}.'
+                                     .format(value, cell))
+                patches.append((start, pack('<I', rk)))
+            else:
+                patches.append((start, pack('<d', value)))
+    dest = dest or filename
+    handle, temp = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(dest)), suffix='.xls')
+    os.close(handle)
+    try:
+        shutil.copyfile(filename, temp)
+        with open(temp, 'r+b') as workbook:
+            for start, data in patches:
+                # A value may straddle two sectors of the stream.
+                while data:
+                    sector, within = divmod(start, document.sector_size)
+                    run = data[:document.sector_size - within]
+                    workbook.seek(offsets[sector] + within)
+                    workbook.write(run)
+                    start, data = start + len(run), data[len(run):]
+        shutil.copymode(filename, temp)
+        os.replace(temp, dest)
+    except BaseException:
+        os.remove(temp)
+        raise
@@ -10,14 +10,23 @@ in sequence.
 
 import argparse
 import os.path as osp
-import subprocess
-from time import sleep, time
+from time import time
 
-import psutil
-from pymouse import PyMouse
-from pykeyboard import PyKeyboard
+from aggregate import TARGETS
+from checkpoint import Checkpoint, CheckpointError
+from convergence import evaluate, log_metrics
+from orchestrator import RunTimeout, orchestrate
+from runner import DEFAULT_RATES, RUNNERS, GuiRunner, kill_proc_tree
+from schedule import SampleSchedule
+from sensitivity import clone
+from telemetry import ProcessSampler, log_summary
+import tracing
+from update import STEPS, update
+from watch import WriterExited, wait_for_output
 
-from update import update
+
+class Cancelled(Exception):
+    """The calibration was cancelled between iterations."""
 
 
 def check_positive(value):
@@ -68,6 +77,32 @@ def check_float(value):
     return value
 
 
+def sheet_range(value):
+    """Split a range of a sheet, e.g. 'AO!C4:C8', into sheet and range.
+
+    Parameters
+    ----------
+    value : str
+        The sheet's title and the range, separated by an exclamation mark.
+
+    Returns
+    -------
+    sheet_range : tuple
+        (sheet, range) of value.
+
+    """
+    sheet, _, ref = value.rpartition('!')
+    if not sheet or not ref:
+        raise argparse.ArgumentTypeError(
+            'Value must be a sheet and a range, e.g. AO!C4:C8.')
+    return sheet, ref
+
+
+def output_key(step, member):
+    """The checkpoint key of the result file of an ensemble member."""
+    return step if not member else '{}@{}'.format(step, member)
+
+
 PARSER = argparse.ArgumentParser(
     description='Execute calibration of Auto Ownership and Coordinated Daily '
     'Activity Pattern steps.')
@@ -92,80 +127,115 @@ PARSER.add_argument(
     '-op', '--output_path', metavar='Output_Path', type=str,
     default='../Model Calibration', help='The relative path to the directory '
     'containing the calibration directories.')
-ARGS = PARSER.parse_args()
-
-FILES = {'AO': ['AutoOwnership', 'aoResults.csv', '1_AO'],
-         'CDAP': ['CoordinatedDailyActivityPattern', 'personData_{}.csv',
-                  '2_CDAP']}
-
-
-def kill_proc_tree(pid, including_parent=True):
-    """Kill a process and all of its children.
-
-    Parameters
-    ----------
-    pid : int
-        The process id of the process to kill all children from.
-    including_parent : bool
-        Boolean representing wether to also kill the parent process.
-
-    """
-    parent = psutil.Process(pid)
-    children = parent.children(recursive=True)
-    for child in children:
-        child.kill()
-    _, _ = psutil.wait_procs(children, timeout=5)
-    if including_parent:
-        parent.kill()
-        parent.wait(5)
-
-
-def launch_transcad():
-    """Startup TransCAD and set to fullscreen.
-
-    Returns
-    -------
-    proc : subprocess.Popen
-        Process where TransCAD is running.
-
-    """
-    board = PyKeyboard()
-    proc = subprocess.Popen([r'C:/Program Files/TransCAD 6.0\Tcw.exe'])
-    sleep(15)
-    board.tap_key(board.alt_key)
-    board.tap_key(board.space_key)
-    board.tap_key('x')
-    return proc
+PARSER.add_argument(
+    '-cs', '--chunksize', metavar='Chunksize', type=check_positive,
+    help='Count the CDAP results in chunks of this many rows instead of '
+    'reading the whole person file.')
+PARSER.add_argument(
+    '-e', '--engine', metavar='Engine', type=str, default='python',
+    choices=['python', 'excel'], help='The engine used to execute the '
+    'calibration workbook formulas.')
+PARSER.add_argument(
+    '-qp', '--quiet_period', metavar='Quiet_Period', type=float, default=60,
+    help='The number of seconds a result file must stay unchanged before it '
+    'is considered complete.')
+PARSER.add_argument(
+    '-pi', '--poll_interval', metavar='Poll_Interval', type=float, default=5,
+    help='The longest time in seconds between checks of the result file.')
+PARSER.add_argument(
+    '-st', '--share_tol', metavar='Share_Tolerance', type=float,
+    default=0.01, help='The largest difference between modeled and target '
+    'shares in any segment for a step to be considered converged.')
+PARSER.add_argument(
+    '-ct', '--const_tol', metavar='Constant_Tolerance', type=float,
+    default=0.05, help='The largest change of any constant for a step to be '
+    'considered converged.')
+PARSER.add_argument(
+    '-tr', '--target_ranges', metavar=('Step', 'Labels', 'Targets'), nargs=3,
+    action='append', help='The ranges of the segment labels and target '
+    'shares of a step\'s calibration workbook, e.g. AO _data!A2:A6 '
+    'AO!C4:C8. Convergence is not checked for steps without them.')
+PARSER.add_argument(
+    '-j', '--joint', action='store_true',
+    help='Calibrate AO and CDAP together, updating both from each model run.')
+PARSER.add_argument(
+    '-r', '--runner', metavar='Runner', type=str, default='gui',
+    choices=sorted(RUNNERS), help='The backend used to run the model: gui '
+    'drives TransCAD, batch runs --command and local writes synthetic '
+    'outputs.')
+PARSER.add_argument(
+    '-c', '--command', metavar='Command', type=str,
+    help='Command line template for the batch runner, with fields '
+    '{working_directory}, {start_iter}, {sample_rates}, {write_db} and '
+    '{seed}.')
+PARSER.add_argument(
+    '-rows', '--rows', metavar='Rows', type=check_positive, default=100000,
+    help='The number of persons written by the local runner.')
+PARSER.add_argument(
+    '-db', '--write_db', action='store_true',
+    help='Have the model write its results to the database.')
+PARSER.add_argument(
+    '-a', '--archive', metavar='Archive', type=str, default='parquet',
+    choices=['parquet', 'csv'], help='Keep each iteration\'s results as '
+    'compressed Parquet, counted while converting, which requires pyarrow, '
+    'or as a csv copy.')
+PARSER.add_argument(
+    '-ad', '--adaptive', metavar='Adaptive_Rates', type=str, nargs='?',
+    const='0.1,0.25,0.5,1.0', help='Start each step at a low sample rate and '
+    'move through these comma separated rates as the share gap approaches '
+    'the sampling error. Defaults to 0.1,0.25,0.5,1.0 when given without '
+    'rates.')
+PARSER.add_argument(
+    '-rs', '--resume', action='store_true',
+    help='Continue the calibration recorded in checkpoint.json in the output '
+    'path where it stopped.')
+PARSER.add_argument(
+    '-ti', '--telemetry_interval', metavar='Telemetry_Interval', type=float,
+    default=5, help='The number of seconds between samples of the CPU, '
+    'memory, I/O and threads of the model processes, or 0 to not sample.')
+PARSER.add_argument(
+    '-tf', '--trace_file', metavar='Trace_File', type=str,
+    help='The path of the JSON-lines file the duration of each stage is '
+    'appended to. Defaults to trace.jsonl in the output path.')
+PARSER.add_argument(
+    '-rt', '--run_timeout', metavar='Run_Timeout', type=float,
+    help='The number of seconds after launch by which the model has to '
+    'complete its result files before the calibration stops.')
+PARSER.add_argument(
+    '-ac', '--accelerate', action='store_true',
+    help='Accelerate the constants with Broyden\'s method over all earlier '
+    'iterations instead of following the workbook alone.')
+PARSER.add_argument(
+    '-w', '--workers', metavar='Workers', type=check_positive,
+    help='Count csv archives in byte ranges with this many processes.')
+PARSER.add_argument(
+    '-en', '--ensemble', metavar='Ensemble', type=check_positive, default=1,
+    help='Run this many copies of the model with different seeds side by '
+    'side and update from their averaged counts.')
+PARSER.add_argument(
+    '-ep', '--ensemble_path', metavar='Ensemble_Path', type=str,
+    help='The directory to keep the copies of the working directory in. '
+    'Defaults to the working directory followed by _ensemble.')
 
 
-def compile_abm(working_directory):
-    """Compile the sandag_abm.
+def print_timings(step, timings):
+    """Print the time spent on each kind of workbook operation in an update.
 
     Parameters
     ----------
-    working_directory : str
-        The path to the directory containing the gisdk and uec directories.
+    step : str
+        The calibration step.
+    timings : list of dict
+        The workbook timings returned by update.update.
 
     """
-    mouse = PyMouse()
-    board = PyKeyboard()
-    xdim, ydim = mouse.screen_size()
-    mouse.click(int(round(xdim * 0.55595)), int(round(ydim * 0.04952)))
-    sleep(2)
-    board.type_string('sandag_abm.lst')
-    sleep(2)
-    board.tap_key(board.tab_key, n=4)
-    sleep(2)
-    board.tap_key(board.enter_key)
-    sleep(2)
-    board.type_string(working_directory + '/gisdk')
-    sleep(2)
-    board.tap_key(board.enter_key)
-    sleep(2)
-    board.tap_key(board.tab_key, n=8)
-    sleep(2)
-    board.tap_key(board.enter_key)
-    sleep(2)
+    totals = {}
+    for timing in timings:
+        totals[timing['operation']] = totals.get(timing['operation'], 0) + \
+            timing['seconds']
+    print('{} workbook time: {}'.format(step, ', '.join(
+        '{} {:.2f} s'.format(operation, seconds)
+        for operation, seconds in sorted(totals.items())) or 'none'))
 
 
 def check_rate(start_iter, sample_rate):
@@ -186,7 +256,7 @@ def check_rate(start_iter, sample_rate):
         using defaults.
 
     """
-    rates = ['0.2', '0.5', '1.0']
+    rates = list(DEFAULT_RATES)
     sample_rates = None
     if sample_rate:
         if isinstance(sample_rate, float):
@@ -199,94 +269,296 @@ def check_rate(start_iter, sample_rate):
     return sample_rates
 
 
-def set_abm_params(start_iter, sample_rates):
-    """Set the parameters for the sandag_abm.
+def schedule_rates(start_iter, rate):
+    """Run every iteration from start_iter on at a schedule's sample rate.
 
     Parameters
     ----------
     start_iter : int
         The iteration to start the process from.
-    sample_rates : str or None
-        The sample rates for the abm in string form.
+    rate : float
+        The sample rate of the schedule.
+
+    Returns
+    -------
+    sample_rates : str
+        The values of the sample rates in a comma separated string.
 
     """
-    mouse = PyMouse()
-    board = PyKeyboard()
-    xdim, ydim = mouse.screen_size()
-    mouse.click(int(round(xdim * 0.57083)), int(round(ydim * 0.04952)))
-    sleep(2)
-    board.press_keys([board.alt_key, 'd'])
-    board.press_keys([board.alt_key, 'n'])
-    board.type_string('Setup Scenario')
-    board.tap_key(board.enter_key)
-    sleep(2)
-    board.tap_key(board.space_key)
-    sleep(5)
-    # Set database write to 'No'
-    board.tap_key(board.tab_key, n=22)
-    board.tap_key(board.space_key)
-    if start_iter == 1:
-        board.tap_key(board.tab_key, n=7)
-    else:
-        board.tap_key(board.tab_key, n=2 + start_iter)
-        board.tap_key(board.space_key)
-        board.tap_key(board.tab_key, n=5 - start_iter)
-    if sample_rates:
-        board.tap_key(board.backspace_key)
-        board.type_string(sample_rates)
-    board.tap_key(board.tab_key)
-    board.tap_key(board.space_key)
-    sleep(1)
+    rates = DEFAULT_RATES[:start_iter - 1]
+    rates += [str(rate)] * (len(DEFAULT_RATES) - len(rates))
+    return ','.join(rates)
 
 
-def setup_abm(working_directory, start_iter=1, sample_rate=None):
-    """Setup the sandag_abm with given parameters.
+class ModelRuns():
+    """Run the model for an iteration and update the steps from its results.
+
+    Every copy of the model is launched, the result files are watched
+    concurrently and each step is updated as soon as its files are complete,
+    see orchestrator.py. Each stage is recorded in the checkpoint.
 
     Parameters
     ----------
     working_directory : str
-        The path to the directory containing the gisdk and uec directories.
+        The path to the directory containing the gisdk and uec directories,
+        which the other copies are cloned from.
+    members : list of tuple
+        (working directory, input path, runner.Runner) of each copy of the
+        model, the first being the one in working_directory.
+    checkpoint : checkpoint.Checkpoint
+        The record of the calibration.
+    output_path : str
+        The path to the directory containing the calibration directories.
     start_iter : int, default : 1
-        The iteration to start the process from.
-    sample_rate : float or str, default : None
-        The sample rate for the given starting iteration, or a string
-        representing all of the sample rates.
+        The iteration to start the model from.
+    write_db : bool, default : False
+        Whether the first copy should write its results to the database.
+    quiet_period, poll_interval, run_timeout, telemetry_interval
+        See calibrate.
+    share_tol, const_tol
+        See convergence.evaluate.
+    target_ranges : dict, default : None
+        See calibrate.
+    progress : callable, default : None
+        See calibrate.
+    **options
+        Keyword arguments of update.update shared by every update, e.g.
+        chunksize, engine, archive, workers and accelerate.
 
     """
-    sample_rates = check_rate(start_iter, sample_rate)
-    compile_abm(working_directory)
-    set_abm_params(start_iter, sample_rates)
 
-
-def launch_abm(working_directory):
-    """Launch the sandag_abm.
-
-    Parameters
-    ----------
-    working_directory : str
-        The path to the directory containing the gisdk and uec directories.
-
-    """
-    board = PyKeyboard()
-    board.tap_key(board.down_key)
-    board.tap_key(board.space_key)
-    sleep(2)
-    board.tap_key(board.tab_key, n=3)
-    board.tap_key(board.enter_key)
-    board.type_string(working_directory)
-    sleep(4)
-    board.tap_key(board.enter_key)
-    sleep(2)
-    board.tap_key(board.tab_key, n=6)
-    board.tap_key(board.backspace_key)
-    board.tap_key(board.tab_key)
-    board.tap_key(board.enter_key)
+    def __init__(self, working_directory, members, checkpoint, output_path,
+                 start_iter=1, write_db=False, quiet_period=60,
+                 poll_interval=5, run_timeout=None, telemetry_interval=5,
+                 share_tol=0.01, const_tol=0.05, target_ranges=None,
+                 progress=None, **options):
+        self.working_directory = working_directory
+        self.members = members
+        self.checkpoint = checkpoint
+        self.output_path = output_path
+        self.start_iter = start_iter
+        self.write_db = write_db
+        self.quiet_period = quiet_period
+        self.poll_interval = poll_interval
+        self.run_timeout = run_timeout
+        self.telemetry_interval = telemetry_interval
+        self.share_tol = share_tol
+        self.const_tol = const_tol
+        self.target_ranges = target_ranges or {}
+        self.progress = progress
+        self.options = options
+        self.iteration = 0
+        self.start_time = None
+        self.procs = []
+        self.samplers = []
+
+    def cal_path(self, step):
+        """The directory of a step's calibration files."""
+        return self.output_path + '/{}'.format(STEPS[step].directory)
+
+    def result_file(self, step, member):
+        """The path of a step's result file written by a copy."""
+        return self.members[member][1] + '/output/' + \
+            TARGETS[step].results(self.start_iter)
+
+    def update(self, step, iteration):
+        """Update a step from the results of the copies.
+
+        The new constants are recorded in the checkpoint before they are
+        written to the UEC, see checkpoint.Checkpoint.record_write.
+
+        Returns
+        -------
+        result : dict
+            The value returned by update.update.
+
+        """
+        sources = None
+        if iteration and len(self.members) > 1:
+            sources = [self.result_file(step, member)
+                       for member in range(len(self.members))]
+        def before_write(uec_path, constants):
+            self.checkpoint.record_write(step, iteration, uec_path,
+                                         constants)
+
+        return update(iteration, self.members[0][1], self.cal_path(step),
+                      method=step, start_iter=self.start_iter,
+                      sources=sources, before_write=before_write,
+                      **self.options)
+
+    def report(self, step, iteration, result, schedule=None, full=True):
+        """Evaluate an update and record it in the log and checkpoint.
+
+        Parameters
+        ----------
+        step : str
+            The calibration step.
+        iteration : int
+            The calibration iteration number.
+        result : dict
+            The value returned by update.update.
+        schedule : schedule.SampleSchedule, default : None
+            The sample rate schedule the run followed, if any.
+        full : bool, default : True
+            Whether the run was at the schedule's highest rate. A step only
+            converges on such a run.
+
+        Returns
+        -------
+        metrics : dict
+            The value returned by convergence.evaluate, with the schedule's
+            decision under 'converged'.
+
+        """
+        metrics = evaluate(step, result, share_tol=self.share_tol,
+                           const_tol=self.const_tol,
+                           ranges=self.target_ranges.get(step))
+        if iteration and schedule:
+            metrics['sample_rate'] = schedule.rate
+            metrics['converged'] = metrics['converged'] and full
+        if iteration and self.options.get('accelerate'):
+            metrics['rule'] = result['method']
+        if iteration:
+            print_timings(step, result['timings'])
+        log_metrics(self.cal_path(step), iteration, metrics)
+        self.checkpoint.record_update(step, iteration, result, metrics,
+                                      metrics['converged'])
+        if self.progress:
+            self.progress(step, iteration, metrics)
+        if iteration:
+            print('Completed Step {} iteration {}.\n'.format(
+                STEPS[step].uec, iteration))
+        return metrics
+
+    def launch(self, group, sample_rates):
+        """Start every copy of the model and sample its resource use."""
+        self.start_time = time()
+        self.checkpoint.record_launch(group, self.iteration, self.start_time,
+                                      sample_rates)
+        label = '{}_{}'.format('_'.join(group), self.iteration)
+        for member, (directory, _, runner) in enumerate(self.members):
+            if member:
+                with tracing.span('clone', path=directory):
+                    clone(self.working_directory, directory)
+            proc = runner.launch(
+                directory, start_iter=self.start_iter,
+                sample_rates=sample_rates,
+                write_db=self.write_db and not member, seed=member)
+            self.procs.append(proc)
+            if self.telemetry_interval:
+                name = label if not member else \
+                    '{}_m{}'.format(label, member)
+                sampler = ProcessSampler(
+                    proc.pid, self.output_path + '/telemetry_{}.csv'.format(
+                        name), interval=self.telemetry_interval)
+                self.samplers.append((name, sampler))
+                sampler.start()
+
+    def wait(self, step, timeout):
+        """Wait for the result files of a step, see orchestrator.py."""
+        deadline = None if timeout is None else time() + timeout
+        statuses = []
+        # The copies run side by side, so they share the timeout.
+        for member, proc in enumerate(self.procs):
+            with tracing.span('model_run', step=step, member=member,
+                              path=self.result_file(step, member)) as fields:
+                status = wait_for_output(
+                    self.result_file(step, member), self.start_time,
+                    quiet_period=self.quiet_period,
+                    poll_interval=self.poll_interval,
+                    timeout=None if deadline is None else
+                    max(deadline - time(), 0),
+                    exited=lambda: proc.poll() is not None)
+                fields['bytes'] = status.st_size
+            statuses.append(status)
+        return statuses
+
+    def record_output(self, step, statuses):
+        """Record the completed result files of a step in the checkpoint."""
+        for member, status in enumerate(statuses):
+            self.checkpoint.record_output(output_key(step, member),
+                                          self.result_file(step, member),
+                                          status)
+
+    def process(self, step):
+        """Update a step from the results of the running iteration."""
+        return self.update(step, self.iteration)
+
+    def teardown(self):
+        """Stop the samplers and the model."""
+        for name, sampler in self.samplers:
+            sampler.stop()
+            log_summary(self.output_path + '/telemetry.jsonl', name,
+                        sampler.summary())
+        with tracing.span('teardown', members=len(self.procs)):
+            for proc in self.procs:
+                kill_proc_tree(proc.pid, including_parent=True)
+
+    def run(self, group, active, iteration, sample_rates):
+        """Run the model for an iteration and update the active steps.
+
+        The model is not launched again if a resumed run already completed
+        the result files of every active step.
+
+        Parameters
+        ----------
+        group : list of str
+            The steps calibrated from the same model runs.
+        active : list of str
+            The steps to update from this iteration's run.
+        iteration : int
+            The calibration iteration number.
+        sample_rates : str or None
+            The sample rates of the run, see check_rate.
+
+        Returns
+        -------
+        results : dict
+            The value returned by update.update for each active step.
+
+        """
+        self.iteration = iteration
+        self.procs, self.samplers = [], []
+        if not all(self.checkpoint.completed_output(
+                group, iteration, output_key(step, member))
+                for step in active for member in range(len(self.members))):
+            try:
+                self.launch(group, sample_rates)
+            except BaseException:
+                # Without this, the copies launched so far would keep
+                # running, and being sampled, after the error.
+                self.teardown()
+                raise
+        return orchestrate(
+            active, self.wait if self.procs else None, self.process,
+            on_output=self.record_output,
+            teardown=self.teardown if self.procs else None,
+            timeout=self.run_timeout)
 
 
 def calibrate(working_directory, start_iter=1, sample_rate=None, max_iters=3,
-              input_path='.', output_path='../Model Calibration'):
+              input_path='.', output_path='../Model Calibration',
+              chunksize=None, engine='python', quiet_period=60,
+              poll_interval=5, share_tol=0.01, const_tol=0.05, joint=False,
+              runner=None, write_db=False, trace_file=None,
+              archive='parquet', adaptive=None, resume=False,
+              telemetry_interval=5, run_timeout=None, workers=None,
+              accelerate=False, ensemble=1, ensemble_path=None,
+              steps=('AO', 'CDAP'), target_ranges=None, progress=None,
+              cancel=None):
     """Calibrate abm with given parameters.
 
+    The result files of a run are watched concurrently and each step is
+    updated as soon as its file is complete while the model keeps running for
+    the other steps, see orchestrator.py. The model is torn down as soon as
+    its last result file lands.
+
+    An ensemble runs copies of the model side by side, each in its own copy
+    of the working directory and with its own seed, and updates each step
+    from the mean of their counts. The variance of the counts across the
+    copies gives the standard error of the modeled shares, which the sample
+    rate schedule uses in place of its binomial estimate, see convergence.py.
+
     Parameters
     ----------
     working_directory : str
@@ -303,32 +575,217 @@ def calibrate(working_directory, start_iter=1, sample_rate=None, max_iters=3,
     output_path : str, default : '../Model Calibration'
         The relative path to the directory containing the calibration
         directories.
+    chunksize : int, default : None
+        If given, the CDAP results are counted in chunks of this many rows.
+    engine : str, default : 'python'
+        The engine used to execute the calibration workbook formulas, either
+        'python' or 'excel'.
+    quiet_period : float, default : 60
+        The number of seconds a result file must stay unchanged after the
+        model rewrites it before it is considered complete.
+    poll_interval : float, default : 5
+        The longest time in seconds between checks of the result file.
+    share_tol : float, default : 0.01
+        The largest difference between modeled and target shares in any
+        segment for a step to be considered converged.
+    const_tol : float, default : 0.05
+        The largest change of any constant for a step to be considered
+        converged. Each step stops early once both tolerances are met.
+    joint : bool, default : False
+        If True, both steps are calibrated from the same model runs: each
+        run's aoResults and personData files are processed concurrently as
+        they appear, and both UECs are updated before the next launch.
+    runner : runner.Runner, default : None
+        The backend used to run the model. Defaults to driving the TransCAD
+        interface with runner.GuiRunner.
+    write_db : bool, default : False
+        Whether the model should write its results to the database.
+    trace_file : str, default : None
+        The path of the JSON-lines file the duration of each stage is
+        appended to, see tracing.py. Defaults to trace.jsonl in output_path.
+    archive : str, default : 'parquet'
+        How each iteration's results are kept with the calibration files,
+        either 'parquet' or 'csv'. See update.update.
+    adaptive : list of float, default : None
+        If given, the sample rate of start_iter follows a
+        schedule.SampleSchedule through these rates instead of sample_rate,
+        and a step only converges on a run at the highest rate.
+    resume : bool, default : False
+        If True, continue the run recorded in checkpoint.json in output_path
+        at its first incomplete stage, after checking the UECs and
+        calibrated workbooks against it. Otherwise a new checkpoint is
+        started.
+    telemetry_interval : float, default : 5
+        The number of seconds between samples of the resource use of the
+        model's process tree, written to telemetry_<steps>_<iteration>.csv
+        in output_path and summarized in telemetry.jsonl. 0 disables it.
+    run_timeout : float, default : None
+        If given, the number of seconds after launch by which the model has
+        to complete the result files of the steps it runs for. The
+        calibration also stops if the model exits without writing them.
+    workers : int, default : None
+        If more than one, csv archives are counted by this many processes.
+    accelerate : bool, default : False
+        If True, the constants of each update are accelerated with
+        Broyden's method over all earlier iterations of the step instead of
+        following the workbook alone, see accelerate.py.
+    ensemble : int, default : 1
+        The number of copies of the model run for each iteration. The first
+        runs in working_directory, and only it writes to the database; the
+        others run in copies of working_directory, which must hold the
+        uec and output directories at input_path, with their seed offset by
+        their number. Requires a runner that can run copies, see
+        runner.Runner.for_directory.
+    ensemble_path : str, default : None
+        The directory the copies are kept in, and reused from. Defaults to
+        the working directory's path followed by `_ensemble`.
+    steps : sequence of str, default : ('AO', 'CDAP')
+        The steps to calibrate, in order.
+    target_ranges : dict, default : None
+        For each step, the (sheet, range) of the segment labels and of the
+        target shares in its calibration workbook, in place of those of
+        update.STEPS. Steps without them, or whose targets do not match the
+        counted segments, are not checked for convergence and run for
+        max_iters iterations.
+    progress : callable, default : None
+        progress(step, iteration, metrics) is called after each update with
+        the metrics returned by convergence.evaluate.
+    cancel : threading.Event, default : None
+        If given, the calibration stops before the next iteration once the
+        event is set.
+
+    Raises
+    ------
+    Cancelled
+        If cancel was set.
 
     """
-    steps = ['AO', 'CDAP']
-    for step in steps:
-        cal_path = output_path + '/{}'.format(FILES[step][2])
-        update(0, input_path, cal_path, method=step)
-        for iter_ in range(max_iters):
-            proc = launch_transcad()
-            setup_abm(working_directory, start_iter=start_iter,
-                      sample_rate=sample_rate)
-            launch_abm(working_directory)
-            start_time = time()
-            sleep(18000)
-            result_file = input_path + '/output/' + FILES[step][1]\
-                .format(start_iter)
-            last_mod = osp.getmtime(result_file)
-            while last_mod < start_time:
-                sleep(1800)
-                last_mod = osp.getmtime(result_file)
-            kill_proc_tree(proc.pid, including_parent=True)
-            update(iter_ + 1, input_path, cal_path, method=step)
-            print('Completed Step {} iteration {}.\n'
-                  .format(FILES[step][0], iter_ + 1))
+    tracing.configure(trace_file or output_path + '/trace.jsonl')
+    if runner is None:
+        runner = GuiRunner()
+    sample_rates = check_rate(start_iter, sample_rate)
+    steps = [step for step in STEPS if step in steps]
+    groups = [steps] if joint else [[step] for step in steps]
+    params = {'start_iter': start_iter, 'joint': joint, 'adaptive': adaptive,
+              'accelerate': accelerate, 'ensemble': ensemble}
+    # The working directory and input path of each copy, and its runner
+    members = [(working_directory, input_path, runner)]
+    if ensemble > 1:
+        ensemble_path = ensemble_path or \
+            osp.abspath(working_directory) + '_ensemble'
+        for member in range(1, ensemble):
+            directory = osp.join(ensemble_path, str(member))
+            members.append((directory, directory,
+                            runner.for_directory(directory)))
+    checkpoint_path = output_path + '/checkpoint.json'
+    if resume:
+        checkpoint = Checkpoint.load(checkpoint_path)
+        checkpoint.validate(params)
+        for step in checkpoint.rollback():
+            print('Redoing the interrupted update of {}.'.format(step))
+    else:
+        checkpoint = Checkpoint(checkpoint_path, params)
+        checkpoint.save()
+    runs = ModelRuns(
+        working_directory, members, checkpoint, output_path,
+        start_iter=start_iter, write_db=write_db, quiet_period=quiet_period,
+        poll_interval=poll_interval, run_timeout=run_timeout,
+        telemetry_interval=telemetry_interval, share_tol=share_tol,
+        const_tol=const_tol, target_ranges=target_ranges,
+        progress=progress, chunksize=chunksize,
+        engine=engine, archive=archive, workers=workers,
+        accelerate=accelerate)
+    for group in groups:
+        metrics = {}
+        converged = {}
+        schedule = SampleSchedule(adaptive) if adaptive else None
+        if schedule:
+            checkpoint.restore_schedule(group, schedule)
+        for step in group:
+            record = checkpoint.steps.get(step)
+            if record:
+                metrics[step] = record['metrics']
+                converged[step] = record['converged']
+                continue
+            metrics[step] = runs.report(step, 0, runs.update(step, 0))
+            converged[step] = metrics[step]['converged']
+        for iter_ in range(checkpoint.iterations(group), max_iters):
+            remaining = [step for step in group if not converged[step]]
+            if not remaining:
+                break
+            if cancel is not None and cancel.is_set():
+                raise Cancelled('Cancelled before iteration {} of {}.'.format(
+                    iter_ + 1, ', '.join(group)))
+            # Steps already updated from this iteration's run before a resume
+            active = [step for step in remaining
+                      if checkpoint.steps[step]['iteration'] <= iter_]
+            full = True
+            if schedule:
+                sample_rates = schedule_rates(start_iter, schedule.rate)
+                full = schedule.full
+            with tracing.span('iteration', steps=active, iteration=iter_ + 1,
+                              sample_rates=sample_rates):
+                results = runs.run(group, active, iter_ + 1, sample_rates)
+                for step in active:
+                    metrics[step] = runs.report(step, iter_ + 1,
+                                                results[step], schedule,
+                                                full)
+                    converged[step] = metrics[step]['converged']
+                if schedule:
+                    rate = schedule.rate
+                    schedule.record([metrics[step] for step in remaining])
+                    last = schedule.history[-1]
+                    if schedule.rate != rate and last['max_gap'] is None:
+                        print('Sample rate {} -> {} (share gap not '
+                              'checked).\n'.format(rate, schedule.rate))
+                    elif schedule.rate != rate:
+                        print('Sample rate {} -> {} (share gap {:.4f}, '
+                              'sampling error {:.4f}).\n'.format(
+                                  rate, schedule.rate, last['max_gap'],
+                                  last['noise']))
+                checkpoint.record_iteration(group, iter_ + 1, schedule)
 
 
 if __name__ == '__main__':
-    calibrate(ARGS.working_directory, start_iter=ARGS.start_iter,
-              sample_rate=ARGS.sample_rate, max_iters=ARGS.max_iters,
-              input_path=ARGS.input_path, output_path=ARGS.output_path)
+    ARGS = PARSER.parse_args()
+    if ARGS.runner == 'batch':
+        if not ARGS.command:
+            PARSER.error('The batch runner requires --command.')
+        RUNNER = RUNNERS['batch'](ARGS.command)
+    elif ARGS.runner == 'local':
+        RUNNER = RUNNERS['local'](ARGS.input_path, rows=ARGS.rows)
+    else:
+        RUNNER = RUNNERS['gui']()
+    if ARGS.adaptive and ARGS.sample_rate:
+        PARSER.error('--adaptive and --sample_rate can not be combined.')
+    if ARGS.ensemble > 1 and ARGS.runner == 'gui':
+        PARSER.error('--ensemble requires the batch or local runner.')
+    TARGET_RANGES = {}
+    for STEP, LABELS, CELLS in ARGS.target_ranges or []:
+        if STEP not in STEPS:
+            PARSER.error('--target_ranges: unknown step {}.'.format(STEP))
+        try:
+            TARGET_RANGES[STEP] = (sheet_range(LABELS), sheet_range(CELLS))
+        except argparse.ArgumentTypeError as exc:
+            PARSER.error('--target_ranges: {}'.format(exc))
+    try:
+        calibrate(ARGS.working_directory, start_iter=ARGS.start_iter,
+                  sample_rate=ARGS.sample_rate, max_iters=ARGS.max_iters,
+                  input_path=ARGS.input_path, output_path=ARGS.output_path,
+                  chunksize=ARGS.chunksize, engine=ARGS.engine,
+                  quiet_period=ARGS.quiet_period,
+                  poll_interval=ARGS.poll_interval, share_tol=ARGS.share_tol,
+                  const_tol=ARGS.const_tol, joint=ARGS.joint, runner=RUNNER,
+                  write_db=ARGS.write_db, trace_file=ARGS.trace_file,
+                  archive=ARGS.archive, adaptive=ARGS.adaptive and [
+                      float(rate) for rate in ARGS.adaptive.split(',')],
+                  resume=ARGS.resume,
+                  telemetry_interval=ARGS.telemetry_interval,
+                  run_timeout=ARGS.run_timeout, workers=ARGS.workers,
+                  accelerate=ARGS.accelerate, ensemble=ARGS.ensemble,
+                  ensemble_path=ARGS.ensemble_path,
+                  target_ranges=TARGET_RANGES)
+    except CheckpointError as exc:
+        PARSER.exit(1, 'Can not resume: {}\n'.format(exc))
+    except (RunTimeout, WriterExited) as exc:
+        PARSER.exit(1, 'Model run failed: {}\n'.format(exc))
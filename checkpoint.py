@@ -0,0 +1,346 @@
+"""This module keeps the progress of a calibration run on disk.
+
+The checkpoint is a JSON file in the calibration directory, replaced
+atomically after every stage: the model launch of an iteration, each result
+file the run completes, and each update with the constants it wrote, the
+calibrated workbook, the archived results and the convergence metrics. A run
+started with `--resume` checks the UECs and workbooks against the checkpoint
+and continues at the first stage that did not complete, so finished model
+runs are not repeated and constants are never seeded from the UEC again.
+
+An update writes its constants to the UEC before the update is recorded, so
+the new constants are recorded as a pending write first. If the run stops
+between the two, the UEC may hold either set: resuming accepts both, puts the
+recorded constants back and redoes the update.
+
+"""
+
+import json
+import math
+import os
+import os.path as osp
+import tempfile
+import threading
+
+from update import uec_constants, workbook_constants, write_uec_constants
+
+
+class CheckpointError(Exception):
+    """The files of a calibration do not match its checkpoint."""
+
+
+def _same(values, expected, rel_tol=1e-9, abs_tol=1e-12):
+    """Check that two lists of constants are equal up to rounding."""
+    return len(values) == len(expected) and all(
+        math.isclose(value or 0, other or 0, rel_tol=rel_tol,
+                     abs_tol=abs_tol)
+        for value, other in zip(values, expected))
+
+
+class Checkpoint():
+    """Progress of a calibration run.
+
+    Parameters
+    ----------
+    path : str
+        Path of the checkpoint file.
+    params : dict, default : None
+        The calibration settings that have to match when resuming.
+
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, params=None):
+        self.path = path
+        self.state = {'version': self.VERSION, 'params': params or {},
+                      'steps': {}, 'groups': {}, 'pending': None,
+                      'writes': {}}
+        # Joint steps record their writes and outputs from several threads.
+        self.lock = threading.RLock()
+
+    @classmethod
+    def load(cls, path):
+        """Read a checkpoint file.
+
+        Parameters
+        ----------
+        path : str
+            Path of the checkpoint file.
+
+        Returns
+        -------
+        checkpoint : Checkpoint
+            The checkpoint.
+
+        """
+        checkpoint = cls(path)
+        try:
+            with open(path) as state:
+                checkpoint.state = json.load(state)
+        except (OSError, ValueError) as exc:
+            raise CheckpointError(
+                'Can not read checkpoint {}: {}'.format(path, exc))
+        if checkpoint.state.get('version') != cls.VERSION:
+            raise CheckpointError('Unsupported checkpoint version.')
+        return checkpoint
+
+    def save(self):
+        """Replace the checkpoint file with the current state."""
+        handle, temp = tempfile.mkstemp(
+            dir=osp.dirname(osp.abspath(self.path)), suffix='.json')
+        try:
+            with os.fdopen(handle, 'w') as state, self.lock:
+                json.dump(self.state, state, indent=1, default=float)
+                state.flush()
+                os.fsync(state.fileno())
+                os.replace(temp, self.path)
+        except BaseException:
+            if osp.exists(temp):
+                os.remove(temp)
+            raise
+
+    @property
+    def steps(self):
+        """The last completed update of each step."""
+        return self.state['steps']
+
+    def iterations(self, group):
+        """The number of model runs completed for a group of steps."""
+        return self.state['groups'].get('+'.join(group), 0)
+
+    @property
+    def writes(self):
+        """The UEC writes of the updates that were not recorded yet."""
+        return self.state.setdefault('writes', {})
+
+    def record_write(self, step, iter_, uec_path, constants):
+        """Record the constants an update is about to write to its UEC.
+
+        The constants the UEC holds are kept with them, so the write can be
+        undone if the update is not recorded.
+
+        Parameters
+        ----------
+        step : str
+            The calibration step.
+        iter_ : int
+            The calibration iteration number.
+        uec_path : str
+            Path to the uec file.
+        constants : list
+            The new constants, ordered as returned by update.uec_constants.
+
+        """
+        previous = uec_constants(uec_path, step)
+        with self.lock:
+            self.writes[step] = {'iteration': iter_, 'uec': uec_path,
+                                 'constants': list(constants),
+                                 'previous': previous}
+            self.save()
+
+    def record_update(self, step, iter_, result, metrics, converged):
+        """Record a completed update.
+
+        Parameters
+        ----------
+        step : str
+            The calibration step.
+        iter_ : int
+            The calibration iteration number.
+        result : dict
+            The value returned by update.update.
+        metrics : dict
+            The value returned by convergence.evaluate.
+        converged : bool
+            Whether the step is done.
+
+        """
+        with self.lock:
+            self.steps[step] = {
+                'iteration': iter_, 'before': list(result['before']),
+                'constants': list(result['after']),
+                'proposed': list(result.get('proposed', result['after'])),
+                'uec': result['uec_path'], 'workbook': result['cal_path'],
+                'archive': result['archive_path'],
+                'metrics': json.loads(json.dumps(metrics, default=float)),
+                'converged': converged}
+            self.writes.pop(step, None)
+            self.save()
+
+    def record_launch(self, group, iter_, start_time, sample_rates):
+        """Record the launch of a model run.
+
+        Parameters
+        ----------
+        group : list of str
+            The steps calibrated from the run.
+        iter_ : int
+            The calibration iteration the run is for.
+        start_time : float
+            Time the model was launched, as returned by time.time.
+        sample_rates : str or None
+            The sample rates of the run.
+
+        """
+        self.state['pending'] = {'group': '+'.join(group), 'iteration': iter_,
+                                 'start_time': start_time,
+                                 'sample_rates': sample_rates, 'outputs': {}}
+        self.save()
+
+    def record_output(self, step, filename, status):
+        """Record a result file the pending run completed.
+
+        Parameters
+        ----------
+        step : str
+            The calibration step the file is for.
+        filename : str
+            Path to the result file.
+        status : os.stat_result
+            The status of the complete file.
+
+        """
+        with self.lock:
+            self.state['pending']['outputs'][step] = {
+                'path': filename, 'size': status.st_size,
+                'mtime_ns': status.st_mtime_ns}
+            self.save()
+
+    def record_iteration(self, group, iter_, schedule=None):
+        """Record that all updates of a model run are done.
+
+        Parameters
+        ----------
+        group : list of str
+            The steps calibrated from the run.
+        iter_ : int
+            The calibration iteration of the run.
+        schedule : schedule.SampleSchedule, default : None
+            The sample rate schedule, if adaptive.
+
+        """
+        key = '+'.join(group)
+        self.state['groups'][key] = iter_
+        if schedule is not None:
+            self.state.setdefault('schedules', {})[key] = {
+                'level': schedule.level, 'history': schedule.history}
+        self.state['pending'] = None
+        self.save()
+
+    def restore_schedule(self, group, schedule):
+        """Restore the rate and history of a sample rate schedule."""
+        saved = self.state.get('schedules', {}).get('+'.join(group))
+        if saved:
+            schedule.level = saved['level']
+            schedule.history = saved['history']
+
+    def completed_output(self, group, iter_, step):
+        """Check if the pending run completed the result file of a step.
+
+        Parameters
+        ----------
+        group : list of str
+            The steps calibrated from the run.
+        iter_ : int
+            The calibration iteration of the run.
+        step : str
+            The calibration step.
+
+        Returns
+        -------
+        status : os.stat_result or None
+            The status of the result file if the pending run completed it
+            and it has not changed since, otherwise None.
+
+        """
+        pending = self.state['pending']
+        if not pending or pending['group'] != '+'.join(group) or \
+                pending['iteration'] != iter_:
+            return None
+        output = pending['outputs'].get(step)
+        if output is None:
+            return None
+        try:
+            status = os.stat(output['path'])
+        except OSError:
+            return None
+        if status.st_size != output['size'] or \
+                status.st_mtime_ns != output['mtime_ns']:
+            return None
+        return status
+
+    def validate(self, params):
+        """Check the calibration files against the checkpoint.
+
+        The settings have to match, and for every step the UEC has to hold
+        the constants of its last update, whose calibrated workbook and
+        archived results have to exist, the workbook with the constants it
+        proposed. A step with a pending write may instead hold the constants
+        of that write, see rollback.
+
+        Parameters
+        ----------
+        params : dict
+            The calibration settings of the resumed run.
+
+        Raises
+        ------
+        CheckpointError
+            If anything does not match.
+
+        """
+        for name, value in self.state['params'].items():
+            if params.get(name) != value:
+                raise CheckpointError(
+                    'The checkpoint was written with {}={!r}, not {!r}.'
+                    .format(name, value, params.get(name)))
+        for step, write in sorted(self.writes.items()):
+            constants = uec_constants(write['uec'], step)
+            if not (_same(constants, write['previous']) or
+                    _same(constants, write['constants'])):
+                raise CheckpointError(
+                    'The {} constants in {} differ from the checkpoint; it '
+                    'was changed during iteration {}.'.format(
+                        step, write['uec'], write['iteration']))
+        for step, record in sorted(self.steps.items()):
+            for key in ('uec', 'workbook', 'archive'):
+                if not osp.exists(record[key]):
+                    raise CheckpointError(
+                        'The {} {} of iteration {} is missing.'.format(
+                            step, key, record['iteration']))
+            write = self.writes.get(step)
+            # A pending write was checked above, against the constants the
+            # UEC held before it.
+            constants = write['previous'] if write else \
+                uec_constants(record['uec'], step)
+            if not _same(constants, record['constants']):
+                raise CheckpointError(
+                    'The {} constants in {} differ from the checkpoint; it '
+                    'was changed after iteration {}.'.format(
+                        step, record['uec'], record['iteration']))
+            if not _same(workbook_constants(record['workbook'], step),
+                         record.get('proposed', record['constants'])):
+                raise CheckpointError(
+                    'The constants of {} differ from the checkpoint.'.format(
+                        record['workbook']))
+
+    def rollback(self):
+        """Undo the UEC writes of the updates that were not recorded.
+
+        The constants each UEC held before the write are put back, so the
+        update is redone from the same constants when the run continues.
+
+        Returns
+        -------
+        steps : list of str
+            The steps whose writes were undone.
+
+        """
+        steps = sorted(self.writes)
+        for step in steps:
+            write = self.writes[step]
+            write_uec_constants(write['uec'], write['previous'], step)
+        self.writes.clear()
+        self.save()
+        return steps
@@ -0,0 +1,172 @@
+"""This module decides when a calibration step has converged.
+
+After each update the modeled shares of every segment (the whole population
+for auto ownership, each person type for CDAP) are compared with the target
+shares of the calibration workbook, read from the same workbook rows as the
+segment labels so the two can not be paired up in a different order. A step
+is converged once every segment's largest share gap and every constant change
+are within tolerance. When the counts are the mean of an ensemble of runs,
+the standard error of each modeled share is estimated from the variance of
+its count across runs.
+
+The calibration workbooks do not keep their targets in a fixed place, so the
+ranges of the labels and targets are given for each step, see update.Step and
+calibrate's --target_ranges. Without them, or when they do not match the
+counted segments, a warning is issued and the share gaps are not checked: the
+step then runs for all its iterations.
+
+"""
+
+import json
+import math
+import os.path as osp
+from time import time
+import warnings
+
+from update import workbook_targets
+
+
+def _segments(method, result, ranges=None):
+    """Pair the modeled counts of each segment with the workbook's targets.
+
+    Parameters
+    ----------
+    method : str, 'AO' | 'CDAP'
+        The calibration step.
+    result : dict
+        The value returned by update.update.
+    ranges : tuple, default : None
+        The (sheet, range) of the labels and of the targets, see
+        update.workbook_targets.
+
+    Returns
+    -------
+    segments : dict
+        For each segment, a mapping of alternative to (count, target).
+
+    Raises
+    ------
+    ValueError
+        If no ranges are given, or the segments or alternatives of the
+        workbook's targets are not the ones counted.
+    KeyError
+        If the workbook has no sheet of a range.
+
+    """
+    counts = result['counts']
+    targets = workbook_targets(result['cal_path'], method, *(ranges or ()))
+    if method == 'AO':
+        counted = {'AO': {str(alt): count for alt, count in counts.items()}}
+    else:
+        counted = {person_type: dict(counts[person_type].items())
+                   for person_type in set(counts.index.get_level_values(0))}
+    if sorted(counted) != sorted(name for name, _ in targets):
+        raise ValueError('The segments of {} ({}) are not the ones counted '
+                         '({}).'.format(result['cal_path'], ', '.join(
+                             name for name, _ in targets),
+                             ', '.join(sorted(counted))))
+    segments = {}
+    for name, shares in targets:
+        extra = set(counted[name]) - {alt for alt, target in shares.items()
+                                      if target is not None}
+        if extra:
+            raise ValueError('{} has no targets for {} of {}.'.format(
+                result['cal_path'], ', '.join(sorted(map(str, extra))),
+                name))
+        segments[name] = {alt: (counted[name].get(alt, 0), target or 0)
+                          for alt, target in shares.items()}
+    return segments
+
+
+def _variances(method, result):
+    """Group the variances of the counts of an ensemble by segment."""
+    variance = result['variance']
+    if method == 'AO':
+        return {'AO': {str(alt): var for alt, var in variance.items()}}
+    return {person_type: dict(variance[person_type].items())
+            for person_type in set(variance.index.get_level_values(0))}
+
+
+def evaluate(method, result, share_tol=0.01, const_tol=0.05, ranges=None):
+    """Measure how close a calibration step is to its targets.
+
+    Parameters
+    ----------
+    method : str, 'AO' | 'CDAP'
+        The calibration step.
+    result : dict
+        The value returned by update.update.
+    share_tol : float, default : 0.01
+        Largest allowed absolute difference between modeled and target share
+        in any segment.
+    const_tol : float, default : 0.05
+        Largest allowed change of any constant.
+    ranges : tuple, default : None
+        The (sheet, range) of the labels and of the targets in the
+        calibration workbook. Defaults to the step's, see update.Step.
+
+    Returns
+    -------
+    metrics : dict
+        The count, modeled and target shares and the share gap of each
+        segment, the constant changes, and whether the step has converged.
+        For an ensemble, each segment also holds the standard error of each
+        modeled share under 'errors'. If the targets can not be read, there
+        are no segments, 'max_gap' is None and the step has not converged.
+
+    """
+    variances = _variances(method, result) if 'variance' in result else {}
+    try:
+        paired = _segments(method, result, ranges)
+    except (KeyError, ValueError) as exc:
+        warnings.warn('Not checking the convergence of {}: {}'.format(
+            method, exc), stacklevel=2)
+        paired = {}
+    segments = {}
+    for name, alternatives in paired.items():
+        total = sum(count for count, _ in alternatives.values())
+        shares = {alt: count / total if total else 0
+                  for alt, (count, _) in alternatives.items()}
+        targets = {alt: target for alt, (_, target) in alternatives.items()}
+        segments[name] = {
+            'total': total, 'shares': shares, 'targets': targets,
+            'gap': max(abs(targets[alt] - shares[alt]) for alt in shares)}
+        if name in variances:
+            # The counts are means of the runs, with variance var / members.
+            members = result.get('members', 1)
+            segments[name]['errors'] = {
+                alt: math.sqrt(variances[name].get(alt, 0) / members) / total
+                if total else 0 for alt in shares}
+    changes = [abs(after - before)
+               for before, after in zip(result['before'], result['after'])]
+    max_gap = max((segment['gap'] for segment in segments.values()),
+                  default=None)
+    max_change = max(changes)
+    return {'method': method, 'segments': segments, 'changes': changes,
+            'max_gap': max_gap, 'max_change': max_change,
+            'converged': max_gap is not None and max_gap <= share_tol and
+            max_change <= const_tol}
+
+
+def log_metrics(cal_path, iter_, metrics):
+    """Append the metrics of an iteration to the step's convergence log.
+
+    Parameters
+    ----------
+    cal_path : str
+        The path to the directory containing the step's calibration files.
+    iter_ : int
+        The calibration iteration number.
+    metrics : dict
+        The value returned by evaluate.
+
+    """
+    record = dict(metrics, iteration=iter_, time=time())
+    with open(osp.join(cal_path, 'convergence.jsonl'), 'a') as log:
+        log.write(json.dumps(record, default=float) + '\n')
+    gap = 'not checked' if metrics['max_gap'] is None else \
+        '{:.4f}'.format(metrics['max_gap'])
+    print('{} iteration {}: max share gap {}, max constant change '
+          '{:.4f}{}'.format(metrics['method'], iter_, gap,
+                            metrics['max_change'],
+                            ', converged' if metrics['converged'] else ''))
@@ -0,0 +1,564 @@
+"""This module runs calibrations from a shared job queue.
+
+A calibration is bound to the working directory of its model, so a machine
+runs one scenario's calibration at a time. The job queue is a SQLite
+database of calibration jobs, each naming a scenario's working directory,
+the steps to calibrate, the iteration budget and any other options of
+calibrate.calibrate. Worker agents, one per model server, claim the oldest
+queued job, copy the scenario and its calibration files into a working copy
+of their own, calibrate the copy and report the metrics of each update and
+the final constants back to the queue. Throughput grows with the number of
+workers attached to the queue.
+
+A worker that stops sending heartbeats, e.g. because its server went down,
+has its job put back in the queue, and a worker that claims the job again
+resumes it from the checkpoint of its working copy if it has one. The queue
+must be on a file system with working file locks for workers on several
+servers; the local runner stands in for the model to try it on one machine.
+
+    python jobqueue.py QUEUE submit SCENARIO -cp CALIBRATION_PATH -mi 5
+    python jobqueue.py QUEUE work WORK_PATH -r batch -c COMMAND
+    python jobqueue.py QUEUE status
+
+"""
+
+import argparse
+import json
+import os
+import os.path as osp
+import shutil
+import socket
+import sqlite3
+import threading
+from time import sleep, time
+
+from aggregate import TARGETS
+from calibrate import Cancelled, calibrate
+from checkpoint import Checkpoint
+from runner import RUNNERS
+from sensitivity import clone
+
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    scenario TEXT NOT NULL,
+    calibration_path TEXT NOT NULL,
+    steps TEXT NOT NULL,
+    max_iters INTEGER NOT NULL,
+    options TEXT NOT NULL,
+    state TEXT NOT NULL,
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    submitted REAL NOT NULL,
+    heartbeat REAL,
+    finished REAL,
+    progress TEXT,
+    result TEXT,
+    error TEXT)'''
+
+COLUMNS = ['id', 'scenario', 'calibration_path', 'steps', 'max_iters',
+           'options', 'state', 'worker', 'attempts', 'submitted', 'heartbeat',
+           'finished', 'progress', 'result', 'error']
+JSON_COLUMNS = ['steps', 'options', 'progress', 'result']
+
+
+class JobQueue():
+    """A queue of calibration jobs in a SQLite database.
+
+    Each call opens its own connection, so a queue can be shared by the
+    threads of a worker and by several processes.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the database. It is created if it does not exist.
+    timeout : float, default : 30
+        The number of seconds to wait for another process's lock.
+
+    """
+
+    def __init__(self, filename, timeout=30):
+        self.filename = filename
+        self.timeout = timeout
+        with self._connect() as db:
+            db.execute(SCHEMA)
+
+    def _connect(self):
+        db = sqlite3.connect(self.filename, timeout=self.timeout,
+                             isolation_level=None)
+        return _Transaction(db)
+
+    def submit(self, scenario, calibration_path, steps=('AO', 'CDAP'),
+               max_iters=3, **options):
+        """Add a calibration job to the queue.
+
+        Parameters
+        ----------
+        scenario : str
+            Path to the scenario's working directory, containing the uec
+            directory.
+        calibration_path : str
+            Path to the directory containing the calibration directories.
+        steps : sequence of str, default : ('AO', 'CDAP')
+            The steps to calibrate.
+        max_iters : int, default : 3
+            The maximum number of iterations of each step.
+        **options
+            Other keyword arguments of calibrate.calibrate, e.g. start_iter,
+            sample_rate, joint or share_tol.
+
+        Returns
+        -------
+        job_id : int
+            The id of the job.
+
+        """
+        with self._connect() as db:
+            return db.execute(
+                'INSERT INTO jobs (scenario, calibration_path, steps, '
+                'max_iters, options, state, submitted) VALUES '
+                '(?, ?, ?, ?, ?, ?, ?)',
+                (osp.abspath(scenario), osp.abspath(calibration_path),
+                 json.dumps(list(steps)), max_iters, json.dumps(options),
+                 'queued', time())).lastrowid
+
+    def claim(self, worker):
+        """Claim the oldest queued job.
+
+        Parameters
+        ----------
+        worker : str
+            The name of the claiming worker.
+
+        Returns
+        -------
+        job : dict or None
+            The job, or None if no job is queued.
+
+        """
+        with self._connect() as db:
+            # Take the write lock before reading so no two workers claim the
+            # same job.
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute(
+                'SELECT id FROM jobs WHERE state = ? ORDER BY id LIMIT 1',
+                ('queued',)).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                'UPDATE jobs SET state = ?, worker = ?, heartbeat = ?, '
+                'attempts = attempts + 1, error = NULL WHERE id = ?',
+                ('running', worker, time(), row[0]))
+        return self.job(row[0])
+
+    def heartbeat(self, job_id, worker, progress=None):
+        """Report that a worker is still running a job.
+
+        Parameters
+        ----------
+        job_id : int
+            The id of the job.
+        worker : str
+            The name of the worker.
+        progress : dict, default : None
+            If given, replaces the job's progress.
+
+        Returns
+        -------
+        running : bool
+            False if the job is no longer the worker's, e.g. because it was
+            requeued after missing its heartbeats.
+
+        """
+        with self._connect() as db:
+            if progress is None:
+                cursor = db.execute(
+                    'UPDATE jobs SET heartbeat = ? WHERE id = ? AND '
+                    'worker = ? AND state = ?',
+                    (time(), job_id, worker, 'running'))
+            else:
+                cursor = db.execute(
+                    'UPDATE jobs SET heartbeat = ?, progress = ? WHERE '
+                    'id = ? AND worker = ? AND state = ?',
+                    (time(), json.dumps(progress, default=float), job_id,
+                     worker, 'running'))
+            return cursor.rowcount == 1
+
+    def finish(self, job_id, worker, result=None, error=None):
+        """Record the outcome of a job.
+
+        Parameters
+        ----------
+        job_id : int
+            The id of the job.
+        worker : str
+            The name of the worker.
+        result : dict, default : None
+            The result of a completed job.
+        error : str, default : None
+            The error of a failed job.
+
+        """
+        with self._connect() as db:
+            db.execute(
+                'UPDATE jobs SET state = ?, finished = ?, result = ?, '
+                'error = ? WHERE id = ? AND worker = ? AND state = ?',
+                ('failed' if error is not None else 'done', time(),
+                 json.dumps(result, default=float), error, job_id, worker,
+                 'running'))
+
+    def requeue_stale(self, max_age):
+        """Put the running jobs that missed their heartbeats back in the queue.
+
+        Parameters
+        ----------
+        max_age : float
+            The number of seconds since the last heartbeat after which a
+            job's worker is presumed dead.
+
+        Returns
+        -------
+        count : int
+            The number of jobs requeued.
+
+        """
+        with self._connect() as db:
+            return db.execute(
+                'UPDATE jobs SET state = ?, worker = NULL WHERE state = ? '
+                'AND heartbeat < ?',
+                ('queued', 'running', time() - max_age)).rowcount
+
+    def job(self, job_id):
+        """The job with the given id, or None."""
+        jobs = self.jobs(job_id=job_id)
+        return jobs[0] if jobs else None
+
+    def jobs(self, state=None, job_id=None):
+        """The jobs of the queue, oldest first.
+
+        Parameters
+        ----------
+        state : str, default : None
+            If given, only the jobs in this state: 'queued', 'running',
+            'done' or 'failed'.
+        job_id : int, default : None
+            If given, only the job with this id.
+
+        Returns
+        -------
+        jobs : list of dict
+            Each job's columns, with steps, options, progress and result
+            decoded.
+
+        """
+        query, args = 'SELECT {} FROM jobs'.format(', '.join(COLUMNS)), []
+        conditions = []
+        if state is not None:
+            conditions.append('state = ?')
+            args.append(state)
+        if job_id is not None:
+            conditions.append('id = ?')
+            args.append(job_id)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        with self._connect() as db:
+            rows = db.execute(query + ' ORDER BY id', args).fetchall()
+        jobs = []
+        for row in rows:
+            job = dict(zip(COLUMNS, row))
+            for column in JSON_COLUMNS:
+                if job[column] is not None:
+                    job[column] = json.loads(job[column])
+            jobs.append(job)
+        return jobs
+
+
+class _Transaction():
+    """Commit or roll back a connection's transaction and close it."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if self.db.in_transaction:
+                self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
+        finally:
+            self.db.close()
+
+
+class Worker():
+    """Claim calibration jobs from a queue and run them.
+
+    Parameters
+    ----------
+    queue : JobQueue
+        The queue to claim jobs from.
+    work_path : str
+        The directory the working copies of the jobs are kept in, one
+        directory per job id.
+    make_runner : callable
+        make_runner(directory) returns the runner.Runner for a working copy.
+    name : str, default : None
+        The name the worker reports. Defaults to the host name and process
+        id.
+    heartbeat_interval : float, default : 30
+        The number of seconds between heartbeats while a job runs.
+    stale_after : float, default : None
+        If given, the running jobs whose last heartbeat is older than this
+        many seconds are requeued before each claim, see
+        JobQueue.requeue_stale.
+
+    """
+
+    def __init__(self, queue, work_path, make_runner, name=None,
+                 heartbeat_interval=30, stale_after=None):
+        self.queue = queue
+        self.work_path = work_path
+        self.make_runner = make_runner
+        self.name = name or '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+
+    def prepare(self, job):
+        """Copy the scenario and calibration files of a job.
+
+        The copy holds the scenario's results of the job's steps, which the
+        first update counts, but no other outputs. An existing copy is
+        reused, so a requeued job can resume.
+
+        Returns
+        -------
+        directory : str
+            The working copy.
+        output_path : str
+            The copy of the calibration files, in the working copy.
+        resume : bool
+            Whether the copy holds the checkpoint of an earlier attempt.
+
+        """
+        directory = osp.join(self.work_path, 'job_{}'.format(job['id']))
+        output_path = osp.join(directory, 'calibration')
+        resume = osp.exists(osp.join(output_path, 'checkpoint.json'))
+        if not resume:
+            clone(job['scenario'], directory)
+            for step in job['steps']:
+                source = osp.join(
+                    job['scenario'], 'output', TARGETS[step].results(
+                        job['options'].get('start_iter', 1)))
+                if osp.exists(source):
+                    shutil.copy2(source, osp.join(directory, 'output'))
+            shutil.copytree(job['calibration_path'], output_path,
+                            dirs_exist_ok=True)
+        return directory, output_path, resume
+
+    def run(self, job):
+        """Calibrate a claimed job and report its outcome.
+
+        A job that is taken away from the worker while it runs is abandoned
+        before the next iteration, without reporting an outcome.
+
+        Returns
+        -------
+        result : dict or None
+            The final constants, metrics and convergence of each step and
+            the paths of the working copy, or None if the job failed or was
+            abandoned.
+
+        """
+        progress = {}
+        stopped = threading.Event()
+        # Set once the job is no longer this worker's, e.g. after it was
+        # requeued for missing its heartbeats, so calibrate stops early.
+        lost = threading.Event()
+
+        def beat():
+            while not stopped.wait(self.heartbeat_interval):
+                if not self.queue.heartbeat(job['id'], self.name):
+                    lost.set()
+
+        def report(step, iteration, metrics):
+            progress[step] = {'iteration': iteration,
+                              'max_gap': metrics['max_gap'],
+                              'max_change': metrics['max_change'],
+                              'converged': metrics['converged']}
+            if not self.queue.heartbeat(job['id'], self.name, progress):
+                lost.set()
+
+        beater = threading.Thread(target=beat, daemon=True)
+        beater.start()
+        try:
+            directory, output_path, resume = self.prepare(job)
+            calibrate(directory, max_iters=job['max_iters'],
+                      input_path=directory, output_path=output_path,
+                      runner=self.make_runner(directory), resume=resume,
+                      steps=job['steps'], progress=report, cancel=lost,
+                      **job['options'])
+            steps = Checkpoint.load(
+                osp.join(output_path, 'checkpoint.json')).steps
+            result = {'working_directory': directory,
+                      'output_path': output_path,
+                      'steps': {step: {
+                          'iteration': record['iteration'],
+                          'constants': record['constants'],
+                          'converged': record['converged'],
+                          'metrics': record['metrics']}
+                          for step, record in steps.items()}}
+        except Cancelled:
+            print('{} abandoned job {}: it is no longer assigned to this '
+                  'worker.'.format(self.name, job['id']))
+            return None
+        except Exception as exc:
+            self.queue.finish(job['id'], self.name,
+                              error='{}: {}'.format(type(exc).__name__, exc))
+            return None
+        finally:
+            stopped.set()
+            beater.join()
+        self.queue.finish(job['id'], self.name, result=result)
+        return result
+
+    def work(self, poll_interval=10, once=False):
+        """Claim and run jobs until the queue is empty or forever.
+
+        Parameters
+        ----------
+        poll_interval : float, default : 10
+            The number of seconds to wait before looking for a job again when
+            none is queued.
+        once : bool, default : False
+            Whether to return once no job is queued instead of waiting.
+
+        Returns
+        -------
+        count : int
+            The number of jobs run.
+
+        """
+        count = 0
+        while True:
+            if self.stale_after:
+                self.queue.requeue_stale(self.stale_after)
+            job = self.queue.claim(self.name)
+            if job is None:
+                if once:
+                    return count
+                sleep(poll_interval)
+                continue
+            print('{} claimed job {}: {}'.format(self.name, job['id'],
+                                                 job['scenario']))
+            self.run(job)
+            count += 1
+
+
+def print_jobs(jobs):
+    """Print one line per job with its state and progress."""
+    for job in jobs:
+        progress = ', '.join(
+            '{} iteration {} gap {}{}'.format(
+                step, state['iteration'], 'not checked'
+                if state['max_gap'] is None else
+                '{:.4f}'.format(state['max_gap']),
+                ' converged' if state['converged'] else '')
+            for step, state in sorted((job['progress'] or {}).items()))
+        print('{:>4} {:<8} {} {}{}'.format(
+            job['id'], job['state'], job['scenario'],
+            job['worker'] or '-', ': ' + progress if progress else ''))
+        if job['error']:
+            print('     ' + job['error'])
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='Queue calibration jobs and run them on workers.')
+    PARSER.add_argument(
+        'queue', metavar='Queue', type=str,
+        help='The path to the SQLite database of the queue.')
+    COMMANDS = PARSER.add_subparsers(dest='action')
+    COMMANDS.required = True
+    SUBMIT = COMMANDS.add_parser('submit', help='Queue a calibration job.')
+    SUBMIT.add_argument(
+        'scenario', metavar='Scenario', type=str,
+        help='The path to the scenario\'s working directory.')
+    SUBMIT.add_argument(
+        '-cp', '--calibration_path', metavar='Calibration_Path', type=str,
+        required=True, help='The path to the directory containing the '
+        'calibration directories.')
+    SUBMIT.add_argument(
+        '-s', '--steps', metavar='Steps', type=str, nargs='+',
+        default=['AO', 'CDAP'], choices=['AO', 'CDAP'],
+        help='The steps to calibrate.')
+    SUBMIT.add_argument(
+        '-mi', '--max_iters', metavar='Max_Iters', type=int, default=3,
+        help='The maximum number of iterations of each step.')
+    SUBMIT.add_argument(
+        '-o', '--options', metavar='Options', type=json.loads, default={},
+        help='Other arguments of calibrate.calibrate as a JSON object, e.g. '
+        '\'{"start_iter": 3, "joint": true}\'.')
+    WORK = COMMANDS.add_parser('work', help='Run queued jobs.')
+    WORK.add_argument(
+        'work_path', metavar='Work_Path', type=str,
+        help='The directory to keep the working copies of the jobs in.')
+    WORK.add_argument(
+        '-r', '--runner', metavar='Runner', type=str, default='batch',
+        choices=['batch', 'local'], help='The backend used to run the model '
+        'in each working copy.')
+    WORK.add_argument(
+        '-c', '--command', metavar='Command', type=str,
+        help='Command line template for the batch runner, see calibrate.py.')
+    WORK.add_argument(
+        '-rows', '--rows', metavar='Rows', type=int, default=100000,
+        help='The number of persons written by the local runner.')
+    WORK.add_argument(
+        '-n', '--name', metavar='Name', type=str,
+        help='The name the worker reports.')
+    WORK.add_argument(
+        '-pi', '--poll_interval', metavar='Poll_Interval', type=float,
+        default=10, help='The number of seconds between looks for a job.')
+    WORK.add_argument(
+        '-sa', '--stale_after', metavar='Stale_After', type=float,
+        help='Requeue the jobs whose last heartbeat is older than this many '
+        'seconds before each claim.')
+    WORK.add_argument(
+        '-once', '--once', action='store_true',
+        help='Stop once no job is queued.')
+    STATUS = COMMANDS.add_parser('status', help='List the jobs.')
+    STATUS.add_argument(
+        '-st', '--state', metavar='State', type=str,
+        choices=['queued', 'running', 'done', 'failed'],
+        help='Only list the jobs in this state.')
+    REQUEUE = COMMANDS.add_parser(
+        'requeue', help='Queue the running jobs that missed their '
+        'heartbeats again.')
+    REQUEUE.add_argument(
+        '-ma', '--max_age', metavar='Max_Age', type=float, default=300,
+        help='The number of seconds since the last heartbeat after which a '
+        'worker is presumed dead.')
+    ARGS = PARSER.parse_args()
+    QUEUE = JobQueue(ARGS.queue)
+    if ARGS.action == 'submit':
+        print('Queued job {}.'.format(QUEUE.submit(
+            ARGS.scenario, ARGS.calibration_path, steps=ARGS.steps,
+            max_iters=ARGS.max_iters, **ARGS.options)))
+    elif ARGS.action == 'work':
+        if ARGS.runner == 'batch':
+            if not ARGS.command:
+                PARSER.error('The batch runner requires --command.')
+            RUNNER = RUNNERS['batch'](ARGS.command)
+
+            def MAKE_RUNNER(directory):
+                return RUNNER
+        else:
+            def MAKE_RUNNER(directory):
+                return RUNNERS['local'](directory, rows=ARGS.rows)
+        WORKER = Worker(QUEUE, ARGS.work_path, MAKE_RUNNER, name=ARGS.name,
+                        stale_after=ARGS.stale_after)
+        print('Ran {} jobs.'.format(WORKER.work(
+            poll_interval=ARGS.poll_interval, once=ARGS.once)))
+    elif ARGS.action == 'requeue':
+        print('Requeued {} jobs.'.format(QUEUE.requeue_stale(ARGS.max_age)))
+    else:
+        print_jobs(QUEUE.jobs(state=ARGS.state))
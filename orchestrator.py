@@ -0,0 +1,109 @@
+"""This module overlaps the stages of a calibration iteration with asyncio.
+
+While the model runs, the result file of every step is watched at the same
+time, and each file is archived, counted and used to update its step's UEC
+as soon as it is complete, e.g. aoResults is processed while the model is
+still computing CDAP. The model is torn down the moment the last result file
+it is needed for lands, concurrently with the updates still running, and an
+optional timeout stops a run that does not finish. The blocking work (the
+file watchers, updates and teardown) runs on worker threads, so the event
+loop only coordinates them.
+
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+
+class RunTimeout(TimeoutError):
+    """The model did not write its result files in time."""
+
+
+def orchestrate(steps, wait, process, on_output=None, teardown=None,
+                timeout=None):
+    """Watch and process the result files of a model run concurrently.
+
+    Parameters
+    ----------
+    steps : list of str
+        The calibration steps updated from the run.
+    wait : callable or None
+        wait(step, timeout) blocks until the result file of step is complete
+        and returns its os.stat_result; it should give up after timeout
+        seconds if that is not None. If None, the result files are already
+        complete.
+    process : callable
+        process(step) updates step from its result file and returns the
+        result.
+    on_output : callable, default : None
+        on_output(step, status) is called in the calling thread as soon as
+        the result file of step is complete.
+    teardown : callable, default : None
+        Stops the model. Called once, as soon as every result file is
+        complete or the run fails.
+    timeout : float, default : None
+        The number of seconds the model may take to complete every result
+        file.
+
+    Returns
+    -------
+    results : dict
+        The value returned by process for each step.
+
+    Raises
+    ------
+    RunTimeout
+        If the result files are not complete within timeout seconds.
+
+    """
+    return asyncio.run(_orchestrate(steps, wait, process, on_output,
+                                    teardown, timeout))
+
+
+def _nothing():
+    pass
+
+
+async def _orchestrate(steps, wait, process, on_output, teardown, timeout):
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else time() + timeout
+    pending = set(steps)
+    stopping = []
+
+    def stop():
+        if not stopping:
+            stopping.append(loop.run_in_executor(pool, teardown or _nothing))
+        return stopping[0]
+
+    async def watch(step):
+        if wait is not None:
+            remaining = None if deadline is None else \
+                max(deadline - time(), 0)
+            try:
+                status = await asyncio.wait_for(
+                    loop.run_in_executor(pool, wait, step, remaining),
+                    remaining)
+            except (asyncio.TimeoutError, TimeoutError):
+                raise RunTimeout('The model did not complete the {} results '
+                                 'within {} seconds.'.format(step, timeout))
+            if on_output is not None:
+                on_output(step, status)
+        pending.discard(step)
+        if not pending:
+            # The model is no longer needed; stop it alongside the updates.
+            stop()
+        return await loop.run_in_executor(pool, process, step)
+
+    # One thread per watcher and update, and one for the teardown.
+    with ThreadPoolExecutor(2 * len(steps) + 1) as pool:
+        tasks = [asyncio.ensure_future(watch(step)) for step in steps]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await stop()
+            raise
+        await stop()
+    return dict(zip(steps, results))
@@ -0,0 +1,945 @@
+"""This module recalculates calibration workbook formulas without Excel.
+
+The formulas of a workbook are parsed once into expression trees, and the
+cells they reference form a dependency graph. When input ranges change, only
+the formula cells downstream of them are evaluated again, in dependency order,
+starting from the values Excel (or an earlier recalculation) cached in the
+file. The results are written back into the saved workbook as cached values so
+that later reads with `data_only=True` see them, exactly as after a save from
+Excel.
+
+"""
+
+import argparse
+from html import escape
+import math
+import re
+import tempfile
+import zipfile
+from os import close, replace
+from os.path import dirname
+
+from openpyxl import load_workbook
+from openpyxl.formula.tokenizer import Token, Tokenizer
+from openpyxl.utils.cell import coordinate_to_tuple, range_boundaries
+
+
+INFIX = {'^': 5, '*': 4, '/': 4, '+': 3, '-': 3, '&': 2, '=': 1, '<>': 1,
+         '<': 1, '>': 1, '<=': 1, '>=': 1}
+
+CELL = re.compile(
+    r'<c r="([A-Z]+[0-9]+)"([^>]*)>(<f[^>]*>.*?</f>|<f[^>]*/>)'
+    r'(?:<v\s*/>|<v>[^<]*</v>)?</c>', re.S)
+
+
+class FormulaError(Exception):
+    """An Excel error value raised while evaluating a formula."""
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+class CellError(str):
+    """The Excel error value held by a cell, such as '#DIV/0!'."""
+
+
+class Range():
+    """A rectangular block of cells on a single worksheet.
+
+    Parameters
+    ----------
+    sheet : str
+        Title of the worksheet.
+    min_row, min_col, max_row, max_col : int
+        One-based bounds of the block, inclusive.
+
+    """
+
+    def __init__(self, sheet, min_row, min_col, max_row, max_col):
+        self.sheet = sheet
+        self.min_row = min_row
+        self.min_col = min_col
+        self.max_row = max_row
+        self.max_col = max_col
+
+    @property
+    def shape(self):
+        """Number of rows and columns in the range."""
+        return (self.max_row - self.min_row + 1,
+                self.max_col - self.min_col + 1)
+
+    def keys(self):
+        """Cell keys of the range in row-major order."""
+        return [(self.sheet, row, col)
+                for row in range(self.min_row, self.max_row + 1)
+                for col in range(self.min_col, self.max_col + 1)]
+
+
+def _number(value):
+    """Coerce a scalar to a number the way Excel arithmetic does."""
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    raise FormulaError('#VALUE!')
+
+
+def _text(value):
+    """Coerce a scalar to text the way Excel concatenation does."""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float):
+        if value.is_integer():
+            return str(int(value))
+        return format(value, '.15g')
+    return str(value)
+
+
+def _rank(value):
+    """Order of a value's type in Excel comparisons."""
+    if isinstance(value, bool):
+        return 2
+    if isinstance(value, str):
+        return 1
+    return 0
+
+
+def _compare(op, left, right):
+    """Compare two scalars with an Excel comparison operator."""
+    if left is None:
+        left = '' if isinstance(right, str) else 0
+    if right is None:
+        right = '' if isinstance(left, str) else 0
+    if _rank(left) != _rank(right):
+        left, right = _rank(left), _rank(right)
+    elif isinstance(left, str):
+        left, right = left.lower(), right.lower()
+    return {'=': left == right, '<>': left != right, '<': left < right,
+            '>': left > right, '<=': left <= right,
+            '>=': left >= right}[op]
+
+
+def _criterion(criteria):
+    """Build a predicate for the criteria of SUMIF, COUNTIF and friends."""
+    if not isinstance(criteria, str):
+        return lambda value: not isinstance(value, str) and \
+            value is not None and _compare('=', value, criteria)
+    for op in ('<=', '>=', '<>', '<', '>', '='):
+        if criteria.startswith(op):
+            target = criteria[len(op):]
+            break
+    else:
+        op, target = '=', criteria
+    try:
+        target = float(target)
+    except ValueError:
+        if op in ('=', '<>') and any(char in target for char in '*?'):
+            pattern = re.compile(''.join(
+                '.*' if char == '*' else '.' if char == '?' else
+                re.escape(char) for char in target), re.I | re.S)
+            matched = op == '='
+            return lambda value: bool(pattern.fullmatch(_text(value))) \
+                == matched
+
+        def test(value):
+            if value is None:
+                value = ''
+            if op in ('=', '<>'):
+                equal = isinstance(value, str) and \
+                    value.lower() == target.lower()
+                return equal == (op == '=')
+            return isinstance(value, str) and _compare(op, value, target)
+        return test
+    return lambda value: isinstance(value, (int, float)) and \
+        not isinstance(value, bool) and _compare(op, value, target)
+
+
+def _round(value, digits, method=None):
+    """Round half away from zero as Excel does, or up or down if given."""
+    scale = 10 ** int(digits)
+    scaled = abs(value) * scale
+    if method == 'up':
+        scaled = math.ceil(round(scaled, 9))
+    elif method == 'down':
+        scaled = math.floor(round(scaled, 9))
+    else:
+        scaled = math.floor(round(scaled, 9) + 0.5)
+    return math.copysign(scaled / scale, value)
+
+
+class Calculator():
+    """Dependency-tracking evaluator for the formulas of a workbook.
+
+    Parameters
+    ----------
+    workbook : openpyxl.Workbook
+        Workbook loaded with its formulas.
+    values : openpyxl.Workbook, default : None
+        The same workbook loaded with `data_only=True`. Its cached values seed
+        the formula cells so that only cells downstream of a change are
+        evaluated. Formula cells without a cached value, or all of them when
+        values is None, are evaluated on the first recalculation.
+
+    """
+
+    def __init__(self, workbook, values=None):
+        self.workbook = workbook
+        self.values = {}
+        self.formulas = {}
+        self.precedents = {}
+        self.dependents = {}
+        self.dirty = set()
+        for sheet in workbook.worksheets:
+            cached = values[sheet.title] if values is not None else None
+            for row in sheet.iter_rows():
+                for cell in row:
+                    self._load(sheet.title, cell, cached)
+        for key, tree in self.formulas.items():
+            refs = set()
+            self._collect(tree, refs)
+            self.precedents[key] = refs
+            for ref in refs:
+                self.dependents.setdefault(ref, set()).add(key)
+
+    def _load(self, title, cell, cached):
+        """Record the value or parsed formula of a single cell."""
+        key = (title, cell.row, cell.column)
+        value = cell.value
+        if hasattr(value, 'text'):
+            value = value.text
+        if isinstance(value, str) and value.startswith('=') and \
+                len(value) > 1:
+            self.formulas[key] = self._parse(value, title)
+            value = None
+            if cached is not None:
+                value = cached.cell(row=cell.row, column=cell.column).value
+            if value is None:
+                self.dirty.add(key)
+            elif isinstance(value, str) and value.startswith('#'):
+                value = CellError(value)
+        if value is not None:
+            self.values[key] = value
+
+    def _parse(self, formula, sheet):
+        """Parse a formula into a nested tuple expression tree."""
+        tokens = [token for token in Tokenizer(formula).items
+                  if token.type != Token.WSPACE]
+        self._tokens, self._pos, self._sheet = tokens, 0, sheet
+        tree = self._expression(0)
+        if self._pos != len(tokens):
+            raise ValueError('Could not parse formula {}'.format(formula))
+        return tree
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise ValueError('Unexpected end of formula.')
+        self._pos += 1
+        return token
+
+    def _expression(self, min_prec):
+        left = self._unary()
+        token = self._peek()
+        while token is not None and token.type == Token.OP_IN and \
+                INFIX.get(token.value, -1) >= min_prec:
+            self._pos += 1
+            prec = INFIX[token.value]
+            left = ('op', token.value, left, self._expression(prec + 1))
+            token = self._peek()
+        return left
+
+    def _unary(self):
+        token = self._peek()
+        if token is not None and token.type == Token.OP_PRE:
+            self._pos += 1
+            operand = self._unary()
+            return ('neg', operand) if token.value == '-' else operand
+        node = self._primary()
+        token = self._peek()
+        while token is not None and token.type == Token.OP_POST:
+            self._pos += 1
+            node = ('pct', node)
+            token = self._peek()
+        return node
+
+    def _primary(self):
+        token = self._next()
+        if token.type == Token.OPERAND:
+            if token.subtype == Token.NUMBER:
+                return ('value', float(token.value))
+            if token.subtype == Token.TEXT:
+                return ('value', token.value[1:-1].replace('""', '"'))
+            if token.subtype == Token.LOGICAL:
+                return ('value', token.value.upper() == 'TRUE')
+            if token.subtype == Token.ERROR:
+                return ('error', token.value)
+            return ('ref', self._reference(token.value))
+        if token.type == Token.FUNC and token.subtype == Token.OPEN:
+            name = token.value[:-1].upper()
+            for prefix in ('_XLFN.', '_XLWS.'):
+                if name.startswith(prefix):
+                    name = name[len(prefix):]
+            if name not in FUNCTIONS and name not in ('IF', 'IFERROR'):
+                raise ValueError('Unsupported function {}.'.format(name))
+            args = []
+            token = self._peek()
+            if token is not None and token.type == Token.FUNC and \
+                    token.subtype == Token.CLOSE:
+                self._pos += 1
+                return ('func', name, args)
+            while True:
+                token = self._peek()
+                if token is not None and (
+                        token.type == Token.SEP or
+                        (token.type == Token.FUNC and
+                         token.subtype == Token.CLOSE)):
+                    args.append(('value', None))
+                else:
+                    args.append(self._expression(0))
+                token = self._next()
+                if token.type == Token.FUNC and token.subtype == Token.CLOSE:
+                    return ('func', name, args)
+                if token.type != Token.SEP:
+                    raise ValueError('Expected separator in function call.')
+        if token.type == Token.PAREN and token.subtype == Token.OPEN:
+            node = self._expression(0)
+            token = self._next()
+            if token.type != Token.PAREN:
+                raise ValueError('Unbalanced parentheses in formula.')
+            return node
+        raise ValueError('Unsupported formula token {}.'.format(token.value))
+
+    def _reference(self, text):
+        """Convert a reference or defined name into a Range."""
+        sheet = self._sheet
+        if '!' in text:
+            sheet, text = text.rsplit('!', 1)
+            if sheet.startswith("'"):
+                sheet = sheet[1:-1].replace("''", "'")
+        if sheet not in self.workbook.sheetnames:
+            raise ValueError('Unsupported reference to {}.'.format(sheet))
+        try:
+            min_col, min_row, max_col, max_row = range_boundaries(
+                text.replace('$', ''))
+        except ValueError:
+            return self._name(text)
+        worksheet = self.workbook[sheet]
+        if min_row is None:
+            min_row, max_row = 1, worksheet.max_row
+        if min_col is None:
+            min_col, max_col = 1, worksheet.max_column
+        return Range(sheet, min_row, min_col, max_row, max_col)
+
+    def _name(self, name):
+        """Resolve a workbook defined name to a Range."""
+        defined = self.workbook.defined_names.get(name)
+        if defined is None:
+            raise ValueError('Unknown name {}.'.format(name))
+        destinations = list(defined.destinations)
+        if len(destinations) != 1:
+            raise ValueError('Unsupported defined name {}.'.format(name))
+        sheet, ref = destinations[0]
+        current, self._sheet = self._sheet, sheet
+        try:
+            return self._reference(ref)
+        finally:
+            self._sheet = current
+
+    def _collect(self, tree, refs):
+        """Add the cell keys referenced by an expression tree to refs."""
+        if tree[0] == 'ref':
+            refs.update(tree[1].keys())
+        elif tree[0] == 'op':
+            self._collect(tree[2], refs)
+            self._collect(tree[3], refs)
+        elif tree[0] in ('neg', 'pct'):
+            self._collect(tree[1], refs)
+        elif tree[0] == 'func':
+            for arg in tree[2]:
+                self._collect(arg, refs)
+
+    def _key(self, sheet, ref):
+        """Convert a sheet title and range string to a list of cell keys."""
+        if ':' not in ref:
+            row, col = coordinate_to_tuple(ref.replace('$', ''))
+            return [(sheet, row, col)]
+        min_col, min_row, max_col, max_row = range_boundaries(
+            ref.replace('$', ''))
+        return Range(sheet, min_row, min_col, max_row, max_col).keys()
+
+    def downstream(self, keys):
+        """Find every formula cell that depends on the given cells.
+
+        Parameters
+        ----------
+        keys : iterable
+            Cell keys of the form (sheet, row, column).
+
+        Returns
+        -------
+        cells : set
+            Keys of the formula cells to be evaluated again.
+
+        """
+        cells = set()
+        stack = list(keys)
+        while stack:
+            for key in self.dependents.get(stack.pop(), ()):
+                if key not in cells:
+                    cells.add(key)
+                    stack.append(key)
+        return cells
+
+    def mark_changed(self, sheet, ref):
+        """Flag the cells downstream of a range as needing evaluation.
+
+        Parameters
+        ----------
+        sheet : str
+            Title of the worksheet.
+        ref : str
+            Cell or range reference, e.g. 'B2:B6'.
+
+        """
+        self.dirty |= self.downstream(self._key(sheet, ref))
+
+    def set_values(self, sheet, ref, data):
+        """Write input values into a range and flag its dependents.
+
+        Parameters
+        ----------
+        sheet : str
+            Title of the worksheet.
+        ref : str
+            Cell or range reference, e.g. 'B2:B6', filled in row-major order.
+        data : array-like
+            The values to write.
+
+        """
+        keys = self._key(sheet, ref)
+        if len(keys) != len(data):
+            raise ValueError('Length of dest and data should be the same.')
+        worksheet = self.workbook[sheet]
+        for key, value in zip(keys, data):
+            if hasattr(value, 'item'):
+                value = value.item()
+            worksheet.cell(row=key[1], column=key[2]).value = value
+            self.formulas.pop(key, None)
+            self.dirty.discard(key)
+            for ref_key in self.precedents.pop(key, ()):
+                self.dependents[ref_key].discard(key)
+            if value is None:
+                self.values.pop(key, None)
+            else:
+                self.values[key] = value
+        self.dirty |= self.downstream(keys)
+
+    def get_values(self, sheet, ref):
+        """Read the current values of a range in row-major order.
+
+        Parameters
+        ----------
+        sheet : str
+            Title of the worksheet.
+        ref : str
+            Cell or range reference, e.g. 'L4:L8'.
+
+        Returns
+        -------
+        vals : list
+            Values of the cells.
+
+        """
+        return [self.values.get(key) for key in self._key(sheet, ref)]
+
+    def order(self, cells):
+        """Sort formula cells so that each comes after its precedents."""
+        pending = {key: len(self.precedents[key] & cells) for key in cells}
+        ready = [key for key, count in pending.items() if count == 0]
+        ordered = []
+        while ready:
+            key = ready.pop()
+            ordered.append(key)
+            for dependent in self.dependents.get(key, ()):
+                if dependent in pending:
+                    pending[dependent] -= 1
+                    if pending[dependent] == 0:
+                        ready.append(dependent)
+        if len(ordered) != len(cells):
+            raise ValueError('Workbook contains circular references.')
+        return ordered
+
+    def recalculate(self):
+        """Evaluate every flagged formula cell.
+
+        Returns
+        -------
+        count : int
+            The number of cells evaluated.
+
+        """
+        ordered = self.order(self.dirty)
+        for key in ordered:
+            try:
+                value = self._scalar(self._eval(self.formulas[key]))
+            except FormulaError as err:
+                value = CellError(err.code)
+            if isinstance(value, float) and value.is_integer() and \
+                    abs(value) < 2 ** 53:
+                value = int(value)
+            if value is None:
+                value = 0
+            self.values[key] = value
+        self.dirty = set()
+        return len(ordered)
+
+    def save(self, filename):
+        """Save the workbook with its formulas and computed values.
+
+        Parameters
+        ----------
+        filename : str
+            Path to write the workbook to.
+
+        """
+        self.workbook.save(filename)
+        cached = {}
+        for (sheet, row, col), value in self.values.items():
+            if (sheet, row, col) in self.formulas:
+                cached.setdefault(sheet, {})[(row, col)] = value
+        write_cached_values(filename, [cached.get(sheet.title, {})
+                                       for sheet in self.workbook.worksheets])
+
+    def _get(self, key):
+        value = self.values.get(key)
+        if isinstance(value, CellError):
+            raise FormulaError(value)
+        return value
+
+    def _scalar(self, value):
+        """Reduce a single-cell range to its value."""
+        if isinstance(value, Range):
+            if value.shape != (1, 1):
+                raise FormulaError('#VALUE!')
+            return self._get(value.keys()[0])
+        return value
+
+    def _cells(self, arg):
+        """The values of a range argument, or of a scalar as a list."""
+        if isinstance(arg, Range):
+            return [self._get(key) for key in arg.keys()]
+        return [arg]
+
+    def _numbers(self, args):
+        """Numeric values of function arguments, as SUM and MAX see them."""
+        numbers = []
+        for arg in args:
+            if isinstance(arg, Range):
+                numbers.extend(
+                    value for value in self._cells(arg)
+                    if isinstance(value, (int, float)) and
+                    not isinstance(value, bool))
+            elif arg is not None:
+                numbers.append(_number(arg))
+        return numbers
+
+    def _eval(self, tree):
+        kind = tree[0]
+        if kind == 'value':
+            return tree[1]
+        if kind == 'ref':
+            return tree[1]
+        if kind == 'error':
+            raise FormulaError(tree[1])
+        if kind == 'neg':
+            return -_number(self._scalar(self._eval(tree[1])))
+        if kind == 'pct':
+            return _number(self._scalar(self._eval(tree[1]))) / 100
+        if kind == 'op':
+            return self._operate(tree[1], self._scalar(self._eval(tree[2])),
+                                 self._scalar(self._eval(tree[3])))
+        name, args = tree[1], tree[2]
+        if name == 'IF':
+            test = self._scalar(self._eval(args[0]))
+            if test is None or isinstance(test, str) and test == '':
+                test = False
+            if isinstance(test, str):
+                raise FormulaError('#VALUE!')
+            if test:
+                return self._eval(args[1]) if len(args) > 1 else True
+            return self._eval(args[2]) if len(args) > 2 else False
+        if name == 'IFERROR':
+            try:
+                return self._scalar(self._eval(args[0]))
+            except FormulaError:
+                return self._eval(args[1])
+        return FUNCTIONS[name](self, [self._eval(arg) for arg in args])
+
+    @staticmethod
+    def _operate(op, left, right):
+        if op == '&':
+            return _text(left) + _text(right)
+        if op in ('=', '<>', '<', '>', '<=', '>='):
+            return _compare(op, left, right)
+        left, right = _number(left), _number(right)
+        if op == '+':
+            return left + right
+        if op == '-':
+            return left - right
+        if op == '*':
+            return left * right
+        if op == '/':
+            if right == 0:
+                raise FormulaError('#DIV/0!')
+            return left / right
+        try:
+            result = float(left) ** right
+        except (OverflowError, ZeroDivisionError):
+            raise FormulaError('#NUM!')
+        if isinstance(result, complex):
+            raise FormulaError('#NUM!')
+        return result
+
+
+def _math(func):
+    """Wrap a one-argument math function, mapping domain errors to #NUM!."""
+    def wrapped(calc, args):
+        try:
+            return func(_number(calc._scalar(args[0])))
+        except (ValueError, OverflowError):
+            raise FormulaError('#NUM!')
+    return wrapped
+
+
+def _sumproduct(calc, args):
+    columns = [calc._cells(arg) for arg in args]
+    if len(set(len(column) for column in columns)) != 1:
+        raise FormulaError('#VALUE!')
+    total = 0
+    for values in zip(*columns):
+        product = 1
+        for value in values:
+            if not isinstance(value, (int, float)) or \
+                    isinstance(value, bool):
+                value = 0
+            product *= value
+        total += product
+    return total
+
+
+def _ifs(calc, args):
+    """Cells selected by the range and criteria pairs of SUMIFS and kin."""
+    ranges = [calc._cells(arg) for arg in args[::2]]
+    tests = [_criterion(calc._scalar(arg)) for arg in args[1::2]]
+    if len(set(len(cells) for cells in ranges)) != 1:
+        raise FormulaError('#VALUE!')
+    return [all(test(value) for test, value in zip(tests, values))
+            for values in zip(*ranges)]
+
+
+def _sum_selected(calc, sum_range, selected):
+    cells = calc._cells(sum_range)
+    if len(cells) != len(selected):
+        raise FormulaError('#VALUE!')
+    return [value for value, chosen in zip(cells, selected) if chosen and
+            isinstance(value, (int, float)) and not isinstance(value, bool)]
+
+
+def _sumif(calc, args):
+    selected = _ifs(calc, args[:2])
+    return sum(_sum_selected(calc, args[2] if len(args) > 2 else args[0],
+                             selected))
+
+
+def _sumifs(calc, args):
+    return sum(_sum_selected(calc, args[0], _ifs(calc, args[1:])))
+
+
+def _averageifs(calc, args):
+    values = _sum_selected(calc, args[0], _ifs(calc, args[1:]))
+    if not values:
+        raise FormulaError('#DIV/0!')
+    return sum(values) / len(values)
+
+
+def _average(calc, args):
+    numbers = calc._numbers(args)
+    if not numbers:
+        raise FormulaError('#DIV/0!')
+    return sum(numbers) / len(numbers)
+
+
+def _log(calc, args):
+    base = _number(calc._scalar(args[1])) if len(args) > 1 else 10
+    try:
+        return math.log(_number(calc._scalar(args[0])), base)
+    except (ValueError, ZeroDivisionError):
+        raise FormulaError('#NUM!')
+
+
+def _index(calc, args):
+    area = args[0]
+    if not isinstance(area, Range):
+        return area
+    rows, cols = area.shape
+    row = int(_number(calc._scalar(args[1])))
+    col = int(_number(calc._scalar(args[2]))) if len(args) > 2 else 0
+    if rows == 1 and len(args) < 3:
+        row, col = 1, row
+    elif cols == 1 and col == 0:
+        col = 1
+    if not (0 < row <= rows and 0 < col <= cols):
+        raise FormulaError('#REF!')
+    return calc._get((area.sheet, area.min_row + row - 1,
+                      area.min_col + col - 1))
+
+
+def _match(calc, args):
+    value = calc._scalar(args[0])
+    cells = calc._cells(args[1])
+    kind = _number(calc._scalar(args[2])) if len(args) > 2 else 1
+    if kind == 0:
+        test = _criterion(value) if isinstance(value, str) else \
+            (lambda cell: cell is not None and _compare('=', cell, value))
+        for idx, cell in enumerate(cells):
+            if test(cell):
+                return idx + 1
+        raise FormulaError('#N/A')
+    found = None
+    for idx, cell in enumerate(cells):
+        if cell is None or _rank(cell) != _rank(value):
+            continue
+        if _compare('<=' if kind > 0 else '>=', cell, value):
+            found = idx + 1
+        else:
+            break
+    if found is None:
+        raise FormulaError('#N/A')
+    return found
+
+
+def _lookup(calc, args, vertical):
+    area = args[1]
+    if not isinstance(area, Range):
+        raise FormulaError('#VALUE!')
+    offset = int(_number(calc._scalar(args[2])))
+    approx = calc._scalar(args[3]) if len(args) > 3 else True
+    if vertical:
+        first = Range(area.sheet, area.min_row, area.min_col, area.max_row,
+                      area.min_col)
+    else:
+        first = Range(area.sheet, area.min_row, area.min_col, area.min_row,
+                      area.max_col)
+    idx = _match(calc, [args[0], first, 1 if approx else 0])
+    if vertical:
+        return _index(calc, [area, idx, offset])
+    return _index(calc, [area, offset, idx])
+
+
+def _count(calc, args):
+    return len(calc._numbers(
+        [arg for arg in args if isinstance(arg, Range) or
+         isinstance(arg, (int, float))]))
+
+
+def _counta(calc, args):
+    return sum(1 for arg in args for value in calc._cells(arg)
+               if value is not None)
+
+
+FUNCTIONS = {
+    'SUM': lambda calc, args: sum(calc._numbers(args)),
+    'SUMPRODUCT': _sumproduct,
+    'SUMIF': _sumif,
+    'SUMIFS': _sumifs,
+    'AVERAGE': _average,
+    'AVERAGEIFS': _averageifs,
+    'COUNT': _count,
+    'COUNTA': _counta,
+    'COUNTIF': lambda calc, args: sum(_ifs(calc, args)),
+    'COUNTIFS': lambda calc, args: sum(_ifs(calc, args)),
+    'MIN': lambda calc, args: min(calc._numbers(args) or [0]),
+    'MAX': lambda calc, args: max(calc._numbers(args) or [0]),
+    'ABS': _math(abs),
+    'EXP': _math(math.exp),
+    'LN': _math(math.log),
+    'LOG10': _math(math.log10),
+    'LOG': _log,
+    'SQRT': _math(math.sqrt),
+    'INT': _math(math.floor),
+    'ROUND': lambda calc, args: _round(
+        _number(calc._scalar(args[0])), _number(calc._scalar(args[1]))),
+    'ROUNDUP': lambda calc, args: _round(
+        _number(calc._scalar(args[0])), _number(calc._scalar(args[1])),
+        'up'),
+    'ROUNDDOWN': lambda calc, args: _round(
+        _number(calc._scalar(args[0])), _number(calc._scalar(args[1])),
+        'down'),
+    'AND': lambda calc, args: all(
+        _number(value) for arg in args for value in calc._cells(arg)
+        if value is not None),
+    'OR': lambda calc, args: any(
+        _number(value) for arg in args for value in calc._cells(arg)
+        if value is not None),
+    'NOT': lambda calc, args: not _number(calc._scalar(args[0])),
+    'ISBLANK': lambda calc, args: calc._scalar(args[0]) is None,
+    'ISNUMBER': lambda calc, args: isinstance(
+        calc._scalar(args[0]), (int, float)) and
+    not isinstance(calc._scalar(args[0]), bool),
+    'INDEX': _index,
+    'MATCH': _match,
+    'VLOOKUP': lambda calc, args: _lookup(calc, args, True),
+    'HLOOKUP': lambda calc, args: _lookup(calc, args, False),
+}
+
+
+def _cached_xml(value):
+    """Attribute and value element for a cached formula result."""
+    if isinstance(value, CellError):
+        return ' t="e"', '<v>{}</v>'.format(escape(value, quote=False))
+    if isinstance(value, bool):
+        return ' t="b"', '<v>{}</v>'.format(int(value))
+    if isinstance(value, str):
+        return ' t="str"', '<v>{}</v>'.format(escape(value, quote=False))
+    return '', '<v>{}</v>'.format(repr(value))
+
+
+def write_cached_values(filename, sheets):
+    """Store computed formula results in a workbook saved by openpyxl.
+
+    openpyxl writes formula cells with empty values, which Excel fills in
+    when it saves the file. This fills them in the same way so the file can
+    be read with `data_only=True` without a round-trip through Excel.
+
+    Parameters
+    ----------
+    filename : str
+        Path to a workbook saved by openpyxl.
+    sheets : list of dict
+        For each worksheet, in order, a mapping of (row, column) to value.
+
+    """
+    def fill(match, cached):
+        value = cached.get(coordinate_to_tuple(match.group(1)))
+        if value is None:
+            return match.group(0)
+        attrs = re.sub(r'\s+t="[^"]*"', '', match.group(2))
+        kind, element = _cached_xml(value)
+        return '<c r="{}"{}{}>{}{}</c>'.format(
+            match.group(1), attrs, kind, match.group(3), element)
+
+    handle, temp = tempfile.mkstemp(dir=dirname(filename) or '.',
+                                    suffix='.xlsx')
+    close(handle)
+    with zipfile.ZipFile(filename) as source, \
+            zipfile.ZipFile(temp, 'w', zipfile.ZIP_DEFLATED) as dest:
+        for item in source.infolist():
+            data = source.read(item.filename)
+            match = re.fullmatch(r'xl/worksheets/sheet(\d+)\.xml',
+                                 item.filename)
+            if match and int(match.group(1)) <= len(sheets):
+                cached = sheets[int(match.group(1)) - 1]
+                data = CELL.sub(lambda found: fill(found, cached),
+                                data.decode('utf-8')).encode('utf-8')
+            dest.writestr(item, data)
+    replace(temp, filename)
+
+
+def recalculate(filename, base=None, changed=()):
+    """Recalculate a calibration workbook in place.
+
+    Parameters
+    ----------
+    filename : str
+        Path to a workbook saved with openpyxl after its inputs were changed.
+    base : str, default : None
+        Path to the workbook filename was created from, whose cached values
+        are still valid outside of the changed ranges. If None, every formula
+        is evaluated.
+    changed : iterable of tuple, default : ()
+        (sheet, range) pairs of the inputs that differ from base.
+
+    Returns
+    -------
+    calc : Calculator
+        The calculator holding the workbook values.
+
+    """
+    workbook = load_workbook(filename)
+    values = load_workbook(base, data_only=True) if base else None
+    calc = Calculator(workbook, values)
+    if values is not None:
+        values.close()
+    for sheet, ref in changed:
+        calc.mark_changed(sheet, ref)
+    calc.recalculate()
+    calc.save(filename)
+    workbook.close()
+    return calc
+
+
+def compare(filename, rel_tol=1e-9, abs_tol=1e-9):
+    """Check the engine against the values Excel saved in a workbook.
+
+    Parameters
+    ----------
+    filename : str
+        Path to a workbook last saved by Excel.
+    rel_tol : float, default : 1e-9
+        Relative tolerance for numeric values.
+    abs_tol : float, default : 1e-9
+        Absolute tolerance for numeric values.
+
+    Returns
+    -------
+    mismatches : list of tuple
+        (sheet, row, column, excel value, engine value) for every formula cell
+        whose recalculated value differs from the saved one.
+
+    """
+    expected = Calculator(load_workbook(filename),
+                          load_workbook(filename, data_only=True))
+    calc = Calculator(load_workbook(filename))
+    calc.recalculate()
+    mismatches = []
+    for key in calc.formulas:
+        saved, value = expected.values.get(key), calc.values.get(key)
+        if isinstance(saved, (int, float)) and \
+                isinstance(value, (int, float)):
+            if math.isclose(saved, value, rel_tol=rel_tol, abs_tol=abs_tol):
+                continue
+        elif saved == value or (saved is None and value in ('', 0)):
+            continue
+        mismatches.append(key + (saved, value))
+    return mismatches
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='Compare recalculated formulas with the values saved by '
+        'Excel in a workbook.')
+    PARSER.add_argument(
+        'filename', metavar='Filename', type=str,
+        help='The path to a workbook last saved by Excel.')
+    ARGS = PARSER.parse_args()
+    MISMATCHES = compare(ARGS.filename)
+    for sheet, row, col, saved, value in MISMATCHES:
+        print('{}!R{}C{}: excel {!r}, engine {!r}'.format(
+            sheet, row, col, saved, value))
+    print('{} mismatched cells.'.format(len(MISMATCHES)))
+    raise SystemExit(1 if MISMATCHES else 0)
@@ -0,0 +1,325 @@
+"""This module contains the backends that launch the sandag_abm.
+
+Every runner starts a model run with the same parameters (the global
+iteration to start from, the sample rates and whether to write to the
+database) and returns the process running it, so the calibration loop can
+wait for outputs and stop the model without knowing how it was started.
+
+- GuiRunner drives the TransCAD interface with PyMouse and PyKeyboard.
+- BatchRunner runs a command line built from a template.
+- LocalRunner writes synthetic outputs with synthetic.py, so the calibration
+  loop can be tested and benchmarked without TransCAD.
+
+"""
+
+import abc
+import os.path as osp
+import shlex
+import subprocess
+import sys
+from time import sleep
+
+import psutil
+
+from tracing import span
+
+
+DEFAULT_RATES = ['0.2', '0.5', '1.0']
+
+
+def launch_transcad():
+    """Startup TransCAD and set to fullscreen.
+
+    Returns
+    -------
+    proc : subprocess.Popen
+        Process where TransCAD is running.
+
+    """
+    from pykeyboard import PyKeyboard
+    board = PyKeyboard()
+    proc = subprocess.Popen([r'C:/Program Files/TransCAD 6.0\Tcw.exe'])
+    sleep(15)
+    board.tap_key(board.alt_key)
+    board.tap_key(board.space_key)
+    board.tap_key('x')
+    return proc
+
+
+def compile_abm(working_directory):
+    """Compile the sandag_abm.
+
+    Parameters
+    ----------
+    working_directory : str
+        The path to the directory containing the gisdk and uec directories.
+
+    """
+    from pymouse import PyMouse
+    from pykeyboard import PyKeyboard
+    mouse = PyMouse()
+    board = PyKeyboard()
+    xdim, ydim = mouse.screen_size()
+    mouse.click(int(round(xdim * 0.55595)), int(round(ydim * 0.04952)))
+    sleep(2)
+    board.type_string('sandag_abm.lst')
+    sleep(2)
+    board.tap_key(board.tab_key, n=4)
+    sleep(2)
+    board.tap_key(board.enter_key)
+    sleep(2)
+    board.type_string(working_directory + '/gisdk')
+    sleep(2)
+    board.tap_key(board.enter_key)
+    sleep(2)
+    board.tap_key(board.tab_key, n=8)
+    sleep(2)
+    board.tap_key(board.enter_key)
+    sleep(2)
+
+
+def set_abm_params(start_iter, sample_rates, write_db=False):
+    """Set the parameters for the sandag_abm.
+
+    Parameters
+    ----------
+    start_iter : int
+        The iteration to start the process from.
+    sample_rates : str or None
+        The sample rates for the abm in string form.
+    write_db : bool, default : False
+        Whether the model should write its results to the database.
+
+    """
+    from pymouse import PyMouse
+    from pykeyboard import PyKeyboard
+    mouse = PyMouse()
+    board = PyKeyboard()
+    xdim, ydim = mouse.screen_size()
+    mouse.click(int(round(xdim * 0.57083)), int(round(ydim * 0.04952)))
+    sleep(2)
+    board.press_keys([board.alt_key, 'd'])
+    board.press_keys([board.alt_key, 'n'])
+    board.type_string('Setup Scenario')
+    board.tap_key(board.enter_key)
+    sleep(2)
+    board.tap_key(board.space_key)
+    sleep(5)
+    # Set database write to 'No' unless writing was asked for
+    board.tap_key(board.tab_key, n=22)
+    if not write_db:
+        board.tap_key(board.space_key)
+    if start_iter == 1:
+        board.tap_key(board.tab_key, n=7)
+    else:
+        board.tap_key(board.tab_key, n=2 + start_iter)
+        board.tap_key(board.space_key)
+        board.tap_key(board.tab_key, n=5 - start_iter)
+    if sample_rates:
+        board.tap_key(board.backspace_key)
+        board.type_string(sample_rates)
+    board.tap_key(board.tab_key)
+    board.tap_key(board.space_key)
+    sleep(1)
+
+
+def launch_abm(working_directory):
+    """Launch the sandag_abm.
+
+    Parameters
+    ----------
+    working_directory : str
+        The path to the directory containing the gisdk and uec directories.
+
+    """
+    from pykeyboard import PyKeyboard
+    board = PyKeyboard()
+    board.tap_key(board.down_key)
+    board.tap_key(board.space_key)
+    sleep(2)
+    board.tap_key(board.tab_key, n=3)
+    board.tap_key(board.enter_key)
+    board.type_string(working_directory)
+    sleep(4)
+    board.tap_key(board.enter_key)
+    sleep(2)
+    board.tap_key(board.tab_key, n=6)
+    board.tap_key(board.backspace_key)
+    board.tap_key(board.tab_key)
+    board.tap_key(board.enter_key)
+
+
+def kill_proc_tree(pid, including_parent=True):
+    """Kill a process and all of its children.
+
+    Parameters
+    ----------
+    pid : int
+        The process id of the process to kill all children from.
+    including_parent : bool
+        Boolean representing wether to also kill the parent process.
+
+    """
+    try:
+        parent = psutil.Process(pid)
+        children = parent.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return
+    for child in children:
+        try:
+            child.kill()
+        except psutil.NoSuchProcess:
+            pass
+    _, _ = psutil.wait_procs(children, timeout=5)
+    if including_parent:
+        try:
+            parent.kill()
+            parent.wait(5)
+        except psutil.NoSuchProcess:
+            pass
+
+
+class Runner(abc.ABC):
+    """Interface of the backends that launch the sandag_abm.
+
+    A backend has to implement launch, and is checked for it when created.
+
+    """
+
+    @abc.abstractmethod
+    def launch(self, working_directory, start_iter=1, sample_rates=None,
+               write_db=False, seed=0):
+        """Start a model run.
+
+        Parameters
+        ----------
+        working_directory : str
+            The path to the directory containing the gisdk and uec
+            directories.
+        start_iter : int, default : 1
+            The iteration to start the process from.
+        sample_rates : str, default : None
+            The sample rates of the three global iterations in a comma
+            separated string, or None to use the defaults.
+        write_db : bool, default : False
+            Whether the model should write its results to the database.
+        seed : int, default : 0
+            Offset of the model's random seed, so copies of the model run
+            side by side draw different samples.
+
+        Returns
+        -------
+        proc : subprocess.Popen
+            The process running the model.
+
+        """
+
+    def for_directory(self, directory):
+        """The runner of a copy of the working directory.
+
+        Parameters
+        ----------
+        directory : str
+            Path to the copy.
+
+        Returns
+        -------
+        runner : Runner
+            A runner that runs the model in the copy.
+
+        """
+        return self
+
+
+class GuiRunner(Runner):
+    """Run the model by driving the TransCAD interface.
+
+    The interface runs one model at a time with the seed of its properties,
+    so the seed offset is ignored and copies can not be run.
+
+    """
+
+    def launch(self, working_directory, start_iter=1, sample_rates=None,
+               write_db=False, seed=0):
+        with span('launch_transcad'):
+            proc = launch_transcad()
+        with span('compile_abm'):
+            compile_abm(working_directory)
+        with span('set_abm_params', start_iter=start_iter):
+            set_abm_params(start_iter, sample_rates, write_db=write_db)
+        with span('launch_abm'):
+            launch_abm(working_directory)
+        return proc
+
+    def for_directory(self, directory):
+        raise ValueError('The GUI runner can not run copies of the model.')
+
+
+class BatchRunner(Runner):
+    """Run the model with a command line.
+
+    Parameters
+    ----------
+    command : str
+        Command line template. The fields {working_directory}, {start_iter},
+        {sample_rates}, {write_db} (1 or 0) and {seed} are filled in for each
+        run, e.g. 'runSandagAbm.cmd {working_directory} {start_iter}
+        {sample_rates} {write_db}'.
+
+    """
+
+    def __init__(self, command):
+        self.command = command
+
+    def launch(self, working_directory, start_iter=1, sample_rates=None,
+               write_db=False, seed=0):
+        fields = {'working_directory': working_directory,
+                  'start_iter': start_iter,
+                  'sample_rates': sample_rates or ','.join(DEFAULT_RATES),
+                  'write_db': int(write_db), 'seed': seed}
+        args = [arg.format(**fields) for arg in
+                shlex.split(self.command, posix=sys.platform != 'win32')]
+        with span('launch', runner='batch', start_iter=start_iter):
+            return subprocess.Popen(args, cwd=working_directory)
+
+
+class LocalRunner(Runner):
+    """Stand in for the model by writing synthetic outputs.
+
+    Parameters
+    ----------
+    input_path : str
+        The path to the directory containing the output and uec directories.
+    rows : int, default : 100000
+        The number of persons at a sample rate of 1.
+    duration : float, default : 0
+        Seconds to wait between global iterations, to mimic model runtime.
+    seed : int, default : 0
+        Seed of the random number generator.
+
+    """
+
+    def __init__(self, input_path, rows=100000, duration=0, seed=0):
+        self.input_path = input_path
+        self.rows = rows
+        self.duration = duration
+        self.seed = seed
+
+    def launch(self, working_directory, start_iter=1, sample_rates=None,
+               write_db=False, seed=0):
+        args = [sys.executable,
+                osp.join(osp.dirname(osp.abspath(__file__)), 'synthetic.py'),
+                self.input_path, '--rows', str(self.rows), '--start_iter',
+                str(start_iter), '--seed', str(self.seed + seed),
+                '--duration', str(self.duration)]
+        if sample_rates:
+            args += ['--sample_rates', sample_rates]
+        with span('launch', runner='local', start_iter=start_iter):
+            return subprocess.Popen(args)
+
+    def for_directory(self, directory):
+        return LocalRunner(directory, rows=self.rows, duration=self.duration,
+                           seed=self.seed)
+
+
+RUNNERS = {'gui': GuiRunner, 'batch': BatchRunner, 'local': LocalRunner}
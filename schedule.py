@@ -0,0 +1,111 @@
+"""This module adapts the model's sample rate to the calibration's progress.
+
+The modeled shares of a run at sample rate r are estimated from roughly r
+times the population, so they carry a sampling error of about
+sqrt(p * (1 - p) / n) for a share p of a segment of n persons. While the gap
+between modeled and target shares is much larger than that error, a small
+sample steers the constants as well as a full one at a fraction of the model
+time. Once the gap approaches the noise floor, the schedule moves to the next
+higher rate, and a step is only accepted as converged from a run at the
+highest rate, so the calibration never converges on sampling noise. Where an
+ensemble of runs measured the standard errors of the shares directly, those
+are used instead. Steps whose share gap was not checked are left out, and
+without any gap the schedule moves up a rate after every run.
+
+"""
+
+import math
+
+
+RATES = [0.1, 0.25, 0.5, 1.0]
+
+
+def sampling_error(metrics, z=1.96):
+    """The largest sampling error of the modeled shares of a step.
+
+    Parameters
+    ----------
+    metrics : dict
+        The value returned by convergence.evaluate.
+    z : float, default : 1.96
+        The number of standard errors of the returned error, 1.96 for a 95%
+        confidence interval.
+
+    Returns
+    -------
+    error : float
+        The largest half-width of the confidence interval of any modeled
+        share, in the units of the share gap.
+
+    """
+    errors = [0.0]
+    for segment in metrics['segments'].values():
+        if 'errors' in segment:
+            errors.extend(z * error for error in segment['errors'].values())
+            continue
+        if not segment['total']:
+            continue
+        errors.extend(z * math.sqrt(share * (1 - share) / segment['total'])
+                      for share in segment['shares'].values())
+    return max(errors)
+
+
+class SampleSchedule():
+    """Choose the sample rate of each calibration model run.
+
+    Parameters
+    ----------
+    rates : list of float, default : None
+        The sample rates to step through, from lowest to highest. Defaults
+        to RATES.
+    noise_ratio : float, default : 2.0
+        Move to the next rate once the largest share gap is within this many
+        times the sampling error.
+    z : float, default : 1.96
+        The number of standard errors of the sampling error.
+
+    """
+
+    def __init__(self, rates=None, noise_ratio=2.0, z=1.96):
+        self.rates = sorted(rates or RATES)
+        self.noise_ratio = noise_ratio
+        self.z = z
+        self.level = 0
+        self.history = []
+
+    @property
+    def rate(self):
+        """The sample rate of the next model run."""
+        return self.rates[self.level]
+
+    @property
+    def full(self):
+        """Whether the next model run is at the highest rate."""
+        return self.level == len(self.rates) - 1
+
+    def record(self, metrics):
+        """Record the metrics of a run and choose the next rate.
+
+        Parameters
+        ----------
+        metrics : list of dict
+            The values returned by convergence.evaluate for each step
+            updated from the run.
+
+        Returns
+        -------
+        rate : float
+            The sample rate of the next model run.
+
+        """
+        metrics = [step for step in metrics if step['max_gap'] is not None]
+        gap = max((step['max_gap'] for step in metrics), default=None)
+        noise = max((sampling_error(step, z=self.z) for step in metrics),
+                    default=None)
+        record = {'rate': self.rate, 'max_gap': gap, 'noise': noise}
+        if not self.full and (gap is None or
+                              gap <= self.noise_ratio * noise):
+            self.level += 1
+        record['next_rate'] = self.rate
+        self.history.append(record)
+        return self.rate
@@ -0,0 +1,340 @@
+"""This module estimates how the calibration responds to each constant.
+
+A calibration iteration learns how the modeled shares respond to the
+constants from the single run it makes. The sensitivity farm instead clones
+the model's working directory once per constant, perturbs that constant in
+the clone's UEC and runs all clones at once from a local job queue, next to
+an unperturbed base run. The residual of each run (the change of the
+constants its calibration workbook proposes) minus the base run's residual,
+divided by the perturbation, is one column of the Jacobian of the residuals,
+cross-segment effects included. A Newton step through that matrix gives the
+calibrated constants in one wall-clock round. The matrix is saved next to the
+step's calibration workbook, and the constants can be written to the UEC
+directly.
+
+The clones share nothing but what they were copied from, so the runs can be
+spread over cores with the local or batch runner, or over nodes with a batch
+command that submits to them. The GUI runner can not run models side by
+side.
+
+    python sensitivity.py WORKING_DIRECTORY -m CDAP -r batch -c COMMAND -j 8
+
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import os.path as osp
+import shutil
+from time import time
+
+import numpy as np
+
+from aggregate import TARGETS, scan
+from runner import RUNNERS, kill_proc_tree
+import tracing
+from update import (STEPS, uec_constants, workbook_step,
+                    write_uec_constants)
+from watch import wait_for_output
+
+
+def clone(source, dest):
+    """Copy a model working directory without its outputs.
+
+    An existing copy is reused, with only its uec directory refreshed.
+
+    Parameters
+    ----------
+    source : str
+        Path to the working directory, containing the uec and output
+        directories.
+    dest : str
+        Path of the copy.
+
+    """
+    if osp.isdir(dest):
+        shutil.copytree(osp.join(source, 'uec'), osp.join(dest, 'uec'),
+                        dirs_exist_ok=True)
+    else:
+        shutil.copytree(source, dest, ignore=lambda directory, names: [
+            'output'] if osp.samefile(directory, source) else [])
+    os.makedirs(osp.join(dest, 'output'), exist_ok=True)
+
+
+def perturbations(constants, step_size):
+    """The constants of the base run and of one run per perturbed constant.
+
+    Parameters
+    ----------
+    constants : list of float
+        The current constants.
+    step_size : float
+        The change of the perturbed constant.
+
+    Returns
+    -------
+    runs : list of list of float
+        The constants of each run, the unperturbed base run first.
+
+    """
+    runs = [list(constants)]
+    for idx in range(len(constants)):
+        run = list(constants)
+        run[idx] += step_size
+        runs.append(run)
+    return runs
+
+
+def estimate(residuals, step_size):
+    """Estimate the Jacobian of the residuals by forward differences.
+
+    Parameters
+    ----------
+    residuals : array-like
+        The residual of the base run followed by the residual of each
+        perturbed run, one row per run.
+    step_size : float
+        The change of the perturbed constants.
+
+    Returns
+    -------
+    jacobian : numpy.ndarray
+        The change of each residual (rows) per change of each constant
+        (columns).
+
+    """
+    residuals = np.asarray(residuals, dtype=float)
+    return (residuals[1:] - residuals[0]).T / step_size
+
+
+def newton(constants, residual, jacobian):
+    """Solve for the constants whose residuals are zero.
+
+    Constants that move no residual, such as those of reference
+    alternatives, are left unchanged by the least-squares solution.
+
+    Parameters
+    ----------
+    constants : list of float
+        The constants of the base run.
+    residual : list of float
+        The residual of the base run.
+    jacobian : numpy.ndarray
+        As returned by estimate.
+
+    Returns
+    -------
+    constants : list of float
+        The new constants.
+
+    """
+    step = np.linalg.lstsq(jacobian, -np.asarray(residual, dtype=float),
+                           rcond=None)[0]
+    return (np.asarray(constants, dtype=float) + step).tolist()
+
+
+def run_clone(directory, constants, runner, method='AO', start_iter=1,
+              sample_rates=None, quiet_period=60, poll_interval=5,
+              timeout=None):
+    """Run the model in a clone with the given constants and count results.
+
+    Parameters
+    ----------
+    directory : str
+        Path to the clone.
+    constants : list of float
+        The constants written to the clone's UEC.
+    runner : runner.Runner
+        The backend that runs the model in the clone.
+    method : str, 'AO' | 'CDAP'
+        The calibration step.
+    start_iter : int, default : 1
+        The iteration of the abm to start on.
+    sample_rates : str, default : None
+        The sample rates of the run.
+    quiet_period : float, default : 60
+        See watch.wait_for_output.
+    poll_interval : float, default : 5
+        See watch.wait_for_output.
+    timeout : float, default : None
+        The number of seconds the run may take.
+
+    Returns
+    -------
+    counts : pandas.Series
+        The counts of the step's target, as returned by aggregate.scan.
+
+    """
+    step = STEPS[method]
+    write_uec_constants(osp.join(directory, 'uec', step.uec + '.xls'),
+                        constants, method)
+    result_file = osp.join(directory, 'output',
+                           TARGETS[method].results(start_iter))
+    with tracing.span('sensitivity_run', path=directory, method=method):
+        start_time = time()
+        proc = runner.launch(directory, start_iter=start_iter,
+                             sample_rates=sample_rates)
+        try:
+            wait_for_output(result_file, start_time,
+                            quiet_period=quiet_period,
+                            poll_interval=poll_interval, timeout=timeout,
+                            exited=lambda: proc.poll() is not None)
+        finally:
+            kill_proc_tree(proc.pid, including_parent=True)
+    return scan(result_file, {method: TARGETS[method]})[method]
+
+
+def sensitivity(working_directory, make_runner, method='AO',
+                output_path='../Model Calibration', clone_path=None,
+                step_size=0.25, jobs=None, apply=False, **run_options):
+    """Estimate the Jacobian of a step from parallel runs and solve it.
+
+    Parameters
+    ----------
+    working_directory : str
+        Path to the model's working directory, containing the uec and
+        output directories.
+    make_runner : callable
+        make_runner(directory) returns the runner.Runner for a clone.
+    method : str, 'AO' | 'CDAP'
+        The calibration step.
+    output_path : str, default : '../Model Calibration'
+        The path to the directory containing the calibration directories.
+    clone_path : str, default : None
+        The directory the clones are kept in, and reused from. Defaults to
+        the working directory's path followed by `_sensitivity`.
+    step_size : float, default : 0.25
+        The perturbation of each constant.
+    jobs : int, default : None
+        The number of runs at a time. Defaults to all of them.
+    apply : bool, default : False
+        Whether to write the new constants to the working directory's UEC.
+    **run_options
+        start_iter, sample_rates, quiet_period, poll_interval and timeout,
+        passed on to run_clone.
+
+    Returns
+    -------
+    result : dict
+        The base constants, the constants the workbook proposes from the
+        base run, the residual, the Jacobian and the new constants. Also
+        saved as sensitivity.json in the step's calibration directory.
+
+    """
+    step = STEPS[method]
+    clone_path = clone_path or working_directory.rstrip('/\\') + \
+        '_sensitivity'
+    constants = uec_constants(
+        osp.join(working_directory, 'uec', step.uec + '.xls'), method)
+    constants = [const or 0 for const in constants]
+    runs = perturbations(constants, step_size)
+    directories = [osp.join(clone_path, '{}_{}'.format(method, idx))
+                   for idx in range(len(runs))]
+    for directory in directories:
+        clone(working_directory, directory)
+    template = osp.join(output_path, step.directory, step.workbook + '.xlsx')
+
+    def run(idx):
+        counts = run_clone(directories[idx], runs[idx],
+                           make_runner(directories[idx]), method=method,
+                           **run_options)
+        proposed = workbook_step(
+            template, osp.join(directories[idx], 'sensitivity.xlsx'),
+            counts, runs[idx], method=method)
+        return [after - before for before, after in zip(runs[idx],
+                                                        proposed)], proposed
+
+    with ThreadPoolExecutor(jobs or len(runs)) as queue:
+        outcomes = list(queue.map(run, range(len(runs))))
+    residuals = [residual for residual, _ in outcomes]
+    jacobian = estimate(residuals, step_size)
+    result = {'method': method, 'step_size': step_size,
+              'constants': constants, 'proposed': outcomes[0][1],
+              'residual': residuals[0], 'jacobian': jacobian.tolist(),
+              'new_constants': newton(constants, residuals[0], jacobian)}
+    with open(osp.join(output_path, step.directory, 'sensitivity.json'),
+              'w') as saved:
+        json.dump(result, saved, indent=1, default=float)
+    if apply:
+        write_uec_constants(
+            osp.join(working_directory, 'uec', step.uec + '.xls'),
+            result['new_constants'], method)
+    return result
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='Estimate the calibration Jacobian from parallel runs.')
+    PARSER.add_argument(
+        'working_directory', metavar='Working_Directory', type=str,
+        help='The path to the directory containing the uec and output '
+        'directories.')
+    PARSER.add_argument(
+        '-m', '--method', metavar='Method', type=str, default='AO',
+        choices=sorted(STEPS), help='The calibration step.')
+    PARSER.add_argument(
+        '-op', '--output_path', metavar='Output_Path', type=str,
+        default='../Model Calibration', help='The path to the directory '
+        'containing the calibration directories.')
+    PARSER.add_argument(
+        '-cp', '--clone_path', metavar='Clone_Path', type=str,
+        help='The directory to keep the clones in.')
+    PARSER.add_argument(
+        '-s', '--step_size', metavar='Step_Size', type=float, default=0.25,
+        help='The perturbation of each constant.')
+    PARSER.add_argument(
+        '-j', '--jobs', metavar='Jobs', type=int,
+        help='The number of runs at a time. Defaults to all of them.')
+    PARSER.add_argument(
+        '-r', '--runner', metavar='Runner', type=str, default='batch',
+        choices=['batch', 'local'], help='The backend used to run the '
+        'model in each clone.')
+    PARSER.add_argument(
+        '-c', '--command', metavar='Command', type=str,
+        help='Command line template for the batch runner, see calibrate.py.')
+    PARSER.add_argument(
+        '-rows', '--rows', metavar='Rows', type=int, default=100000,
+        help='The number of persons written by the local runner.')
+    PARSER.add_argument(
+        '-si', '--start_iter', metavar='Start_Iteration', type=int,
+        default=1, choices=[1, 2, 3],
+        help='The iteration of the abm on which to start.')
+    PARSER.add_argument(
+        '-sr', '--sample_rates', metavar='Sample_Rates', type=str,
+        help='The sample rates of the three global iterations.')
+    PARSER.add_argument(
+        '-qp', '--quiet_period', metavar='Quiet_Period', type=float,
+        default=60, help='The number of seconds a result file must stay '
+        'unchanged before it is considered complete.')
+    PARSER.add_argument(
+        '-pi', '--poll_interval', metavar='Poll_Interval', type=float,
+        default=5, help='The longest time in seconds between checks of the '
+        'result file.')
+    PARSER.add_argument(
+        '-rt', '--run_timeout', metavar='Run_Timeout', type=float,
+        help='The number of seconds each run may take.')
+    PARSER.add_argument(
+        '-a', '--apply', action='store_true',
+        help='Write the new constants to the working directory\'s UEC.')
+    ARGS = PARSER.parse_args()
+    if ARGS.runner == 'batch':
+        if not ARGS.command:
+            PARSER.error('The batch runner requires --command.')
+        RUNNER = RUNNERS['batch'](ARGS.command)
+
+        def MAKE_RUNNER(directory):
+            return RUNNER
+    else:
+        def MAKE_RUNNER(directory):
+            return RUNNERS['local'](directory, rows=ARGS.rows)
+    tracing.configure(osp.join(ARGS.output_path, 'trace.jsonl'))
+    RESULT = sensitivity(
+        ARGS.working_directory, MAKE_RUNNER, method=ARGS.method,
+        output_path=ARGS.output_path, clone_path=ARGS.clone_path,
+        step_size=ARGS.step_size, jobs=ARGS.jobs, apply=ARGS.apply,
+        start_iter=ARGS.start_iter, sample_rates=ARGS.sample_rates,
+        quiet_period=ARGS.quiet_period, poll_interval=ARGS.poll_interval,
+        timeout=ARGS.run_timeout)
+    print('{} constants: {}'.format(ARGS.method, ', '.join(
+        '{:.4f}'.format(const) for const in RESULT['new_constants'])))
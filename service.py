@@ -0,0 +1,346 @@
+"""This module keeps the calibration updates resident in a service.
+
+Running an update as a script starts a new interpreter for every iteration,
+which imports pandas, openpyxl and xlrd again and parses the same calibration
+templates and UECs again before doing any work. The service imports the
+update modules once and then answers update requests over a local socket (a
+named pipe on Windows), so each request reuses the loaded modules, the parsed
+templates of workbooks.WORKBOOKS and the parsed UECs of update.READ_CACHE.
+The client side imports nothing but the standard library, so a request costs
+milliseconds of startup instead of seconds.
+
+Requests and replies are JSON objects. Requests are served one at a time, in
+the order their connections are accepted, since the updates write the same
+workbooks and UECs.
+
+The socket is kept in a directory of the temporary directory only its owner
+can open, and clients have to prove they hold the service's key. Unless one
+is given, the key is read from KEY_FILE in the user's home directory, which
+is created with a random key readable only by the user on first use.
+
+    python service.py serve -p TEMPLATE [TEMPLATE ...]
+    python service.py update 1 -ip . -op "../Model Calibration/1_AO" -m AO
+    python service.py stop
+
+"""
+
+import argparse
+import getpass
+import json
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+import os
+import secrets
+import stat
+import sys
+import tempfile
+from time import perf_counter
+
+
+USER = getpass.getuser()
+ADDRESS = r'\\.\pipe\sandag-calibration-{}'.format(USER) \
+    if sys.platform == 'win32' else os.path.join(
+        tempfile.gettempdir(), 'sandag-calibration-{}'.format(USER),
+        'service.sock')
+KEY_FILE = os.path.join(os.path.expanduser('~'), '.sandag-calibration-key')
+
+
+class ServiceError(Exception):
+    """The service could not complete a request."""
+
+
+def _encode(value):
+    """Convert the values of an update result that JSON can not hold."""
+    if hasattr(value, 'items') and hasattr(value, 'index'):
+        # pandas.Series of counts, as pairs of the index labels and count
+        return [[list(key) if isinstance(key, tuple) else key, _encode(count)]
+                for key, count in value.items()]
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+def default_authkey(filename=KEY_FILE):
+    """Read the user's service key, creating it on first use.
+
+    Parameters
+    ----------
+    filename : str, default : KEY_FILE
+        The file the key is kept in.
+
+    Returns
+    -------
+    authkey : bytes
+        The key.
+
+    """
+    try:
+        handle = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o600)
+    except FileExistsError:
+        with open(filename, 'rb') as key:
+            return key.read().strip()
+    authkey = secrets.token_hex(32).encode()
+    with os.fdopen(handle, 'wb') as key:
+        key.write(authkey)
+    return authkey
+
+
+def _private_directory(directory):
+    """Create a directory only its owner can use, or check an existing one.
+
+    Raises
+    ------
+    ServiceError
+        If the directory belongs to another user or others can open it.
+
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    status = os.stat(directory)
+    if status.st_uid != os.getuid() or \
+            stat.S_IMODE(status.st_mode) & 0o077:
+        raise ServiceError('{} has to be a directory only {} can '
+                           'open.'.format(directory, USER))
+
+
+class Service():
+    """Answer update requests with resident modules and caches.
+
+    The update modules are imported when the service starts, not when this
+    module is imported.
+
+    Parameters
+    ----------
+    address : str, default : ADDRESS
+        The path of the socket, or of the named pipe on Windows.
+    authkey : bytes, default : None
+        The key clients have to prove they hold. Defaults to the key of
+        default_authkey.
+    preload : list of str, default : None
+        Paths to calibration templates to parse before the first request.
+
+    """
+
+    def __init__(self, address=ADDRESS, authkey=None, preload=None):
+        self.address = address
+        self.authkey = authkey or default_authkey()
+        self.served = 0
+        start = perf_counter()
+        import update
+        import update_cdap
+        import update_ownership
+        from workbooks import WORKBOOKS
+        self.modules = {'update': update, 'update_cdap': update_cdap,
+                        'update_ownership': update_ownership}
+        self.workbooks = WORKBOOKS
+        for template in preload or []:
+            with WORKBOOKS.checkout(template):
+                pass
+        self.startup = perf_counter() - start
+
+    def handle(self, request):
+        """Answer a request.
+
+        Parameters
+        ----------
+        request : dict
+            'command' and its keyword arguments under 'kwargs'. The commands
+            are 'update' (update.update), 'update_cdap'
+            (update_cdap.update_cdap), 'update_ownership'
+            (update_ownership.update_auto_ownership), 'stats', 'release'
+            (drop the cached workbooks) and 'stop'.
+
+        Returns
+        -------
+        reply : dict
+            'result' holds the value returned by the command.
+
+        Raises
+        ------
+        ServiceError
+            If the command is unknown.
+
+        """
+        command, kwargs = request.get('command'), request.get('kwargs', {})
+        update = self.modules['update']
+        if command == 'update':
+            return {'result': update.update(**kwargs)}
+        if command == 'update_cdap':
+            return {'result': self.modules['update_cdap'].update_cdap(
+                **kwargs)}
+        if command == 'update_ownership':
+            return {'result': self.modules['update_ownership']
+                    .update_auto_ownership(**kwargs)}
+        if command == 'stats':
+            return {'result': {
+                'served': self.served, 'startup': self.startup,
+                'templates': sorted(self.workbooks.templates),
+                'uecs': sorted(update.READ_CACHE.books),
+                'uec_hits': update.READ_CACHE.hits,
+                'uec_misses': update.READ_CACHE.misses}}
+        if command == 'release':
+            update.READ_CACHE.release()
+            self.workbooks.release()
+            return {'result': None}
+        if command == 'stop':
+            return {'result': None}
+        raise ServiceError('Unknown command {!r}.'.format(command))
+
+    def serve(self):
+        """Answer requests until a stop request arrives.
+
+        Raises
+        ------
+        ServiceError
+            If the default socket's directory can be opened by other users.
+
+        """
+        if sys.platform != 'win32':
+            if self.address == ADDRESS:
+                _private_directory(os.path.dirname(ADDRESS))
+            if os.path.exists(self.address):
+                os.remove(self.address)
+        with Listener(self.address, authkey=self.authkey) as listener:
+            if sys.platform != 'win32':
+                os.chmod(self.address, 0o600)
+            print('Serving calibration updates on {} (started in {:.2f} s).'
+                  .format(self.address, self.startup))
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, OSError, EOFError):
+                    # A client that failed authentication or hung up.
+                    continue
+                with conn:
+                    try:
+                        message = json.loads(conn.recv_bytes().decode())
+                    except (OSError, EOFError, ValueError):
+                        continue
+                    if not isinstance(message, dict):
+                        continue
+                    start = perf_counter()
+                    try:
+                        reply = self.handle(message)
+                    except Exception as exc:
+                        reply = {'error': '{}: {}'.format(
+                            type(exc).__name__, exc)}
+                    reply['seconds'] = perf_counter() - start
+                    self.served += 1
+                    try:
+                        conn.send_bytes(json.dumps(
+                            reply, default=_encode).encode())
+                    except OSError:
+                        pass
+                if message.get('command') == 'stop':
+                    return
+
+
+def request(command, address=ADDRESS, authkey=None, **kwargs):
+    """Send a request to a running service and wait for its reply.
+
+    Parameters
+    ----------
+    command : str
+        The command, see Service.handle.
+    address : str, default : ADDRESS
+        The address the service listens on.
+    authkey : bytes, default : None
+        The service's key. Defaults to the key of default_authkey.
+    **kwargs
+        The keyword arguments of the command.
+
+    Returns
+    -------
+    result
+        The value returned by the command, with pandas objects as lists of
+        [label, value] pairs.
+
+    Raises
+    ------
+    ServiceError
+        If the command failed in the service.
+
+    """
+    with Client(address, authkey=authkey or default_authkey()) as conn:
+        conn.send_bytes(json.dumps({'command': command,
+                                    'kwargs': kwargs}).encode())
+        reply = json.loads(conn.recv_bytes().decode())
+    if 'error' in reply:
+        raise ServiceError(reply['error'])
+    return reply['result']
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='Run calibration updates in a resident service.')
+    PARSER.add_argument(
+        '-a', '--address', metavar='Address', type=str, default=ADDRESS,
+        help='The socket, or named pipe on Windows, of the service.')
+    PARSER.add_argument(
+        '-k', '--authkey', metavar='Authkey', type=str,
+        help='The key clients have to hold to use the service. Defaults to '
+        'the key kept in {}.'.format(KEY_FILE))
+    COMMANDS = PARSER.add_subparsers(dest='action')
+    COMMANDS.required = True
+    SERVE = COMMANDS.add_parser('serve', help='Start the service.')
+    SERVE.add_argument(
+        '-p', '--preload', metavar='Preload', type=str, nargs='*',
+        default=[], help='Calibration templates to parse at startup.')
+    UPDATE = COMMANDS.add_parser(
+        'update', help='Update a step from the results of a model run.')
+    UPDATE.add_argument(
+        'iteration', metavar='Iteration', type=int,
+        help='The calibration iteration number.')
+    UPDATE.add_argument(
+        '-ip', '--input_path', metavar='Input_Path', type=str, default='.',
+        help='The path to the directory containing the output and uec '
+        'directories.')
+    UPDATE.add_argument(
+        '-op', '--output_path', metavar='Output_Path', type=str,
+        required=True, help='The path to the directory containing the '
+        'step\'s calibration files.')
+    UPDATE.add_argument(
+        '-m', '--method', metavar='Method', type=str, default='AO',
+        choices=['AO', 'CDAP'], help='The calibration step.')
+    UPDATE.add_argument(
+        '-cs', '--chunksize', metavar='Chunksize', type=int,
+        help='Count csv archives in chunks of this many rows.')
+    UPDATE.add_argument(
+        '-e', '--engine', metavar='Engine', type=str, default='python',
+        choices=['python', 'excel'], help='The engine used to execute the '
+        'calibration workbook formulas.')
+    UPDATE.add_argument(
+        '-ar', '--archive', metavar='Archive', type=str, default='parquet',
+        choices=['parquet', 'csv'], help='How the results file is kept. '
+        'Parquet requires pyarrow.')
+    COMMANDS.add_parser('stats', help='Show what the service has cached.')
+    COMMANDS.add_parser('release', help='Drop the cached workbooks.')
+    COMMANDS.add_parser('stop', help='Stop the service.')
+    ARGS = PARSER.parse_args()
+    AUTHKEY = ARGS.authkey.encode() if ARGS.authkey else None
+    if ARGS.action == 'serve':
+        try:
+            Service(ARGS.address, authkey=AUTHKEY,
+                    preload=ARGS.preload).serve()
+        except ServiceError as exc:
+            PARSER.exit(1, 'Can not serve: {}\n'.format(exc))
+    else:
+        KWARGS = {}
+        if ARGS.action == 'update':
+            # The service resolves paths from its own working directory.
+            KWARGS = {'iter_': ARGS.iteration,
+                      'input_path': os.path.abspath(ARGS.input_path),
+                      'output_path': os.path.abspath(ARGS.output_path),
+                      'method': ARGS.method,
+                      'chunksize': ARGS.chunksize, 'engine': ARGS.engine,
+                      'archive': ARGS.archive}
+        try:
+            RESULT = request(ARGS.action, address=ARGS.address,
+                             authkey=AUTHKEY, **KWARGS)
+        except (AuthenticationError, ServiceError, OSError) as exc:
+            PARSER.exit(1, 'Request failed: {}\n'.format(exc))
+        if ARGS.action == 'update':
+            print('{} constants: {}'.format(ARGS.method, ', '.join(
+                '{:.4f}'.format(const or 0) for const in RESULT['after'])))
+        elif RESULT is not None:
+            print(json.dumps(RESULT, indent=1))
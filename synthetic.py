@@ -0,0 +1,327 @@
+"""This module generates synthetic sandag_abm outputs.
+
+The files have the columns and labels of the real aoResults and personData
+outputs. Choices are drawn from logit models whose alternative specific
+constants are read from the AutoOwnership and CoordinatedDailyActivityPattern
+UECs, at the cells the calibration updates, so a calibration run against the
+synthetic model responds to the constants it writes.
+
+It can also write the UECs and calibration workbooks themselves, with the cell
+layouts update_ao and update_cdap expect, so the whole update can be run and
+benchmarked without the model inputs.
+
+"""
+
+import argparse
+import os
+import os.path as osp
+from time import sleep
+
+import numpy as np
+from openpyxl import Workbook
+import pandas as pd
+from xlrd import open_workbook
+import xlwt
+
+
+PERSON_TYPES = ['Full-time worker', 'Part-time worker', 'University Student',
+                'Non-worker', 'Retired', 'Student of driving age',
+                'Student of non-driving age', 'Child too young for school']
+TYPE_SHARES = [0.36, 0.1, 0.06, 0.12, 0.13, 0.05, 0.12, 0.06]
+NON_MANDATORY = ['Non-worker', 'Retired']
+CDAP_ROWS = ['University Student', 'Student of driving age',
+             'Full-time worker', 'Student of non-driving age', 'Non-worker',
+             'Retired', 'Part-time worker', 'Child too young for school']
+AO_UTILITY = np.array([0.0, 1.2, 1.4, 0.6, 0.2])
+CDAP_UTILITY = {'M': 0.8, 'N': 0.1}
+AO_TARGETS = [0.05, 0.3, 0.4, 0.17, 0.08]
+CDAP_TARGETS = {'H': 0.3, 'M': 0.4, 'N': 0.3}
+CDAP_NAMES = ['College Student', 'Driving Age Student', 'Full-time worker',
+              'Non-driving Student', 'Non-working Adult', 'Non-working Senior',
+              'Part-time worker', 'Pre-school']
+# The ranges of the segment labels and targets of the calibration workbooks,
+# for calibrate's target_ranges
+TARGET_RANGES = {'AO': (('_data', 'A2:A6'), ('AO', 'C4:C8')),
+                 'CDAP': (('CDAP', 'B30:B37'), ('CDAP', 'K30:M37'))}
+
+
+def _choose(rng, utilities, size):
+    """Draw alternatives from a multinomial logit model."""
+    exp = np.exp(utilities - np.max(utilities))
+    return rng.choice(len(utilities), size=size, p=exp / exp.sum())
+
+
+def read_constants(uec_dir):
+    """Read the calibrated constants the synthetic model responds to.
+
+    Parameters
+    ----------
+    uec_dir : str
+        Path to the directory containing the uec files. Missing files leave
+        the constants at zero.
+
+    Returns
+    -------
+    ao : numpy.ndarray
+        Constants of the five auto ownership alternatives.
+    cdap : dict
+        Constants of the M and N patterns for each person type.
+
+    """
+    ao = np.zeros(5)
+    cdap = {person_type: {'M': 0.0, 'N': 0.0} for person_type in CDAP_ROWS}
+    path = osp.join(uec_dir, 'AutoOwnership.xls')
+    if osp.exists(path):
+        sheet = open_workbook(path).sheet_by_index(1)
+        ao = np.array([sheet.cell_value(rowx=81, colx=6 + idx) or 0
+                       for idx in range(5)], dtype=float)
+    path = osp.join(uec_dir, 'CoordinatedDailyActivityPattern.xls')
+    if osp.exists(path):
+        sheet = open_workbook(path).sheet_by_index(1)
+        for idx, person_type in enumerate(CDAP_ROWS):
+            cdap[person_type] = {
+                'M': sheet.cell_value(rowx=88 + idx, colx=6) or 0,
+                'N': sheet.cell_value(rowx=88 + idx, colx=7) or 0}
+    return ao, cdap
+
+
+def write_ao_results(filename, rows, constants=None, seed=0,
+                     chunksize=1000000):
+    """Write a synthetic aoResults file.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the file to write.
+    rows : int
+        The number of households.
+    constants : array-like, default : None
+        Constants added to the utility of each auto ownership level.
+    seed : int, default : 0
+        Seed of the random number generator.
+    chunksize : int, default : 1000000
+        The number of rows generated and written at a time.
+
+    """
+    rng = np.random.default_rng(seed)
+    utilities = AO_UTILITY + (0 if constants is None else
+                              np.asarray(constants, dtype=float))
+    for start in range(0, rows, chunksize):
+        size = min(chunksize, rows - start)
+        frame = pd.DataFrame({'HHID': np.arange(start + 1, start + size + 1),
+                              'AO': _choose(rng, utilities, size)})
+        frame.to_csv(filename, index=False, mode='w' if start == 0 else 'a',
+                     header=start == 0)
+
+
+def write_person_data(filename, rows, constants=None, seed=0,
+                      chunksize=1000000):
+    """Write a synthetic personData file.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the file to write.
+    rows : int
+        The number of persons.
+    constants : dict, default : None
+        Constants of the M and N patterns for each person type, as returned
+        by read_constants.
+    seed : int, default : 0
+        Seed of the random number generator.
+    chunksize : int, default : 1000000
+        The number of rows generated and written at a time.
+
+    """
+    rng = np.random.default_rng(seed)
+    constants = constants or {}
+    for start in range(0, rows, chunksize):
+        size = min(chunksize, rows - start)
+        types = rng.choice(len(PERSON_TYPES), size=size, p=TYPE_SHARES)
+        patterns = np.empty(size, dtype=object)
+        for idx, person_type in enumerate(PERSON_TYPES):
+            mask = types == idx
+            const = constants.get(person_type, {})
+            alternatives = ['H', 'N'] if person_type in NON_MANDATORY else \
+                ['H', 'M', 'N']
+            utilities = np.array([
+                0 if alt == 'H' else CDAP_UTILITY[alt] + const.get(alt, 0)
+                for alt in alternatives])
+            patterns[mask] = np.array(alternatives)[
+                _choose(rng, utilities, mask.sum())]
+        ids = np.arange(start + 1, start + size + 1)
+        frame = pd.DataFrame({
+            'hh_id': (ids + 1) // 2, 'person_id': ids,
+            'person_num': 2 - ids % 2,
+            'age': rng.integers(0, 95, size=size),
+            'gender': rng.choice(['m', 'f'], size=size),
+            'type': np.array(PERSON_TYPES)[types],
+            'value_of_time': rng.gamma(2.0, 8.0, size=size).round(2),
+            'activity_pattern': patterns,
+            'imf_choice': rng.integers(0, 4, size=size),
+            'inmf_choice': rng.integers(0, 37, size=size)})
+        frame.to_csv(filename, index=False, mode='w' if start == 0 else 'a',
+                     header=start == 0)
+
+
+def write_uecs(uec_dir):
+    """Write AutoOwnership and CoordinatedDailyActivityPattern UECs.
+
+    The second sheet of each workbook is filled with labels in its first six
+    columns and zeros after them, so the constants update_ao and update_cdap
+    write start at zero.
+
+    Parameters
+    ----------
+    uec_dir : str
+        Path to the directory to write the uec files to.
+
+    """
+    os.makedirs(uec_dir, exist_ok=True)
+    for name in ('AutoOwnership', 'CoordinatedDailyActivityPattern'):
+        book = xlwt.Workbook()
+        book.add_sheet('Header')
+        sheet = book.add_sheet('Model')
+        for row in range(100):
+            for col in range(12):
+                sheet.write(row, col,
+                            'Term {}'.format(row) if col < 6 else 0.0)
+        book.save(osp.join(uec_dir, '{}.xls'.format(name)))
+
+
+def write_calibration_workbooks(output_path):
+    """Write the AO and CDAP calibration workbooks.
+
+    The formulas move each constant by the log ratio of its target and
+    modeled share, relative to the first alternative, reading the counts
+    from the `_data` sheet and the previous constants from the inputs
+    update_ao and update_cdap fill in. The labels and targets are at
+    TARGET_RANGES, the targets of the H, M and N patterns of each person type
+    in CDAP!K30:M37.
+
+    Parameters
+    ----------
+    output_path : str
+        Path to the directory to create the `1_AO` and `2_CDAP` calibration
+        directories in.
+
+    """
+    os.makedirs(osp.join(output_path, '1_AO'), exist_ok=True)
+    os.makedirs(osp.join(output_path, '2_CDAP'), exist_ok=True)
+
+    book = Workbook()
+    sheet = book.active
+    sheet.title = 'AO'
+    data = book.create_sheet('_data')
+    for idx, target in enumerate(AO_TARGETS):
+        row = 4 + idx
+        data.cell(row=2 + idx, column=1).value = idx
+        data.cell(row=2 + idx, column=2).value = 1
+        sheet['C{}'.format(row)] = target
+        sheet['E{}'.format(row)] = \
+            '=_data!B{}/SUM(_data!$B$2:$B$6)'.format(2 + idx)
+        sheet['K{}'.format(row)] = 0
+        sheet['L{0}'.format(row)] = \
+            '=K{0}+LN(C{0}/E{0})-(K$4+LN(C$4/E$4))'.format(row)
+    book.save(osp.join(output_path, '1_AO', '1_AO Calibration.xlsx'))
+
+    book = Workbook()
+    sheet = book.active
+    sheet.title = 'CDAP'
+    data = book.create_sheet('_data')
+    row = 2
+    for name in CDAP_NAMES:
+        for pattern in CDAP_TARGETS:
+            if pattern == 'M' and name.startswith('Non-working'):
+                continue
+            data.cell(row=row, column=3).value = name
+            data.cell(row=row, column=4).value = pattern
+            data.cell(row=row, column=5).value = 1
+            row += 1
+    for idx, name in enumerate(CDAP_NAMES):
+        row = 30 + idx
+        sheet['B{}'.format(row)] = name
+        sheet['C{}'.format(row)] = 0
+        sheet['D{}'.format(row)] = 0
+        targets = dict(CDAP_TARGETS)
+        if name.startswith('Non-working'):
+            # Without a mandatory pattern the other two keep their ratio.
+            scale = 1 - targets.pop('M')
+            targets = {pattern: share / scale
+                       for pattern, share in targets.items()}
+        for col, pattern in zip('FGH', CDAP_TARGETS):
+            sheet['{}{}'.format(col, row)] = (
+                '=SUMIFS(_data!$E:$E,_data!$C:$C,$B{0},_data!$D:$D,"{1}")/'
+                'SUMIFS(_data!$E:$E,_data!$C:$C,$B{0})'.format(row, pattern))
+        for col, pattern in zip('KLM', CDAP_TARGETS):
+            sheet['{}{}'.format(col, row)] = targets.get(pattern, 0)
+        sheet['I{}'.format(row)] = \
+            '=IF(G{0}>0,C{0}+LN(L{0}/G{0})-LN(K{0}/F{0}),C{0})'.format(row)
+        sheet['J{}'.format(row)] = \
+            '=D{0}+LN(M{0}/H{0})-LN(K{0}/F{0})'.format(row)
+    book.save(osp.join(output_path, '2_CDAP', '2_CDAP Calibration.xlsx'))
+
+
+def run_model(input_path, rows=100000, start_iter=1, sample_rates=None,
+              seed=0, duration=0):
+    """Stand in for a sandag_abm run by writing synthetic outputs.
+
+    Parameters
+    ----------
+    input_path : str
+        The path to the directory containing the output and uec directories.
+    rows : int, default : 100000
+        The number of persons at a sample rate of 1. Households are half as
+        many.
+    start_iter : int, default : 1
+        The first global iteration to run.
+    sample_rates : str, default : None
+        Comma separated sample rates of the three global iterations.
+    seed : int, default : 0
+        Seed of the random number generator.
+    duration : float, default : 0
+        Seconds to wait between iterations, to mimic model runtime.
+
+    """
+    rates = [float(rate) for rate in
+             (sample_rates or '0.2,0.5,1.0').split(',')]
+    output = osp.join(input_path, 'output')
+    os.makedirs(output, exist_ok=True)
+    ao, cdap = read_constants(osp.join(input_path, 'uec'))
+    for iteration in range(start_iter, 4):
+        persons = max(int(rows * rates[iteration - 1]), 1)
+        sleep(duration)
+        if iteration == start_iter:
+            write_ao_results(osp.join(output, 'aoResults.csv'),
+                             max(persons // 2, 1), ao, seed=seed)
+        write_person_data(
+            osp.join(output, 'personData_{}.csv'.format(iteration)), persons,
+            cdap, seed=seed + iteration)
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='Write synthetic sandag_abm outputs.')
+    PARSER.add_argument(
+        'input_path', metavar='Input_Path', type=str,
+        help='The path to the directory containing the output and uec '
+        'directories.')
+    PARSER.add_argument(
+        '-r', '--rows', metavar='Rows', type=int, default=100000,
+        help='The number of persons at a sample rate of 1.')
+    PARSER.add_argument(
+        '-si', '--start_iter', metavar='Start_Iteration', type=int,
+        default=1, help='The first global iteration to run.')
+    PARSER.add_argument(
+        '-sr', '--sample_rates', metavar='Sample_Rates', type=str,
+        help='Comma separated sample rates of the three global iterations.')
+    PARSER.add_argument(
+        '-s', '--seed', metavar='Seed', type=int, default=0,
+        help='Seed of the random number generator.')
+    PARSER.add_argument(
+        '-d', '--duration', metavar='Duration', type=float, default=0,
+        help='Seconds to wait between iterations.')
+    ARGS = PARSER.parse_args()
+    run_model(ARGS.input_path, rows=ARGS.rows, start_iter=ARGS.start_iter,
+              sample_rates=ARGS.sample_rates, seed=ARGS.seed,
+              duration=ARGS.duration)
@@ -0,0 +1,189 @@
+"""This module samples the resource use of the model while it runs.
+
+A ProcessSampler polls the process the runner started and all of its
+children (TransCAD, Java, the matrix servers) on a background thread. Each
+sample of each process is appended to a csv time series as it is taken, and
+only running totals are kept in memory for the summary, so memory use does not
+grow with the length of the run. The summary reports the peak and average of
+the tree's total CPU, resident memory and thread count, the bytes read and
+written, and the peaks of each process name, which shows whether a run is
+bound by CPU, memory or disk.
+
+"""
+
+import csv
+import json
+import threading
+from time import time
+
+import psutil
+
+
+FIELDS = ['time', 'pid', 'name', 'cpu', 'rss', 'read_bytes', 'write_bytes',
+          'threads']
+
+
+class ProcessSampler():
+    """Record the resource use of a process tree at a fixed interval.
+
+    Parameters
+    ----------
+    pid : int
+        The process id of the root of the tree.
+    filename : str
+        Path of the csv file the samples are written to.
+    interval : float, default : 5
+        The number of seconds between samples.
+
+    """
+
+    def __init__(self, pid, filename, interval=5):
+        self.pid = pid
+        self.filename = filename
+        self.interval = interval
+        self.procs = {}
+        self.io = {}
+        self.names = {}
+        self.totals = {'samples': 0, 'cpu': [0.0, 0.0], 'rss': [0, 0],
+                       'threads': [0, 0]}
+        self.start_time = None
+        self.end_time = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """Start sampling in the background."""
+        self.start_time = time()
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling."""
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.end_time = time()
+
+    def _tree(self):
+        """The processes of the tree, reusing the handles of earlier samples.
+
+        psutil measures the CPU use of a process since the previous call on
+        the same handle, so handles are kept for as long as the process runs.
+
+        """
+        try:
+            root = psutil.Process(self.pid)
+            current = [root] + root.children(recursive=True)
+        except psutil.NoSuchProcess:
+            current = []
+        procs = {}
+        for proc in current:
+            if proc.pid not in self.procs:
+                try:
+                    proc.cpu_percent(None)
+                except psutil.Error:
+                    continue
+            procs[proc.pid] = self.procs.get(proc.pid, proc)
+        self.procs = procs
+        return list(procs.values())
+
+    def sample(self, writer):
+        """Sample every process of the tree and write a row for each."""
+        now = time()
+        cpu = rss = threads = 0
+        for proc in self._tree():
+            try:
+                with proc.oneshot():
+                    name = proc.name()
+                    proc_cpu = proc.cpu_percent(None)
+                    proc_rss = proc.memory_info().rss
+                    proc_threads = proc.num_threads()
+                    try:
+                        counters = proc.io_counters()
+                        io = (counters.read_bytes, counters.write_bytes)
+                    except (AttributeError, psutil.AccessDenied):
+                        io = (None, None)
+            except psutil.Error:
+                continue
+            writer.writerow([round(now, 3), proc.pid, name,
+                             round(proc_cpu, 1), proc_rss, io[0], io[1],
+                             proc_threads])
+            if io[0] is not None:
+                self.io[proc.pid] = io
+            peak = self.names.setdefault(
+                name, {'cpu': 0.0, 'rss': 0, 'threads': 0})
+            peak['cpu'] = max(peak['cpu'], proc_cpu)
+            peak['rss'] = max(peak['rss'], proc_rss)
+            peak['threads'] = max(peak['threads'], proc_threads)
+            cpu += proc_cpu
+            rss += proc_rss
+            threads += proc_threads
+        for key, value in (('cpu', cpu), ('rss', rss), ('threads', threads)):
+            total = self.totals[key]
+            total[0] = max(total[0], value)
+            total[1] += value
+        self.totals['samples'] += 1
+
+    def _run(self):
+        with open(self.filename, 'w', newline='') as series:
+            writer = csv.writer(series)
+            writer.writerow(FIELDS)
+            while True:
+                self.sample(writer)
+                series.flush()
+                if self.stopped.wait(self.interval):
+                    break
+
+    def summary(self):
+        """Summarize the samples taken so far.
+
+        Returns
+        -------
+        summary : dict
+            The number of samples and seconds sampled, the peak and mean of
+            the tree's total CPU percent, resident bytes and threads, the
+            bytes read and written, and the peak CPU, resident bytes and
+            threads of each process name.
+
+        """
+        samples = self.totals['samples']
+        summary = {'samples': samples,
+                   'seconds': (self.end_time or time()) - self.start_time}
+        for key in ('cpu', 'rss', 'threads'):
+            peak, total = self.totals[key]
+            summary[key] = {'peak': peak,
+                            'mean': total / samples if samples else 0}
+        # The counters of each process start with the process, which the
+        # model run started, so the last values are the run's totals.
+        summary['read_bytes'] = sum(io[0] for io in self.io.values())
+        summary['write_bytes'] = sum(io[1] for io in self.io.values())
+        summary['processes'] = self.names
+        return summary
+
+
+def log_summary(filename, label, summary):
+    """Append a sampler summary to a JSON-lines file and print it.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the JSON-lines file.
+    label : str
+        Identifies the run, e.g. the steps and iteration.
+    summary : dict
+        The value returned by ProcessSampler.summary.
+
+    """
+    with open(filename, 'a') as log:
+        log.write(json.dumps(dict(summary, run=label, time=time())) + '\n')
+    print('{} model resources: CPU peak {:.0f}% mean {:.0f}%, memory peak '
+          '{:.2f} GB, read {:.2f} GB, written {:.2f} GB, threads peak {}'
+          .format(label, summary['cpu']['peak'], summary['cpu']['mean'],
+                  summary['rss']['peak'] / 1e9, summary['read_bytes'] / 1e9,
+                  summary['write_bytes'] / 1e9, summary['threads']['peak']))
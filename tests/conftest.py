@@ -0,0 +1,6 @@
+"""Make the calibration modules at the repository root importable."""
+
+import os.path as osp
+import sys
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
@@ -0,0 +1,189 @@
+"""Tests of counting model results with aggregate.py."""
+
+from collections import OrderedDict
+import os
+import os.path as osp
+
+import pandas as pd
+import pytest
+
+from aggregate import (CDAP_NAMES, TARGETS, CountCache, Target, _count_range,
+                       _counts, _merge, archive, read_archive, scan,
+                       split_ranges)
+from synthetic import write_ao_results, write_person_data
+
+
+ROWS = 3000
+
+PERSON_TARGETS = OrderedDict([
+    ('CDAP', TARGETS['CDAP']),
+    ('FT', Target('personData_{iteration}.csv', ['activity_pattern'],
+                  filters={'type': ['Full-time worker']}))])
+
+
+@pytest.fixture
+def person_data(tmp_path):
+    """A synthetic personData file."""
+    path = str(tmp_path / 'personData_3.csv')
+    write_person_data(path, ROWS, seed=1)
+    return path
+
+
+@pytest.fixture
+def ao_results(tmp_path):
+    """A synthetic aoResults file."""
+    path = str(tmp_path / 'aoResults.csv')
+    write_ao_results(path, ROWS, seed=2)
+    return path
+
+
+def baseline(filename, targets):
+    """Count each target by grouping the whole file with pandas."""
+    results = pd.read_csv(filename)
+    counts = {}
+    for name, target in targets.items():
+        rows = results
+        for column, values in target.filters.items():
+            rows = rows[rows[column].isin(values)]
+        rows = rows.replace(target.labels)
+        counts[name] = rows.groupby(target.columns).size().to_dict()
+    return counts
+
+
+def as_dicts(counts):
+    return {name: series.to_dict() for name, series in counts.items()}
+
+
+def test_baseline_relabels_types(person_data):
+    counts = baseline(person_data, {'CDAP': TARGETS['CDAP']})['CDAP']
+    types = {key[0] for key in counts}
+    assert set(CDAP_NAMES.values()) <= types
+    assert not set(CDAP_NAMES) & types
+
+
+@pytest.mark.parametrize('chunksize', [None, 1000, 777])
+def test_scan(person_data, chunksize):
+    counts = scan(person_data, PERSON_TARGETS, chunksize=chunksize)
+    assert as_dicts(counts) == baseline(person_data, PERSON_TARGETS)
+    assert counts['CDAP'].sum() == ROWS
+    assert counts['CDAP'].index.is_monotonic_increasing
+
+
+def test_scan_numeric_labels(ao_results):
+    targets = {'AO': TARGETS['AO']}
+    counts = scan(ao_results, targets, chunksize=500)
+    assert as_dicts(counts) == baseline(ao_results, targets)
+    assert counts['AO'].index.tolist() == sorted(counts['AO'].index)
+
+
+def test_archive(person_data, tmp_path):
+    dest = str(tmp_path / 'personData_3.parquet')
+    counts = archive(person_data, dest, PERSON_TARGETS, block_size=4096)
+    assert as_dicts(counts) == baseline(person_data, PERSON_TARGETS)
+    results = pd.read_csv(person_data)
+    archived = read_archive(dest)
+    pd.testing.assert_frame_equal(archived, results, check_dtype=False)
+    assert read_archive(dest, ['type']).columns.tolist() == ['type']
+    assert [path.name for path in tmp_path.iterdir()
+            if path.suffix == '.parquet'] == [osp.basename(dest)]
+
+
+def test_archive_late_text(tmp_path):
+    # The note column is empty in the first blocks, so it is inferred as
+    # null before any text appears.
+    path = str(tmp_path / 'aoResults.csv')
+    with open(path, 'w') as results:
+        results.write('HHID,AO,note\n')
+        for row in range(ROWS):
+            results.write('{},{},{}\n'.format(
+                row + 1, row % 5, 'x' if row > ROWS - 100 else ''))
+    dest = str(tmp_path / 'aoResults.parquet')
+    targets = {'AO': TARGETS['AO']}
+    counts = archive(path, dest, targets, block_size=4096)
+    assert as_dicts(counts) == baseline(path, targets)
+    archived = read_archive(dest)
+    assert len(archived) == ROWS
+    assert archived['note'].iloc[-1] == 'x'
+
+
+def test_cache_round_trip(person_data, tmp_path):
+    cache = CountCache(str(tmp_path / 'cache'))
+    counts = scan(person_data, PERSON_TARGETS)
+    for name, target in PERSON_TARGETS.items():
+        assert cache.get(person_data, target) is None
+        cache.put(person_data, target, counts[name])
+        cached = cache.get(person_data, target)
+        pd.testing.assert_series_equal(cached, counts[name])
+    assert len(cache.entries()) == len(PERSON_TARGETS)
+
+
+def test_cache_misses_changes(person_data, tmp_path):
+    cache = CountCache(str(tmp_path / 'cache'))
+    target = TARGETS['CDAP']
+    counts = scan(person_data, {'CDAP': target})['CDAP']
+    cache.put(person_data, target, counts)
+    relabeled = Target(target.filename, target.columns, labels={})
+    assert cache.get(person_data, relabeled) is None
+    assert cache.get(person_data, target) is not None
+    write_person_data(person_data, ROWS, seed=3)
+    assert cache.get(person_data, target) is None
+
+
+def test_cache_invalidate(person_data, ao_results, tmp_path):
+    cache = CountCache(str(tmp_path / 'cache'))
+    for filename, targets in ((person_data, PERSON_TARGETS),
+                              (ao_results, {'AO': TARGETS['AO']})):
+        counts = scan(filename, targets)
+        for name, target in targets.items():
+            cache.put(filename, target, counts[name])
+    assert cache.invalidate(person_data) == len(PERSON_TARGETS)
+    assert cache.get(person_data, TARGETS['CDAP']) is None
+    assert cache.get(ao_results, TARGETS['AO']) is not None
+    assert cache.invalidate() == 1
+    assert cache.entries() == []
+
+
+def test_cache_evicts_to_budget(person_data, tmp_path):
+    cache = CountCache(str(tmp_path / 'cache'))
+    counts = scan(person_data, PERSON_TARGETS)
+    cache.put(person_data, PERSON_TARGETS['CDAP'], counts['CDAP'])
+    (oldest, _, size), = cache.entries()
+    os.utime(oldest, (0, 0))
+    cache.budget = size
+    cache.put(person_data, PERSON_TARGETS['FT'], counts['FT'])
+    assert cache.get(person_data, PERSON_TARGETS['CDAP']) is None
+    assert cache.get(person_data, PERSON_TARGETS['FT']) is not None
+
+
+def test_split_ranges_at_line_boundaries(person_data):
+    with open(person_data, 'rb') as results:
+        data = results.read()
+    header, ranges = split_ranges(person_data, 3, range_bytes=10000)
+    assert header == data[:data.index(b'\n')].decode().split(',')
+    assert ranges[0][0] == data.index(b'\n') + 1
+    assert ranges[-1][1] == len(data)
+    assert len(ranges) >= len(data) // 10000
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+        assert data[end - 1:end] == b'\n'
+    # Some rows straddle the nominal boundaries the ranges were moved from.
+    nominal = [ranges[0][0] + (len(data) - ranges[0][0]) * part // len(ranges)
+               for part in range(1, len(ranges))]
+    assert any(data[offset - 1:offset] != b'\n' for offset in nominal)
+
+
+def test_count_ranges(person_data):
+    header, ranges = split_ranges(person_data, 3, range_bytes=10000)
+    totals = {name: {} for name in PERSON_TARGETS}
+    for start, end in ranges:
+        _merge(totals, _count_range(person_data, start, end, header,
+                                    PERSON_TARGETS))
+    counts = {name: _counts(totals[name], target)
+              for name, target in PERSON_TARGETS.items()}
+    assert as_dicts(counts) == baseline(person_data, PERSON_TARGETS)
+
+
+@pytest.mark.parametrize('workers', [2, 3])
+def test_scan_workers(person_data, workers):
+    counts = scan(person_data, PERSON_TARGETS, workers=workers)
+    assert as_dicts(counts) == baseline(person_data, PERSON_TARGETS)
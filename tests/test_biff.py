@@ -0,0 +1,120 @@
+"""Tests of writing UEC cells in place with biff.py."""
+
+import os.path as osp
+
+from xlrd import open_workbook
+import pytest
+
+from biff import PatchError, decode_rk, encode_rk, patch_cells
+from synthetic import write_uecs
+from update import UECEditor, read_values
+
+
+@pytest.fixture
+def uec(tmp_path):
+    """A synthetic AutoOwnership UEC, whose constants are RK cells."""
+    write_uecs(str(tmp_path))
+    return str(tmp_path / 'AutoOwnership.xls')
+
+
+def sheet_values(filename):
+    """Read the values of every cell of every sheet."""
+    book = open_workbook(filename)
+    try:
+        return [[sheet.row_values(row) for row in range(sheet.nrows)]
+                for sheet in book.sheets()]
+    finally:
+        book.release_resources()
+
+
+def read_bytes(filename):
+    with open(filename, 'rb') as workbook:
+        return workbook.read()
+
+
+@pytest.mark.parametrize('value', [0.0, 1.0, -3.0, 1.5, 0.25, 0.1, -12.34,
+                                   2 ** 28, 2.0 ** 100])
+def test_rk_round_trip(value):
+    rk = encode_rk(value)
+    assert rk is not None
+    assert decode_rk(rk) == value
+
+
+def test_rk_rejects_inexact_values():
+    assert encode_rk(0.123456789) is None
+
+
+def test_patch_reads_back(uec):
+    before = sheet_values(uec)
+    size = osp.getsize(uec)
+    patch_cells(uec, [(1, 81, 6, 1.5), (1, 81, 7, -2.0), (1, 82, 6, 0.1)])
+    assert read_values(uec, 81, 6, 2, axis=1) == [1.5, -2.0]
+    assert read_values(uec, 82, 6, 1) == [0.1]
+    after = sheet_values(uec)
+    before[1][81][6:8] = [1.5, -2.0]
+    before[1][82][6] = 0.1
+    assert after == before
+    assert osp.getsize(uec) == size
+
+
+def test_patch_to_another_file(uec, tmp_path):
+    dest = str(tmp_path / 'patched.xls')
+    original = read_bytes(uec)
+    patch_cells(uec, [(1, 81, 6, 2.0)], dest=dest)
+    assert read_bytes(uec) == original
+    assert read_values(dest, 81, 6, 1) == [2.0]
+
+
+@pytest.mark.parametrize('cell, message', [
+    ((1, 81, 2, 1.0), 'text'),
+    ((1, 150, 6, 1.0), 'empty'),
+    ((5, 1, 1, 1.0), 'no sheet'),
+    ((1, 81, 6, 'x'), 'not a number'),
+    ((1, 81, 6, 0.123456789), 'does not fit'),
+])
+def test_patch_errors_leave_the_file(uec, cell, message):
+    original = read_bytes(uec)
+    with pytest.raises(PatchError, match=message):
+        # The valid first cell is not written either.
+        patch_cells(uec, [(1, 82, 6, 1.0), cell])
+    assert read_bytes(uec) == original
+
+
+def test_patch_rejects_other_files(tmp_path):
+    path = str(tmp_path / 'text.xls')
+    with open(path, 'w') as text:
+        text.write('AO,count\n')
+    with pytest.raises(PatchError):
+        patch_cells(path, [(1, 1, 1, 1.0)])
+
+
+def test_editor_falls_back_to_rewrite(uec):
+    with pytest.raises(PatchError):
+        patch_cells(uec, [(1, 81, 6, 0.123456789)])
+    with UECEditor(uec) as editor:
+        editor.write(81, 6, [0.123456789, -2.5], axis=1)
+        editor.write(88, 6, [0.75])
+    assert read_values(uec, 81, 6, 3, axis=1) == [0.123456789, -2.5, 0.0]
+    assert read_values(uec, 88, 6, 1) == [0.75]
+    # The rewrite stores full doubles, which later writes patch in place.
+    patch_cells(uec, [(1, 81, 6, 0.987654321)])
+    assert read_values(uec, 81, 6, 1) == [0.987654321]
+
+
+def test_editor_matches_rewrite(uec, tmp_path):
+    copy = str(tmp_path / 'copy.xls')
+    with open(copy, 'wb') as dest:
+        dest.write(read_bytes(uec))
+    for path, in_place in ((uec, True), (copy, False)):
+        with UECEditor(path, in_place=in_place) as editor:
+            editor.write(81, 6, [0.5, 1.25, -1.0, 2.0, 0.0], axis=1)
+    assert sheet_values(uec) == sheet_values(copy)
+
+
+def test_editor_discards_writes_on_error(uec):
+    original = read_bytes(uec)
+    with pytest.raises(RuntimeError):
+        with UECEditor(uec) as editor:
+            editor.write(81, 6, [1.0])
+            raise RuntimeError
+    assert read_bytes(uec) == original
@@ -0,0 +1,42 @@
+"""Tests of resuming a calibration from its checkpoint."""
+
+import pytest
+
+from checkpoint import Checkpoint, CheckpointError
+from synthetic import write_uecs
+from update import uec_constants, write_uec_constants
+
+
+NEW = [0.0, 0.5, 0.25, -0.5, 1.0]
+
+
+@pytest.fixture
+def uec(tmp_path):
+    """A synthetic AutoOwnership UEC, whose constants are all zero."""
+    write_uecs(str(tmp_path))
+    return str(tmp_path / 'AutoOwnership.xls')
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'checkpoint.json')
+
+
+@pytest.mark.parametrize('written', [False, True])
+def test_interrupted_write_is_undone(uec, path, written):
+    checkpoint = Checkpoint(path)
+    checkpoint.record_write('AO', 0, uec, NEW)
+    if written:
+        write_uec_constants(uec, NEW, 'AO')
+    resumed = Checkpoint.load(path)
+    resumed.validate({})
+    assert resumed.rollback() == ['AO']
+    assert uec_constants(uec, 'AO') == [0.0] * 5
+    assert Checkpoint.load(path).writes == {}
+
+
+def test_other_constants_are_refused(uec, path):
+    Checkpoint(path).record_write('AO', 0, uec, NEW)
+    write_uec_constants(uec, [1.0] * 5, 'AO')
+    with pytest.raises(CheckpointError, match='changed during iteration 0'):
+        Checkpoint.load(path).validate({})
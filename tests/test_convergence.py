@@ -0,0 +1,51 @@
+"""Tests of checking convergence against the workbook's targets."""
+
+import os.path as osp
+
+import pandas as pd
+import pytest
+
+from convergence import evaluate
+from schedule import SampleSchedule
+from synthetic import AO_TARGETS, TARGET_RANGES, write_calibration_workbooks
+
+
+@pytest.fixture
+def result(tmp_path):
+    """An AO update whose counts are at the synthetic workbook's targets."""
+    write_calibration_workbooks(str(tmp_path))
+    counts = pd.Series([int(target * 1000) for target in AO_TARGETS],
+                       index=pd.Index(range(5), name='AO'))
+    return {'counts': counts, 'before': [0.0] * 5, 'after': [0.01] * 5,
+            'cal_path': osp.join(str(tmp_path), '1_AO',
+                                 '1_AO Calibration.xlsx')}
+
+
+def test_converged_at_targets(result):
+    metrics = evaluate('AO', result, ranges=TARGET_RANGES['AO'])
+    assert metrics['max_gap'] == pytest.approx(0)
+    assert metrics['segments']['AO']['targets'] == dict(
+        zip('01234', AO_TARGETS))
+    assert metrics['converged']
+
+
+@pytest.mark.parametrize('ranges, message', [
+    (None, 'No target ranges'),
+    ((('_data', 'A2:A5'), ('AO', 'C4:C7')), 'no targets for 4'),
+    ((('Targets', 'A2:A6'), ('AO', 'C4:C8')), 'Targets'),
+])
+def test_unchecked_without_targets(result, ranges, message):
+    with pytest.warns(UserWarning, match=message):
+        metrics = evaluate('AO', result, ranges=ranges)
+    assert metrics['segments'] == {}
+    assert metrics['max_gap'] is None
+    assert metrics['max_change'] == pytest.approx(0.01)
+    assert not metrics['converged']
+
+
+def test_schedule_moves_up_without_gaps(result):
+    schedule = SampleSchedule([0.25, 1.0])
+    with pytest.warns(UserWarning):
+        metrics = evaluate('AO', result)
+    assert schedule.record([metrics]) == 1.0
+    assert schedule.history[-1]['max_gap'] is None
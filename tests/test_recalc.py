@@ -0,0 +1,138 @@
+"""Tests of the formula engine in recalc.py."""
+
+import math
+import os.path as osp
+
+from openpyxl import Workbook, load_workbook
+import pytest
+
+from recalc import Calculator, CellError, recalculate
+from synthetic import AO_TARGETS, write_calibration_workbooks
+from update import calculate
+
+
+FORMULAS = {
+    'B1': ('=1+2*3^2', 19),
+    'B2': ('=-2^2', 4),
+    'B3': ('=(1+2)*3', 9),
+    'B4': ('=SUM(A1:A3)', 9),
+    'B5': ('=B4*2', 18),
+    'B6': ('="a"&"b"', 'ab'),
+    'B7': ('=A1<>A2', True),
+    'B8': ('=IF(A1>1,LN(A3),0)', math.log(4)),
+    'B9': ('=SUMIFS(A1:A3,A1:A3,">2")', 7),
+    'B10': ('=INDEX(A1:A3,MATCH(3,A1:A3,0))', 3),
+    'B11': ('=ROUND(2.345,2)', 2.35),
+    'B12': ('=AVERAGE(A1:A3)', 3),
+    'B13': ('=A1/0', '#DIV/0!'),
+    'B14': ('=B13+1', '#DIV/0!'),
+}
+
+
+@pytest.fixture
+def sheet_path(tmp_path):
+    """A workbook with inputs in A1:A3 and the FORMULAS in column B."""
+    book = Workbook()
+    sheet = book.active
+    sheet.title = 'S'
+    for row, value in enumerate([2, 3, 4], 1):
+        sheet.cell(row=row, column=1).value = value
+    for ref, (formula, _) in FORMULAS.items():
+        sheet[ref] = formula
+    sheet['C1'] = '=A1*10'
+    path = str(tmp_path / 'formulas.xlsx')
+    book.save(path)
+    return path
+
+
+def test_formulas(sheet_path):
+    calc = recalculate(sheet_path)
+    for ref, (formula, expected) in FORMULAS.items():
+        assert calc.get_values('S', ref) == [pytest.approx(expected)], \
+            formula
+
+
+def test_errors_are_cell_errors(sheet_path):
+    calc = recalculate(sheet_path)
+    value = calc.get_values('S', 'B14')[0]
+    assert isinstance(value, CellError)
+
+
+def test_cached_values_are_written(sheet_path):
+    recalculate(sheet_path)
+    sheet = load_workbook(sheet_path, data_only=True)['S']
+    for ref, (formula, expected) in FORMULAS.items():
+        assert sheet[ref].value == pytest.approx(expected), formula
+    # The formulas themselves are kept.
+    assert load_workbook(sheet_path)['S']['B4'].value == '=SUM(A1:A3)'
+
+
+def test_only_dependents_are_evaluated(sheet_path):
+    recalculate(sheet_path)
+    calc = Calculator(load_workbook(sheet_path),
+                      load_workbook(sheet_path, data_only=True))
+    calc.set_values('S', 'A2', [13])
+    # B4, B7, B9, B10 and B12 read A2, B5 reads B4, and C1 reads neither.
+    assert calc.dirty == {('S', row, 2) for row in (4, 5, 7, 9, 10, 12)}
+    assert calc.recalculate() == 6
+    assert calc.get_values('S', 'B4:B5') == [19, 38]
+    assert calc.get_values('S', 'C1') == [20]
+
+
+def test_changed_ranges_against_base(sheet_path, tmp_path):
+    recalculate(sheet_path)
+    book = load_workbook(sheet_path)
+    book['S']['A1'] = 5
+    changed = str(tmp_path / 'changed.xlsx')
+    book.save(changed)
+    calc = recalculate(changed, base=sheet_path, changed=[('S', 'A1')])
+    assert calc.get_values('S', 'B4') == [12]
+    assert calc.get_values('S', 'C1') == [50]
+    sheet = load_workbook(changed, data_only=True)['S']
+    assert sheet['B5'].value == 24
+    assert sheet['B8'].value == pytest.approx(math.log(4))
+
+
+@pytest.fixture
+def calibration(tmp_path):
+    """The synthetic AO and CDAP calibration workbooks."""
+    write_calibration_workbooks(str(tmp_path))
+    return str(tmp_path)
+
+
+def test_ao_workbook(calibration):
+    template = osp.join(calibration, '1_AO', '1_AO Calibration.xlsx')
+    cal_path = osp.join(calibration, '1_AO', '1_AO Calibration_0.xlsx')
+    counts = [10, 40, 30, 15, 5]
+    constants = [0, 0.5, -0.25, 1, 2]
+    values = calculate(template, cal_path, [(('_data', 'B2:B6'), counts),
+                                            (('AO', 'K4:K8'), constants)],
+                       ('AO', 'L4:L8'))
+    shares = [count / sum(counts) for count in counts]
+    expected = [const + math.log(target / share) -
+                math.log(AO_TARGETS[0] / shares[0])
+                for const, target, share in zip(constants, AO_TARGETS,
+                                                shares)]
+    assert values == pytest.approx(expected)
+    saved = load_workbook(cal_path, data_only=True)['AO']
+    assert [saved['L{}'.format(row)].value for row in range(4, 9)] == \
+        pytest.approx(expected)
+
+
+def test_cdap_workbook_matches_full_recalculation(calibration, tmp_path):
+    template = osp.join(calibration, '2_CDAP', '2_CDAP Calibration.xlsx')
+    cal_path = osp.join(calibration, '2_CDAP', '2_CDAP Calibration_0.xlsx')
+    counts = list(range(5, 27))
+    constants = [idx / 10 for idx in range(16)]
+    values = calculate(template, cal_path, [(('_data', 'E2:E23'), counts),
+                                            (('CDAP', 'C30:D37'), constants)],
+                       ('CDAP', 'I30:J37'))
+    full = str(tmp_path / 'full.xlsx')
+    book = load_workbook(template)
+    for cell, count in zip(book['_data']['E'][1:23], counts):
+        cell.value = count
+    for idx, const in enumerate(constants):
+        book['CDAP'].cell(row=30 + idx // 2, column=3 + idx % 2).value = const
+    book.save(full)
+    assert values == pytest.approx(
+        recalculate(full).get_values('CDAP', 'I30:J37'))
@@ -0,0 +1,42 @@
+"""Tests of timing the calibration workbooks of each update."""
+
+import os.path as osp
+import threading
+
+from synthetic import write_calibration_workbooks
+from workbooks import WorkbookManager
+
+
+def test_timings_per_thread(tmp_path):
+    write_calibration_workbooks(str(tmp_path))
+    templates = [osp.join(str(tmp_path), '1_AO', '1_AO Calibration.xlsx'),
+                 osp.join(str(tmp_path), '2_CDAP', '2_CDAP Calibration.xlsx')]
+    manager = WorkbookManager()
+    barrier = threading.Barrier(len(templates))
+    timings = {}
+
+    def work(template):
+        with manager.timed() as collected:
+            barrier.wait()
+            with manager.checkout(template):
+                pass
+            manager.read(template, '_data', 'A1:A2')
+            barrier.wait()
+        timings[template] = collected
+
+    threads = [threading.Thread(target=work, args=(template,))
+               for template in templates]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for template in templates:
+        assert [(timing['operation'], timing['path'])
+                for timing in timings[template]] == [('load', template),
+                                                     ('read', template)]
+    # Nothing is collected outside a timed block.
+    manager.read(templates[0], '_data', 'A1:A2')
+    with manager.timed() as outer:
+        with manager.timed() as inner:
+            manager.read(templates[0], '_data', 'A1:A2')
+    assert len(outer) == len(inner) == 1
@@ -0,0 +1,192 @@
+"""This module records where the time of a calibration run goes.
+
+Each stage of a run (launching and setting up the model, waiting for its
+results, tearing it down, copying, parsing and counting the results, loading,
+recalculating and saving the workbooks, writing the UECs) is recorded as a
+span: one JSON object per line with the run, stage, start and end timestamps,
+duration and any file sizes or row counts the stage knows about. Spans opened
+inside another span on the same thread record its id as their parent.
+
+Tracing is off until `configure` is given a file. The summary command
+aggregates the spans of any number of trace files by stage:
+
+    python tracing.py summary trace.jsonl [trace.jsonl ...]
+
+"""
+
+import argparse
+from contextlib import contextmanager
+import itertools
+import json
+import os
+import threading
+from time import perf_counter, time
+
+
+class Tracer():
+    """Write spans to a JSON-lines file.
+
+    Parameters
+    ----------
+    path : str, default : None
+        Path of the file spans are appended to. Nothing is recorded if None.
+    run : str, default : None
+        Identifier written with every span. Defaults to the start time.
+
+    """
+
+    def __init__(self, path=None, run=None):
+        self.path = path
+        self.run = run or '{:.0f}'.format(time())
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.ids = itertools.count(1)
+
+    @contextmanager
+    def span(self, stage, **fields):
+        """Record the duration of a with block.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage.
+        **fields
+            Values recorded with the span, e.g. bytes or rows. More can be
+            added to the yielded dict inside the block.
+
+        Yields
+        ------
+        fields : dict
+            The fields recorded with the span.
+
+        """
+        if self.path is None:
+            yield fields
+            return
+        stack = self.local.__dict__.setdefault('stack', [])
+        span_id = next(self.ids)
+        parent = stack[-1] if stack else None
+        stack.append(span_id)
+        start, clock = time(), perf_counter()
+        error = None
+        try:
+            yield fields
+        except BaseException as exc:
+            error = type(exc).__name__
+            raise
+        finally:
+            stack.pop()
+            record = dict(fields, run=self.run, stage=stage, id=span_id,
+                          parent=parent, start=start, end=time(),
+                          duration=perf_counter() - clock)
+            if error:
+                record['error'] = error
+            self.write(record)
+
+    def write(self, record):
+        """Append a record to the trace file."""
+        line = json.dumps(record, default=str) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as trace:
+                trace.write(line)
+
+
+TRACER = Tracer()
+
+
+def configure(path, run=None):
+    """Start recording spans.
+
+    Parameters
+    ----------
+    path : str or None
+        Path of the file spans are appended to, or None to stop tracing.
+    run : str, default : None
+        Identifier written with every span. Defaults to the start time.
+
+    """
+    TRACER.path = path
+    TRACER.run = run or '{:.0f}'.format(time())
+
+
+def span(stage, **fields):
+    """Record the duration of a with block with the module's tracer.
+
+    See Tracer.span.
+
+    """
+    return TRACER.span(stage, **fields)
+
+
+def file_size(filename):
+    """Size of a file in bytes, or None if it does not exist."""
+    try:
+        return os.stat(filename).st_size
+    except OSError:
+        return None
+
+
+def summarize(paths):
+    """Aggregate the spans of trace files by stage.
+
+    Parameters
+    ----------
+    paths : list of str
+        Paths of the trace files.
+
+    Returns
+    -------
+    summary : dict
+        For each stage, the number of runs and spans, the total, mean and
+        largest duration in seconds, and the total bytes and rows recorded.
+
+    """
+    summary = {}
+    runs = {}
+    for path in paths:
+        with open(path) as trace:
+            for line in trace:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                stats = summary.setdefault(record['stage'], {
+                    'spans': 0, 'total': 0.0, 'max': 0.0, 'bytes': 0,
+                    'rows': 0})
+                runs.setdefault(record['stage'], set()).add(
+                    (path, record['run']))
+                stats['spans'] += 1
+                stats['total'] += record['duration']
+                stats['max'] = max(stats['max'], record['duration'])
+                stats['bytes'] += record.get('bytes') or 0
+                stats['rows'] += record.get('rows') or 0
+    for stage, stats in summary.items():
+        stats['runs'] = len(runs[stage])
+        stats['mean'] = stats['total'] / stats['spans']
+    return summary
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description='Inspect calibration traces.')
+    COMMANDS = PARSER.add_subparsers(dest='command')
+    COMMANDS.required = True
+    SUMMARY = COMMANDS.add_parser(
+        'summary', help='Aggregate the spans of trace files by stage.')
+    SUMMARY.add_argument(
+        'paths', metavar='Paths', type=str, nargs='+',
+        help='The paths to the trace files.')
+    SUMMARY.add_argument(
+        '-j', '--json', action='store_true',
+        help='Print the summary as JSON.')
+    ARGS = PARSER.parse_args()
+    SUMMARY = summarize(ARGS.paths)
+    if ARGS.json:
+        print(json.dumps(SUMMARY, indent=2))
+    else:
+        print('{:16} {:>5} {:>6} {:>12} {:>10} {:>10} {:>14} {:>12}'.format(
+            'stage', 'runs', 'spans', 'total s', 'mean s', 'max s', 'bytes',
+            'rows'))
+        for STAGE, STATS in sorted(SUMMARY.items(),
+                                   key=lambda item: -item[1]['total']):
+            print('{:16} {runs:5} {spans:6} {total:12.2f} {mean:10.3f} '
+                  '{max:10.3f} {bytes:14} {rows:12}'.format(STAGE, **STATS))
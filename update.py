@@ -1,15 +1,176 @@
 """This module contians all functions related to updating calibration files."""
 
 
-from os.path import abspath
+from collections import Counter, OrderedDict
+from os import close, remove, replace, stat
+from os.path import abspath, dirname, exists
 import shutil
+import tempfile
+import threading
 
-from openpyxl import load_workbook
 import pandas as pd
-import win32com.client as win32
 from xlrd import open_workbook
 from xlutils.copy import copy
 
+from accelerate import propose
+from aggregate import (CDAP_NAMES, TARGETS, CountCache,
+                       archive as archive_results, scan, scan_ensemble)
+from biff import PatchError, patch_cells
+from recalc import recalculate
+from tracing import file_size, span
+from workbooks import WORKBOOKS
+
+
+class WorkbookCache():
+    """Parsed workbooks for read_values, keyed by path, mtime and size.
+
+    A workbook is parsed on its first read and reused until the file's
+    modification time or size changes. Least recently used workbooks are
+    released once the combined size of the cached files exceeds the budget.
+
+    Parameters
+    ----------
+    budget : int, default : 268435456
+        The largest combined size in bytes of the cached workbook files.
+
+    """
+
+    def __init__(self, budget=268435456):
+        self.budget = budget
+        self.books = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.parses = Counter()
+        self.lock = threading.Lock()
+
+    def open(self, filename):
+        """Return the parsed workbook, parsing it only if it has changed.
+
+        Parameters
+        ----------
+        filename : string
+            Path to the workbook.
+
+        Returns
+        -------
+        book : xlrd.Book
+            The parsed workbook.
+
+        """
+        path = abspath(filename)
+        status = stat(path)
+        key = (status.st_mtime_ns, status.st_size)
+        with self.lock:
+            entry = self.books.get(path)
+            if entry is not None and entry[0] == key:
+                self.hits += 1
+                self.books.move_to_end(path)
+                return entry[1]
+            self.misses += 1
+            self.parses[path] += 1
+            book = open_workbook(path)
+            self._release(path)
+            self.books[path] = (key, book)
+            while len(self.books) > 1 and sum(
+                    entry[0][1] for entry in self.books.values()) > \
+                    self.budget:
+                self._release(next(iter(self.books)))
+            return book
+
+    def _release(self, path):
+        entry = self.books.pop(path, None)
+        if entry is not None:
+            entry[1].release_resources()
+
+    def release(self, filename=None):
+        """Drop a workbook, or every workbook, from the cache.
+
+        Parameters
+        ----------
+        filename : string, default : None
+            Path to the workbook to drop. All are dropped if None.
+
+        """
+        with self.lock:
+            paths = list(self.books) if filename is None else \
+                [abspath(filename)]
+            for path in paths:
+                self._release(path)
+
+
+READ_CACHE = WorkbookCache()
+
+
+class Step():
+    """Where a calibration step keeps its constants and workbook.
+
+    Parameters
+    ----------
+    uec : str
+        Name of the step's UEC in the uec directory, without extension.
+    directory : str
+        Name of the directory of the step's calibration files.
+    workbook : str
+        Name of the base calibration workbook, without extension.
+    sheet : str
+        The sheet of the workbook that calculates the constants.
+    data : str
+        The range of the `_data` sheet the counts are written to.
+    inputs : str
+        The range of the sheet holding the constants the model was run with.
+    outputs : str
+        The range of the sheet the new constants are calculated in.
+    uec_cells : list of tuple
+        (row, column, length, axis) of each run of constants in the UEC, in
+        the order of the columns of the input and output ranges.
+    alternatives : list of str, default : None
+        The alternative of each column of the targets, each row being a
+        segment. If None, the rows are the alternatives of a single segment.
+    labels : tuple, default : None
+        (sheet, range) of the label of each row of the targets.
+    targets : tuple, default : None
+        (sheet, range) of the target shares. The calibration workbooks do
+        not keep their targets in a fixed place, so convergence is only
+        checked once both ranges are given, see convergence.py.
+
+    """
+
+    def __init__(self, uec, directory, workbook, sheet, data, inputs,
+                 outputs, uec_cells, alternatives=None, labels=None,
+                 targets=None):
+        self.uec = uec
+        self.directory = directory
+        self.workbook = workbook
+        self.sheet = sheet
+        self.data = data
+        self.inputs = inputs
+        self.outputs = outputs
+        self.uec_cells = list(uec_cells)
+        self.labels = labels
+        self.targets = targets
+        self.alternatives = alternatives
+
+    def columns(self, values):
+        """Split the values of a range, read row by row, into its columns."""
+        count = len(self.uec_cells)
+        return [list(values[idx::count]) for idx in range(count)]
+
+    def rows(self, constants):
+        """Order constants, column after column, as the rows of a range."""
+        count = len(self.uec_cells)
+        size = len(constants) // count
+        return [constants[idx + size * col] for idx in range(size)
+                for col in range(count)]
+
+
+STEPS = OrderedDict([
+    ('AO', Step('AutoOwnership', '1_AO', '1_AO Calibration', 'AO', 'B2:B6',
+                'K4:K8', 'L4:L8', [(81, 6, 5, 1)])),
+    ('CDAP', Step('CoordinatedDailyActivityPattern', '2_CDAP',
+                  '2_CDAP Calibration', 'CDAP', 'E2:E23', 'C30:D37',
+                  'I30:J37', [(88, 6, 8, 0), (88, 7, 8, 0)],
+                  alternatives=['H', 'M', 'N']))])
+
 
 def replace_values(dest, data):
     """Replace the values in dest with those in data.
@@ -27,23 +188,106 @@ def replace_values(dest, data):
         cell.value = value
 
 
-def exec_formulas(cal_path):
-    """Use excel to execute formulas in workbook.
+def exec_formulas(cal_path, engine='python', base=None, changed=()):
+    """Execute the formulas in a workbook and save their results.
 
     Parameters
     ----------
     cal_path : string
         Path to a calibration file.
+    engine : str, 'python' | 'excel'
+        Default : 'python'
+        Valid Options :
+        - 'python' : Recalculate with the native engine in recalc.py.
+        - 'excel' : Open and save the workbook in Excel through COM.
+    base : string, default : None
+        Path to the workbook cal_path was created from. The python engine
+        reuses its cached values and only recalculates the cells downstream
+        of the changed ranges.
+    changed : iterable of tuple, default : ()
+        (sheet, range) pairs of the cells that differ from base.
 
     """
+    if engine == 'python':
+        recalculate(cal_path, base=base, changed=changed)
+        return
+    import pythoncom
+    import win32com.client as win32
+    pythoncom.CoInitialize()
     excel = win32.gencache.EnsureDispatch('Excel.Application')
     workbook = excel.Workbooks.Open(abspath(cal_path))
     workbook.Save()
     workbook.Close()
     excel.Quit()
+    pythoncom.CoUninitialize()
+
 
+def read_cdap_counts(filename, chunksize=1000000):
+    """Count persons by type and activity pattern without loading the file.
 
-def update(iter_, input_path, output_path, method='AO'):
+    Only the `type` and `activity_pattern` columns are read, as categoricals,
+    in chunks of at most `chunksize` rows, so memory use does not grow with
+    the size of the synthetic population. See aggregate.scan.
+
+    Parameters
+    ----------
+    filename : str
+        Path to a personData csv file.
+    chunksize : int, default : 1000000
+        The number of rows to read at a time.
+
+    Returns
+    -------
+    counts : pandas.Series
+        Number of persons indexed by calibration type name and activity
+        pattern.
+
+    """
+    return scan(filename, {'CDAP': TARGETS['CDAP']},
+                chunksize=chunksize)['CDAP']
+
+
+def cdap_counts(results):
+    """Order the CDAP counts as they appear in the calibration workbook.
+
+    Parameters
+    ----------
+    results : pandas.DataFrame or pandas.Series
+        DataFrame of the results generated by the model, or counts already
+        indexed by type and activity pattern.
+
+    Returns
+    -------
+    counts : pandas.Series
+        Counts sorted by calibration type name and activity pattern.
+
+    """
+    if isinstance(results, pd.DataFrame):
+        results = results.groupby(['type', 'activity_pattern']).size()
+    results = results.rename(index=CDAP_NAMES, level='type')
+    return results.sort_index()
+
+
+def _archived(source, archive_path):
+    """Check if the archive of a results file is still up to date.
+
+    A csv copy made by shutil.copy2 has the source's size and modification
+    time, and a Parquet archive is newer than its source.
+
+    """
+    try:
+        source_stat, archive_stat = stat(source), stat(archive_path)
+    except OSError:
+        return False
+    if archive_path.endswith('.csv'):
+        return source_stat.st_size == archive_stat.st_size and \
+            source_stat.st_mtime_ns == archive_stat.st_mtime_ns
+    return archive_stat.st_mtime_ns >= source_stat.st_mtime_ns
+
+
+def update(iter_, input_path, output_path, method='AO', chunksize=None,
+           engine='python', cache=True, archive='parquet', workers=None,
+           accelerate=False, sources=None, start_iter=3, before_write=None):
     """Aggregate model results, calculate constants, and update the UEC.
 
     Parameters
@@ -61,29 +305,172 @@ def update(iter_, input_path, output_path, method='AO'):
         Valid Options :
         - 'AO' : Update AutoOwnership
         - 'CDAP' : Update CoordinatedDailyActivityPattern
+    chunksize : int, default : None
+        If given, csv archives are counted while streaming the file in
+        chunks of this many rows instead of being read in full.
+    engine : str, 'python' | 'excel'
+        The engine used to execute the calibration workbook formulas.
+        Default : 'python'
+    cache : bool, default : True
+        Whether to reuse the counts of an unchanged results file from, and
+        store new counts in, the `count_cache` directory next to
+        output_path. The file is not archived again either if its archive
+        is up to date.
+    archive : str, 'parquet' | 'csv'
+        How the results file is kept with the calibration files.
+        Default : 'parquet'
+        Valid Options :
+        - 'parquet' : Convert it to compressed Parquet, counting it in the
+          same pass. Requires pyarrow.
+        - 'csv' : Copy it and count the copy.
+    workers : int, default : None
+        If more than one, a csv archive is counted in byte ranges by this
+        many processes, see aggregate.scan_ranges.
+    accelerate : bool, default : False
+        Whether to accelerate the constants with the history of the
+        calibrated workbooks of the earlier iterations, see accelerate.py.
+    sources : list of str, default : None
+        The result files of an ensemble of runs with different seeds. If
+        given, the counts of the runs are averaged instead of counting the
+        model's output, and the counts of each run are archived with their
+        mean and variance in a csv file. The cache is not used.
+    start_iter : int, default : 3
+        The global iteration of the abm whose results file is counted, see
+        aggregate.Target.results.
+    before_write : callable, default : None
+        before_write(uec_path, constants) is called with the new constants,
+        ordered as returned by uec_constants, before they are written to
+        the UEC, e.g. to record them in a checkpoint.
+
+    Returns
+    -------
+    result : dict
+        The counts written to the calibration workbook and the constants
+        before and after the update, as returned by update_ao or update_cdap,
+        the paths of the uec, calibrated workbook and archived results under
+        'uec_path', 'cal_path' and 'archive_path', under 'parses' the number
+        of times read_values parsed each workbook during the update, and
+        under 'timings' the seconds this update spent loading, reading and
+        saving calibration workbooks. For an ensemble, 'variance' holds the
+        variance of each count across the runs, in the order of 'counts',
+        and 'members' the number of runs.
 
     """
-    files = {
-        'AO': ['AutoOwnership', 'aoResults', '1_AO Calibration',
-               update_ao],
-        'CDAP': ['CoordinatedDailyActivityPattern', 'personData_3',
-                 '2_CDAP Calibration', update_cdap]}
-
-    cal_path = output_path + '/{}_{}.xlsx'.format(files[method][2], iter_)
-    uec_path = input_path + '/uec/{}.xls'.format(files[method][0])
-    shutil.copy2(input_path + '/output/{}.csv'.format(files[method][1]),
-                 output_path + '/{}_{}.csv'.format(files[method][1], iter_))
-    results = pd.read_csv(
-        output_path + '/{}_{}.csv'.format(files[method][1], iter_))
-    if iter_ < 1:
-        wb_name = output_path + '/{}.xlsx'.format(files[method][2])
-    else:
-        wb_name = output_path + \
-            '/{}_{}.xlsx'.format(files[method][2], iter_ - 1)
-    files[method][3](iter_, wb_name, results, uec_path, cal_path)
+    parses = READ_CACHE.parses.copy()
+    step = STEPS[method]
+    results_file = TARGETS[method].results(start_iter)
+    stem = results_file[:-len('.csv')]
+
+    cal_path = output_path + '/{}_{}.xlsx'.format(step.workbook, iter_)
+    uec_path = input_path + '/uec/{}.xls'.format(step.uec)
+    archive_path = output_path + '/{}_{}.{}'.format(stem, iter_, archive)
+    with WORKBOOKS.timed() as timings, \
+            span('update', method=method, iteration=iter_):
+        source = input_path + '/output/' + results_file
+        target = {method: TARGETS[method]}
+        results = variance = None
+        if sources:
+            cache = False
+            archive_path = output_path + '/{}_{}_ensemble.csv'.format(
+                stem, iter_)
+            with span('ensemble_count', members=len(sources),
+                      bytes=sum(map(file_size, sources))) as fields:
+                runs = scan_ensemble(sources, target, chunksize=chunksize,
+                                     workers=workers)[method]
+                results = runs.mean(axis=1)
+                variance = runs.var(axis=1).fillna(0)
+                runs.assign(mean=results, variance=variance).to_csv(
+                    archive_path)
+                fields['rows'] = int(runs.values.sum())
+        if cache:
+            counts_cache = CountCache(
+                dirname(abspath(output_path)) + '/count_cache')
+            with span('cache_lookup', path=source) as fields:
+                results = counts_cache.get(source, TARGETS[method])
+                fields['hit'] = hit = results is not None
+        if not sources and (results is None or
+                            not _archived(source, archive_path)):
+            if archive == 'parquet':
+                with span('archive', path=source,
+                          bytes=file_size(source)) as fields:
+                    counts = archive_results(source, archive_path, target)
+                    fields['archive_bytes'] = file_size(archive_path)
+                    fields['rows'] = int(counts[method].sum())
+                results = counts[method] if results is None else results
+            else:
+                with span('copy', path=source, bytes=file_size(source)):
+                    shutil.copy2(source, archive_path)
+        if results is None:
+            with span('read_csv', path=archive_path,
+                      bytes=file_size(archive_path)) as fields:
+                results = scan(archive_path, target, chunksize=chunksize,
+                               workers=workers)[method]
+                fields['rows'] = int(results.sum())
+        if cache and not hit:
+            counts_cache.put(source, TARGETS[method], results)
+        if iter_ < 1:
+            wb_name = output_path + '/{}.xlsx'.format(step.workbook)
+        else:
+            wb_name = output_path + \
+                '/{}_{}.xlsx'.format(step.workbook, iter_ - 1)
+        history = None
+        if accelerate:
+            history = [output_path + '/{}_{}.xlsx'.format(step.workbook, idx)
+                       for idx in range(iter_)]
+        result = (update_ao if method == 'AO' else update_cdap)(
+            iter_, wb_name, results, uec_path, cal_path, engine=engine,
+            template=output_path + '/{}.xlsx'.format(step.workbook),
+            history=history, before_write=before_write)
+        if variance is not None:
+            result['variance'] = (cdap_counts(variance) if method == 'CDAP'
+                                  else variance)
+            result['members'] = len(sources)
+    result.update(uec_path=uec_path, cal_path=cal_path,
+                  archive_path=archive_path)
+    result['parses'] = dict(READ_CACHE.parses - parses)
+    result['timings'] = timings
+    return result
+
+
+def calculate(template, cal_path, inputs, output, engine='python'):
+    """Fill a copy of a calibration workbook and execute its formulas.
 
+    Parameters
+    ----------
+    template : str
+        Path to the calibration workbook to copy.
+    cal_path : str
+        Path to save the calculated workbook to.
+    inputs : list of tuple
+        ((sheet, range), data) pairs of the values to write.
+    output : tuple
+        (sheet, range) of the values to return.
+    engine : str, 'python' | 'excel'
+        The engine used to execute the calibration workbook formulas.
+        Default : 'python'
 
-def update_ao(iter_, wb_name, results, uec_path, cal_path):
+    Returns
+    -------
+    vals : list
+        Calculated values of the output range in row-major order.
+
+    """
+    with WORKBOOKS.checkout(template) as calc:
+        for (sheet, ref), data in inputs:
+            calc.set_values(sheet, ref, data)
+        if engine == 'python':
+            with span('recalculate', engine=engine) as fields:
+                fields['cells'] = calc.recalculate()
+            WORKBOOKS.save(calc, cal_path)
+            return calc.get_values(*output)
+        WORKBOOKS.save(calc.workbook, cal_path)
+    with span('recalculate', engine=engine):
+        exec_formulas(cal_path, engine=engine)
+    return WORKBOOKS.read(cal_path, *output)
+
+
+def update_ao(iter_, wb_name, results, uec_path, cal_path, engine='python',
+              template=None, history=None, before_write=None):
     """Aggregate model results, calculate constants, and update the UEC.
 
     Parameters
@@ -92,37 +479,175 @@ def update_ao(iter_, wb_name, results, uec_path, cal_path):
         The calibration iteration number.
     wb_name : str
         Path to the calibration workbook.
-    results : pandas.DataFrame
-        DataFrame of the results generated by the model.
+    results : pandas.DataFrame or pandas.Series
+        DataFrame of the results generated by the model, or counts indexed by
+        auto ownership level.
     uec_path : str
         Path to the uec file.
     cal_path : str
         Path to the calibration file.
+    engine : str, 'python' | 'excel'
+        The engine used to execute the calibration workbook formulas.
+        Default : 'python'
+    template : str, default : None
+        Path to the base calibration workbook that is copied for each
+        iteration. Defaults to wb_name.
+    history : list of str, default : None
+        If given, the paths to the calibrated workbooks of the earlier
+        iterations. The previous constants are then read from the uec, and
+        the new constants are accelerated with the history, see
+        accelerate.propose.
+    before_write : callable, default : None
+        Called with uec_path and the new constants before they are written
+        to the UEC, see update.
 
-    """
-    if iter_ > 0:
-        prev_const = read_values(wb_name, 3, 11, 5, sheet_num=0)
-
-    workbook = load_workbook(wb_name)
-    replace_values(workbook['_data']['B'][1:6],
-                   results.groupby('AO').size().values)
+    Returns
+    -------
+    result : dict
+        'counts' : pandas.Series of the counts written to the `_data` sheet,
+        'before' : the constants the model was run with,
+        'after' : the new constants written to the UEC,
+        'proposed' : the new constants calculated by the workbook,
+        'method' : 'broyden' if the constants were accelerated, otherwise
+        'workbook'.
 
-    if iter_ > 0:
-        replace_values(workbook['AO']['K'][3:8], prev_const)
+    """
+    with span('aggregate') as fields:
+        counts = results
+        if isinstance(results, pd.DataFrame):
+            counts = results.groupby('AO').size()
+        fields['groups'] = len(counts)
+    step = STEPS['AO']
+    if iter_ > 0 and history is None:
+        prev_const = WORKBOOKS.read(wb_name, step.sheet, step.outputs)
     else:
-        prev_const = read_values(uec_path, 81, 6, 5, axis=1)
-        replace_values(workbook['AO']['K'][3:8], prev_const)
-
-    workbook.save(cal_path)
-    workbook.close()
+        prev_const = uec_constants(uec_path, 'AO')
+
+    proposed = calculate(
+        template or wb_name, cal_path,
+        [(('_data', step.data), counts.values),
+         ((step.sheet, step.inputs), prev_const)],
+        (step.sheet, step.outputs), engine=engine)
+    new_constants, method = proposed, 'workbook'
+    if history is not None:
+        new_constants, method = accelerated(history, 'AO', prev_const,
+                                            proposed)
+
+    if before_write:
+        before_write(uec_path, list(new_constants))
+    write_uec_constants(uec_path, new_constants, 'AO')
+    return {'counts': counts, 'before': list(prev_const),
+            'after': new_constants, 'proposed': proposed, 'method': method}
+
+
+class UECEditor():
+    """Collect writes to a uec file and save them together.
+
+    The values are written into the existing number cells of the uec in
+    place, see biff.py, so only the bytes of those cells change. If any cell
+    can not be written in place, the uec is parsed and serialized once with
+    xlutils however many ranges and sheets are written. Either way the new
+    file replaces the old one atomically so a crash can not leave a
+    half-written uec. Used as a context manager, the writes are committed
+    when the block exits without an exception.
 
-    exec_formulas(cal_path)
+    Parameters
+    ----------
+    uec_path : string
+        Path to the uec file.
+    in_place : bool, default : True
+        Whether to try writing the cells in place before rewriting the uec.
 
-    workbook = load_workbook(cal_path, data_only=True)
-    new_constants = [cell.value for cell in workbook['AO']['L'][3:8]]
-    workbook.close()
+    """
 
-    update_uec(uec_path, 81, 6, new_constants, axis=1)
+    def __init__(self, uec_path, in_place=True):
+        self.uec_path = uec_path
+        self.in_place = in_place
+        self.writes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.writes = []
+
+    def write(self, startx, starty, values, axis=0, sheet_num=1):
+        """Queue values to write starting at the given cell.
+
+        Parameters
+        ----------
+        startx : int
+            Starting cell row index.
+        starty : int
+            Starting cell column index.
+        values : array-like
+            Values to update.
+        axis : int, default : 0
+            The axis to update values along. Rows = 0, columns = 1.
+        sheet_num : int, default : 1
+            The sheet number to use.
+
+        """
+        self.writes.append((startx, starty, list(values), axis, sheet_num))
+
+    def commit(self):
+        """Apply the queued writes in place, or with one parse and save."""
+        if not self.writes:
+            return
+        with span('uec_write', path=self.uec_path,
+                  cells=sum(len(write[2]) for write in self.writes)) as fields:
+            if self.in_place and self._patch():
+                fields['mode'] = 'patch'
+            else:
+                self._save()
+                fields['mode'] = 'rewrite'
+            fields['bytes'] = file_size(self.uec_path)
+        READ_CACHE.release(self.uec_path)
+        self.writes = []
+
+    def cells(self):
+        """The sheet, row, column and value of each queued cell write."""
+        cells = []
+        for startx, starty, values, axis, sheet_num in self.writes:
+            for idx, val in enumerate(values):
+                if axis == 0:
+                    cells.append((sheet_num, startx + idx, starty, val))
+                else:
+                    cells.append((sheet_num, startx, starty + idx, val))
+        return cells
+
+    def _patch(self):
+        try:
+            patch_cells(self.uec_path, self.cells())
+        except PatchError:
+            return False
+        return True
+
+    def _save(self):
+        uec = open_workbook(self.uec_path, formatting_info=True)
+        workbook = copy(uec)
+        for startx, starty, values, axis, sheet_num in self.writes:
+            sheet = workbook.get_sheet(sheet_num)
+            if axis == 0:
+                for idx, val in enumerate(values):
+                    sheet.write(startx + idx, starty, val)
+            else:
+                for idx, val in enumerate(values):
+                    sheet.write(startx, starty + idx, val)
+        uec.release_resources()
+        handle, temp = tempfile.mkstemp(
+            dir=dirname(abspath(self.uec_path)), suffix='.xls')
+        close(handle)
+        try:
+            workbook.save(temp)
+            shutil.copymode(self.uec_path, temp)
+            replace(temp, self.uec_path)
+        except BaseException:
+            remove(temp)
+            raise
 
 
 def update_uec(uec_path, startx, starty, values, axis=0, sheet_num=1):
@@ -144,17 +669,8 @@ def update_uec(uec_path, startx, starty, values, axis=0, sheet_num=1):
         The sheet number to use.
 
     """
-    uec = open_workbook(uec_path, formatting_info=True)
-    workbook = copy(uec)
-    sheet = workbook.get_sheet(sheet_num)
-    if axis == 0:
-        for idx, val in enumerate(values):
-            sheet.write(startx + idx, starty, val)
-    else:
-        for idx, val in enumerate(values):
-            sheet.write(startx, starty + idx, val)
-    workbook.save(uec_path)
-    uec.release_resources()
+    with UECEditor(uec_path) as uec:
+        uec.write(startx, starty, values, axis=axis, sheet_num=sheet_num)
 
 
 def read_values(filename, startx, starty, length, axis=0, sheet_num=1):
@@ -181,19 +697,209 @@ def read_values(filename, startx, starty, length, axis=0, sheet_num=1):
         Array of constants read from uec file.
 
     """
-    uec = open_workbook(filename)
-    sheet = uec.sheet_by_index(sheet_num)
+    sheet = READ_CACHE.open(filename).sheet_by_index(sheet_num)
     if axis == 0:
         vals = [sheet.cell_value(rowx=startx + idx, colx=starty)
                 for idx in range(length)]
     else:
         vals = [sheet.cell_value(rowx=startx, colx=starty + idx)
                 for idx in range(length)]
-    uec.release_resources()
     return vals
 
 
-def update_cdap(iter_, wb_name, results, uec_path, cal_path):
+def uec_constants(uec_path, method='AO'):
+    """Read the constants the calibration writes to a UEC.
+
+    Parameters
+    ----------
+    uec_path : str
+        Path to the uec file.
+    method : str, 'AO' | 'CDAP'
+        The step the uec belongs to.
+
+    Returns
+    -------
+    vals : list
+        The constants, ordered as the 'after' constants returned by
+        update_ao and update_cdap.
+
+    """
+    return [value for startx, starty, length, axis in STEPS[method].uec_cells
+            for value in read_values(uec_path, startx, starty, length,
+                                     axis=axis)]
+
+
+def write_uec_constants(uec_path, constants, method='AO'):
+    """Write the constants the calibration updates to a UEC.
+
+    Parameters
+    ----------
+    uec_path : str
+        Path to the uec file.
+    constants : list
+        The constants, ordered as returned by uec_constants.
+    method : str, 'AO' | 'CDAP'
+        The step the uec belongs to.
+
+    """
+    constants = list(constants)
+    with UECEditor(uec_path) as uec:
+        for startx, starty, length, axis in STEPS[method].uec_cells:
+            uec.write(startx, starty, constants[:length], axis=axis)
+            constants = constants[length:]
+
+
+def workbook_step(template, cal_path, counts, constants, method='AO',
+                  engine='python'):
+    """Calculate the constants a calibration workbook proposes for a run.
+
+    Parameters
+    ----------
+    template : str
+        Path to the base calibration workbook.
+    cal_path : str
+        Path to save the calculated workbook to.
+    counts : pandas.Series
+        The counts of the run, as returned by aggregate.scan.
+    constants : list
+        The constants the run used, ordered as returned by uec_constants.
+    method : str, 'AO' | 'CDAP'
+        The step the workbook belongs to.
+    engine : str, 'python' | 'excel'
+        The engine used to execute the calibration workbook formulas.
+
+    Returns
+    -------
+    vals : list
+        The proposed constants, in the same order.
+
+    """
+    step = STEPS[method]
+    if method == 'CDAP':
+        counts = cdap_counts(counts)
+    vals = calculate(
+        template, cal_path, [(('_data', step.data), counts.values),
+                             ((step.sheet, step.inputs),
+                              step.rows(list(constants)))],
+        (step.sheet, step.outputs), engine=engine)
+    return sum(step.columns(vals), [])
+
+
+def workbook_constants(cal_path, method='AO'):
+    """Read the new constants calculated by a calibration workbook.
+
+    Parameters
+    ----------
+    cal_path : str
+        Path to the calibrated workbook of an iteration.
+    method : str, 'AO' | 'CDAP'
+        The step the workbook belongs to.
+
+    Returns
+    -------
+    vals : list
+        The constants, ordered as the 'after' constants returned by
+        update_ao and update_cdap.
+
+    """
+    step = STEPS[method]
+    return sum(step.columns(WORKBOOKS.read(cal_path, step.sheet,
+                                           step.outputs)), [])
+
+
+def _label(value):
+    """Read a workbook label as text, e.g. the level 1.0 as '1'."""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def workbook_targets(cal_path, method='AO', labels=None, targets=None):
+    """Read the target shares of a calibration workbook.
+
+    Parameters
+    ----------
+    cal_path : str
+        Path to a calibration workbook of the step.
+    method : str, 'AO' | 'CDAP'
+        The step the workbook belongs to.
+    labels : tuple, default : None
+        (sheet, range) of the label of each row of the targets. Defaults to
+        the step's, see Step.
+    targets : tuple, default : None
+        (sheet, range) of the target shares. Defaults to the step's.
+
+    Returns
+    -------
+    targets : list of tuple
+        (segment, {alternative: share}) pairs in the order of the rows of
+        the labels. For auto ownership the only segment is 'AO' and each row
+        is an alternative.
+
+    Raises
+    ------
+    ValueError
+        If the step has no target ranges.
+    KeyError
+        If the workbook has no sheet of that name.
+
+    """
+    step = STEPS[method]
+    labels = labels or step.labels
+    targets = targets or step.targets
+    if not labels or not targets:
+        raise ValueError('No target ranges are given for {}.'.format(method))
+    labels = [_label(value) for value in WORKBOOKS.read(cal_path, *labels)]
+    shares = WORKBOOKS.read(cal_path, *targets)
+    if step.alternatives is None:
+        return [(method, dict(zip(labels, shares)))]
+    size = len(step.alternatives)
+    return [(label, dict(zip(step.alternatives,
+                             shares[row * size:(row + 1) * size])))
+            for row, label in enumerate(labels)]
+
+
+def accelerated(history, method, prev_const, proposed):
+    """Accelerate the constants a workbook proposes with earlier iterations.
+
+    Parameters
+    ----------
+    history : list of str
+        Paths to the calibrated workbooks of the earlier iterations. Missing
+        workbooks are skipped.
+    method : str, 'AO' | 'CDAP'
+        The step the workbooks belong to.
+    prev_const : list
+        The constants the model was run with, in the order of the workbook's
+        input range.
+    proposed : list
+        The constants the workbook calculated, in the same order.
+
+    Returns
+    -------
+    constants : list
+        The new constants, in the same order.
+    method : str
+        'broyden' if the constants were accelerated, otherwise 'workbook'.
+
+    """
+    step = STEPS[method]
+    before, after = [], []
+    for cal_path in history:
+        if exists(cal_path):
+            before.append(WORKBOOKS.read(cal_path, step.sheet, step.inputs))
+            after.append(WORKBOOKS.read(cal_path, step.sheet, step.outputs))
+    before.append(prev_const)
+    after.append(proposed)
+    with span('accelerate', method=method, history=len(before)) as fields:
+        constants, fields['method'] = propose(
+            [[value or 0 for value in row] for row in before],
+            [[value or 0 for value in row] for row in after])
+    return constants, fields['method']
+
+
+def update_cdap(iter_, wb_name, results, uec_path, cal_path, engine='python',
+                template=None, history=None, before_write=None):
     """Aggregate model results, calculate constants, and update the UEC.
 
     Parameters
@@ -202,49 +908,64 @@ def update_cdap(iter_, wb_name, results, uec_path, cal_path):
         The calibration iteration number.
     wb_name : str
         Path to the calibration workbook.
-    results : pandas.DataFrame
-        DataFrame of the results generated by the model.
+    results : pandas.DataFrame or pandas.Series
+        DataFrame of the results generated by the model, or counts indexed by
+        type and activity pattern.
     uec_path : str
         Path to the uec file.
     cal_path : str
         Path to the calibration file.
+    engine : str, 'python' | 'excel'
+        The engine used to execute the calibration workbook formulas.
+        Default : 'python'
+    template : str, default : None
+        Path to the base calibration workbook that is copied for each
+        iteration. Defaults to wb_name.
+    history : list of str, default : None
+        If given, the paths to the calibrated workbooks of the earlier
+        iterations. The previous constants are then read from the uec, and
+        the new constants are accelerated with the history, see
+        accelerate.propose.
+    before_write : callable, default : None
+        Called with uec_path and the new constants before they are written
+        to the UEC, see update.
+
+    Returns
+    -------
+    result : dict
+        'counts' : pandas.Series of the counts written to the `_data` sheet,
+        'before' : the constants the model was run with, the M column
+        followed by the N column,
+        'after' : the new constants written to the UEC,
+        'proposed' : the new constants calculated by the workbook,
+        'method' : 'broyden' if the constants were accelerated, otherwise
+        'workbook'.
 
     """
-    res = results.groupby(['type', 'activity_pattern']).size()\
-        .reset_index()
-    names = {'Child too young for school': 'Pre-school',
-             'Non-worker': 'Non-working Adult',
-             'Retired': 'Non-working Senior',
-             'Student of driving age': 'Driving Age Student',
-             'Student of non-driving age': 'Non-driving Student',
-             'University Student': 'College Student'}
-    for orig, final in names.items():
-        res.loc[res.type == orig, 'type'] = final
-    res_vals = res.sort_values(['type', 'activity_pattern'])[0].values
-
-    if iter_ > 0:
-        prev_m_const = read_values(wb_name, 30, 9, 8, sheet_num=0)
-        prev_n_const = read_values(wb_name, 30, 10, 8, sheet_num=0)
-
-    workbook = load_workbook(wb_name)
-    replace_values(workbook['_data']['E'][1:23], res_vals)
-
-    if iter_ > 0:
-        replace_values(workbook['CDAP']['C'][29:37], prev_m_const)
-        replace_values(workbook['CDAP']['D'][29:37], prev_n_const)
+    with span('aggregate') as fields:
+        counts = cdap_counts(results)
+        fields['groups'] = len(counts)
+    step = STEPS['CDAP']
+    if iter_ > 0 and history is None:
+        prev_const = WORKBOOKS.read(wb_name, step.sheet, step.outputs)
     else:
-        prev_m_const = read_values(uec_path, 88, 6, 8)
-        prev_n_const = read_values(uec_path, 88, 7, 8)
-        replace_values(workbook['CDAP']['C'][29:37], prev_m_const)
-        replace_values(workbook['CDAP']['D'][29:37], prev_n_const)
-
-    workbook.save(cal_path)
-    workbook.close()
-
-    exec_formulas(cal_path)
-
-    new_m_const = read_values(cal_path, 30, 9, 8, sheet_num=0)
-    new_n_const = read_values(cal_path, 30, 10, 8, sheet_num=0)
-
-    update_uec(uec_path, 88, 6, new_m_const)
-    update_uec(uec_path, 88, 7, new_n_const)
+        prev_const = step.rows(uec_constants(uec_path, 'CDAP'))
+
+    proposed = calculate(
+        template or wb_name, cal_path,
+        [(('_data', step.data), counts.values),
+         ((step.sheet, step.inputs), prev_const)],
+        (step.sheet, step.outputs), engine=engine)
+    new_const, method = proposed, 'workbook'
+    if history is not None:
+        new_const, method = accelerated(history, 'CDAP', prev_const,
+                                        proposed)
+    prev_m_const, prev_n_const = step.columns(prev_const)
+    new_m_const, new_n_const = step.columns(new_const)
+
+    if before_write:
+        before_write(uec_path, new_m_const + new_n_const)
+    write_uec_constants(uec_path, new_m_const + new_n_const, 'CDAP')
+    return {'counts': counts, 'before': list(prev_m_const + prev_n_const),
+            'after': new_m_const + new_n_const,
+            'proposed': sum(step.columns(proposed), []), 'method': method}
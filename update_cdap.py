@@ -1,14 +1,13 @@
 #! /usr/bin/env/python
 
 import argparse
-from os.path import abspath
 import shutil
 
 from openpyxl import load_workbook
 import pandas as pd
-import win32com.client as win32
 from xlrd import open_workbook
-from xlutils.copy import copy
+
+from update import UECEditor, cdap_counts, exec_formulas, read_cdap_counts
 
 
 PARSER = argparse.ArgumentParser(
@@ -26,7 +25,14 @@ PARSER.add_argument(
 PARSER.add_argument(
     '-o', '--output_path', metavar='Output_Path', type=str, default='.',
     help='The path to the directory containing the model calibration files.')
-ARGS = PARSER.parse_args()
+PARSER.add_argument(
+    '-c', '--chunksize', metavar='Chunksize', type=int, default=None,
+    help='Count the person data in chunks of this many rows instead of '
+    'reading the whole file.')
+PARSER.add_argument(
+    '-e', '--engine', metavar='Engine', type=str, default='python',
+    choices=['python', 'excel'], help='The engine used to execute the '
+    'calibration workbook formulas.')
 
 
 def replace_values(dest, data):
@@ -45,7 +51,8 @@ def replace_values(dest, data):
         cell.value = value
 
 
-def update_cdap(iter_, input_path, output_path):
+def update_cdap(iter_, input_path, output_path, chunksize=None,
+                engine='python'):
     """Aggregate model results, calculate constants, and update the UEC.
 
     Parameters
@@ -57,26 +64,24 @@ def update_cdap(iter_, input_path, output_path):
         directories.
     output_path : str
         The relative path to the directory containing the calibration files.
+    chunksize : int, default : None
+        If given, only the type and activity_pattern columns are read, in
+        chunks of this many rows, and the counts are accumulated per chunk.
+    engine : str, default : 'python'
+        The engine used to execute the calibration workbook formulas, either
+        'python' or 'excel'.
 
     """
     uec_path = input_path + '/uec/CoordinatedDailyActivityPattern.xls'
     shutil.copy2(input_path + '/output/personData_3.csv',
                  output_path + f'/personData_{iter_}.csv')
 
-    results = pd.read_csv(output_path + f'/personData_{iter_}.csv')
-    res_vals = results.groupby(['type', 'activity_pattern']).size()\
-        .reset_index()
-    res_vals.loc[res_vals.type == 'Child too young for school', 'type'] = \
-        'Pre-school'
-    res_vals.loc[res_vals.type == 'Non-worker', 'type'] = 'Non-working Adult'
-    res_vals.loc[res_vals.type == 'Retired', 'type'] = 'Non-working Senior'
-    res_vals.loc[res_vals.type == 'Student of driving age', 'type'] = \
-        'Driving Age Student'
-    res_vals.loc[res_vals.type == 'Student of non-driving age', 'type'] = \
-        'Non-driving Student'
-    res_vals.loc[res_vals.type == 'University Student', 'type'] = \
-        'College Student'
-    res_vals = res_vals.sort_values(['type', 'activity_pattern'])[0].values
+    if chunksize:
+        results = read_cdap_counts(output_path + f'/personData_{iter_}.csv',
+                                   chunksize=chunksize)
+    else:
+        results = pd.read_csv(output_path + f'/personData_{iter_}.csv')
+    res_vals = cdap_counts(results).values
 
     if iter_ < 1:
         wb_name = output_path + '/2_CDAP Calibration.xlsx'
@@ -112,11 +117,8 @@ def update_cdap(iter_, input_path, output_path):
     workbook.save(cal_out)
     workbook.close()
 
-    excel = win32.gencache.EnsureDispatch('Excel.Application')
-    workbook = excel.Workbooks.Open(abspath(cal_out))
-    workbook.Save()
-    workbook.Close()
-    excel.Quit()
+    exec_formulas(cal_out, engine=engine, base=wb_name,
+                  changed=[('_data', 'E2:E23'), ('CDAP', 'C30:D37')])
 
     workbook = load_workbook(cal_out, data_only=True)
     new_m_const = [workbook['CDAP'].cell(row=30 + idx, column=9).value
@@ -125,17 +127,13 @@ def update_cdap(iter_, input_path, output_path):
                    for idx in range(8)]
     workbook.close()
 
-    cdap_uec = open_workbook(uec_path, formatting_info=True)
-    workbook = copy(cdap_uec)
-    cdap = workbook.get_sheet(1)
-    for idx, val in enumerate(new_m_const):
-        cdap.write(88 + idx, 6, val)
-    for idx, val in enumerate(new_n_const):
-        cdap.write(88 + idx, 7, val)
-    workbook.save(uec_path)
-    cdap_uec.release_resources()
+    with UECEditor(uec_path) as uec:
+        uec.write(88, 6, new_m_const)
+        uec.write(88, 7, new_n_const)
 
 
 if __name__ == '__main__':
+    ARGS = PARSER.parse_args()
     update_cdap(
-        ARGS.iteration, ARGS.input_path, ARGS.output_path)
+        ARGS.iteration, ARGS.input_path, ARGS.output_path,
+        chunksize=ARGS.chunksize, engine=ARGS.engine)
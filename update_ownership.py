@@ -1,14 +1,13 @@
 #! /usr/bin/env/python
 
 import argparse
-from os.path import abspath
 import shutil
 
 from openpyxl import load_workbook
 import pandas as pd
-import win32com.client as win32
 from xlrd import open_workbook
-from xlutils.copy import copy
+
+from update import UECEditor, exec_formulas
 
 
 PARSER = argparse.ArgumentParser(
@@ -25,7 +24,10 @@ PARSER.add_argument(
 PARSER.add_argument(
     '-o', '--output_path', metavar='Output_Path', type=str, default='.',
     help='The path to the directory containing the model calibration files.')
-ARGS = PARSER.parse_args()
+PARSER.add_argument(
+    '-e', '--engine', metavar='Engine', type=str, default='python',
+    choices=['python', 'excel'], help='The engine used to execute the '
+    'calibration workbook formulas.')
 
 
 def replace_values(dest, data):
@@ -44,7 +46,7 @@ def replace_values(dest, data):
         cell.value = value
 
 
-def update_auto_ownership(iter_, input_path, output_path):
+def update_auto_ownership(iter_, input_path, output_path, engine='python'):
     """Aggregate model results, calculate constants, and update the UEC.
 
     Parameters
@@ -56,6 +58,9 @@ def update_auto_ownership(iter_, input_path, output_path):
         directories.
     output_path : str
         The relative path to the directory containing the calibration files.
+    engine : str, default : 'python'
+        The engine used to execute the calibration workbook formulas, either
+        'python' or 'excel'.
 
     """
     uec_path = input_path + '/uec/AutoOwnership.xls'
@@ -90,25 +95,19 @@ def update_auto_ownership(iter_, input_path, output_path):
     workbook.save(cal_out)
     workbook.close()
 
-    excel = win32.gencache.EnsureDispatch('Excel.Application')
-    workbook = excel.Workbooks.Open(abspath(cal_out))
-    workbook.Save()
-    workbook.Close()
-    excel.Quit()
+    exec_formulas(cal_out, engine=engine, base=wb_name,
+                  changed=[('_data', 'B2:B6'), ('AO', 'K4:K8')])
 
     workbook = load_workbook(cal_out, data_only=True)
     new_constants = [cell.value for cell in workbook['AO']['L'][3:8]]
     workbook.close()
 
-    ao_uec = open_workbook(uec_path, formatting_info=True)
-    workbook = copy(ao_uec)
-    auto_ownership = workbook.get_sheet(1)
-    for idx, val in enumerate(new_constants):
-        auto_ownership.write(81, 6 + idx, val)
-    workbook.save(uec_path)
-    ao_uec.release_resources()
+    with UECEditor(uec_path) as uec:
+        uec.write(81, 6, new_constants, axis=1)
 
 
 if __name__ == '__main__':
+    ARGS = PARSER.parse_args()
     update_auto_ownership(
-        ARGS.iteration, ARGS.input_path, ARGS.output_path)
+        ARGS.iteration, ARGS.input_path, ARGS.output_path,
+        engine=ARGS.engine)
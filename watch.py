@@ -0,0 +1,176 @@
+"""This module detects when the model has finished writing an output file.
+
+A file counts as finished once it has been modified after the model was
+launched and its size and modification time have not changed for a quiet
+period. On Linux the output directory is watched with inotify so that changes
+are seen as soon as they happen; elsewhere, or if inotify is unavailable, the
+file is polled at a short interval.
+
+"""
+
+import ctypes
+import ctypes.util
+import os
+import os.path as osp
+import select
+import sys
+from time import sleep, time
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+class WriterExited(RuntimeError):
+    """The process writing a file exited without writing it."""
+
+
+class Inotify():
+    """Minimal inotify watch on a directory.
+
+    Parameters
+    ----------
+    directory : str
+        Path to the directory to watch.
+
+    """
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def wait(self, timeout):
+        """Block until an event arrives or timeout seconds have passed.
+
+        Parameters
+        ----------
+        timeout : float
+            The maximum number of seconds to wait.
+
+        Returns
+        -------
+        changed : bool
+            Whether any event arrived.
+
+        """
+        ready, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        """Release the inotify file descriptor."""
+        os.close(self.fd)
+
+
+def make_watcher(directory):
+    """Create an inotify watcher for directory if the platform allows it.
+
+    Parameters
+    ----------
+    directory : str
+        Path to the directory to watch.
+
+    Returns
+    -------
+    watcher : Inotify or None
+        The watcher, or None if polling should be used instead.
+
+    """
+    if not sys.platform.startswith('linux') or not osp.isdir(directory):
+        return None
+    try:
+        return Inotify(directory)
+    except (OSError, AttributeError):
+        return None
+
+
+def wait_for_output(filename, start_time, quiet_period=60, poll_interval=5,
+                    timeout=None, exited=None):
+    """Wait until the model has finished rewriting an output file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the output file.
+    start_time : float
+        Time the model was launched, as returned by time.time. Earlier
+        versions of the file are ignored.
+    quiet_period : float, default : 60
+        Number of seconds the file's size and modification time must stay the
+        same before it is considered complete.
+    poll_interval : float, default : 5
+        The longest time in seconds between checks of the file.
+    timeout : float, default : None
+        If given, the number of seconds after which to give up.
+    exited : callable, default : None
+        If given, returns True once the process writing the file has exited.
+        A file the process wrote is then complete without waiting for the
+        quiet period.
+
+    Returns
+    -------
+    stat : os.stat_result
+        The status of the completed file.
+
+    Raises
+    ------
+    TimeoutError
+        If the file is not complete within timeout seconds.
+    WriterExited
+        If the process exited without writing the file.
+
+    """
+    watcher = make_watcher(osp.dirname(osp.abspath(filename)))
+    began = time()
+    last = None
+    stable_since = None
+    try:
+        while True:
+            now = time()
+            done = exited is not None and exited()
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                stat = None
+            wait = poll_interval
+            if stat is not None and stat.st_mtime >= start_time:
+                if done:
+                    return stat
+                current = (stat.st_mtime_ns, stat.st_size)
+                if current != last:
+                    last, stable_since = current, now
+                elif now - stable_since >= quiet_period:
+                    return stat
+                wait = min(poll_interval,
+                           quiet_period - (now - stable_since))
+            else:
+                if done:
+                    raise WriterExited('The model exited without writing '
+                                       '{}.'.format(filename))
+                last = None
+            if timeout is not None:
+                if now - began >= timeout:
+                    raise TimeoutError(
+                        'Timed out waiting for {}.'.format(filename))
+                wait = min(wait, timeout - (now - began))
+            if watcher is not None:
+                watcher.wait(wait)
+            else:
+                sleep(max(wait, 0))
+    finally:
+        if watcher is not None:
+            watcher.close()
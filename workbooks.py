@@ -0,0 +1,175 @@
+"""This module manages the calibration workbooks used by the update.
+
+The base calibration workbooks (`1_AO Calibration.xlsx` and
+`2_CDAP Calibration.xlsx`) are parsed once per process and kept in memory.
+Each iteration overwrites every input range of the template, recalculates and
+saves it under the iteration's name, instead of loading the previous
+iteration's workbook from disk. Value-only reads stream the requested range in
+read-only mode. Every load, read and save is timed so the cost can be reported
+for each iteration. The timings are collected by the thread that does the
+work, so updates running side by side each report only their own.
+
+"""
+
+from contextlib import contextmanager
+from os import stat
+from os.path import abspath
+import threading
+from time import perf_counter
+
+from openpyxl import load_workbook
+from openpyxl.utils.cell import range_boundaries
+
+from recalc import Calculator
+from tracing import file_size, span
+
+
+class WorkbookManager():
+    """Cache of parsed calibration workbook templates."""
+
+    def __init__(self):
+        self.templates = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _time(self, operation, filename, start):
+        timing = {'operation': operation, 'path': filename,
+                  'seconds': perf_counter() - start}
+        for timings in getattr(self.local, 'collectors', []):
+            timings.append(timing)
+
+    @contextmanager
+    def timed(self):
+        """Collect the timings of the current thread during a with block.
+
+        Yields
+        ------
+        timings : list of dict
+            The operation, path and seconds of each load, read and save the
+            thread does in the block, filled in as they complete.
+
+        """
+        timings = []
+        collectors = self.local.__dict__.setdefault('collectors', [])
+        collectors.append(timings)
+        try:
+            yield timings
+        finally:
+            collectors.pop()
+
+    def _load(self, filename):
+        """Parse a template, or return it if parsed since its last change.
+
+        Returns a tuple of the file's (mtime, size) key, the template's
+        calculator and the lock guarding its use.
+
+        """
+        path = abspath(filename)
+        status = stat(path)
+        key = (status.st_mtime_ns, status.st_size)
+        with self.lock:
+            entry = self.templates.get(path)
+            if entry is None or entry[0] != key:
+                start = perf_counter()
+                with span('workbook_load', path=filename,
+                          bytes=status.st_size):
+                    workbook = load_workbook(path)
+                    values = load_workbook(path, data_only=True)
+                    calc = Calculator(workbook, values)
+                    values.close()
+                    calc.recalculate()
+                self._time('load', filename, start)
+                entry = (key, calc, threading.Lock())
+                self.templates[path] = entry
+            return entry
+
+    @contextmanager
+    def checkout(self, filename):
+        """Borrow a template for the duration of a with block.
+
+        The template is only reused by one caller at a time. Values written to
+        it persist, so callers should overwrite every input range they rely
+        on.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the template workbook.
+
+        Yields
+        ------
+        calc : recalc.Calculator
+            The template's calculator, with the workbook as `calc.workbook`.
+
+        """
+        _, calc, lock = self._load(filename)
+        with lock:
+            yield calc
+
+    def read(self, filename, sheet, ref):
+        """Stream the values of a range from a saved workbook.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the workbook.
+        sheet : str
+            Title of the worksheet.
+        ref : str
+            Range to read, e.g. 'L4:L8'.
+
+        Returns
+        -------
+        vals : list
+            Cached values of the range in row-major order.
+
+        """
+        start = perf_counter()
+        min_col, min_row, max_col, max_row = range_boundaries(ref)
+        with span('workbook_read', path=filename, bytes=file_size(filename)):
+            workbook = load_workbook(filename, read_only=True,
+                                     data_only=True)
+            try:
+                vals = [value for row in workbook[sheet].iter_rows(
+                    min_row=min_row, max_row=max_row, min_col=min_col,
+                    max_col=max_col, values_only=True) for value in row]
+            finally:
+                workbook.close()
+        self._time('read', filename, start)
+        return vals
+
+    def save(self, workbook, filename):
+        """Save a workbook or calculator.
+
+        Parameters
+        ----------
+        workbook : openpyxl.Workbook or recalc.Calculator
+            The workbook to save. A calculator also stores its computed
+            values.
+        filename : str
+            Path to write the workbook to.
+
+        """
+        start = perf_counter()
+        with span('workbook_save', path=filename) as fields:
+            workbook.save(filename)
+            fields['bytes'] = file_size(filename)
+        self._time('save', filename, start)
+
+    def release(self, filename=None):
+        """Drop a template, or every template, from the cache.
+
+        Parameters
+        ----------
+        filename : str, default : None
+            Path to the template to drop. All are dropped if None.
+
+        """
+        with self.lock:
+            if filename is None:
+                self.templates.clear()
+            else:
+                self.templates.pop(abspath(filename), None)
+
+
+WORKBOOKS = WorkbookManager()